@@ -37,15 +37,19 @@ def print_canto_usage():
     print_common_usage()
 
 def print_fetch_usage():
-    print "USAGE: canto-fetch [-hvVfdbDCLF]"
+    print "USAGE: canto-fetch [-hvVfdbjDCLF]"
     print "--help       -h       This help."
     print "--version    -v       Print version info."
     print "--verbose    -V       Print extra info while running."
-    print "--force      -f       Force update, regardless of timeestamps."
+    print "--force      -f       Force update, regardless of timeestamps"
+    print "                      (with -d, every feed, every interval)."
     print "--daemon     -d       Run as a daemon."
     print "--background -b       Background (implies -d)"
     print "--interval   -i       Update interval when run as a daemon"
     print "--sysfp      -s       Use system feedparser instead of builtin."
+    print "--jobs       -j [n]   Number of feeds to fetch at once."
+    print "--engine        [e]   Fetch engine, thread or async."
+    print "--stats               Show where the last fetch of each feed spent its time."
     print ""
     print_common_usage()
 
@@ -9,10 +9,14 @@
 # canto client source because they share configuration and canto-fetch can
 # conveniently fit into a single file without there being too much confusion.
 
-# There are three parts, roughly.
-# main()        -> arg parsing and (if necessary) runs the daemon loop
-# run()         -> spawns the appropriate threads
-# FetchThread   -> performs the update for one feed
+# There are six parts, roughly.
+# main()         -> arg parsing and (if necessary) runs the daemon loop
+# RefreshQueue   -> the daemon's index of when each feed is due
+# run()          -> queues up the feeds and spawns a bounded pool of workers
+#                   (and a ParsePool of processes to parse what they download)
+# FetchScheduler -> decides which queued feed a worker gets next
+# FetchWorker    -> a worker thread, runs queued FetchThreads until none are left
+# FetchThread    -> performs the update for one feed
 
 # main is only used when canto-fetch is called from the command line.
 # run is used internally by canto when it needs to invoke an update.
@@ -22,29 +26,84 @@ import feedparser_builtin
 feedparser = feedparser_builtin
 
 from const import VERSION_TUPLE, GIT_SHA
+from connpool import ConnectionPool
+from fetch_async import AsyncEngine, DownloadError, PARSE_WORKERS
+from fetch_parse import ParsePool
+from fetch_backoff import Backoff
+from fetch_checked import Checked
+from storage import copy_feed
+import fetch_backoff
+import fetch_stats
+import notify
+import changelog
 from cfg.base import get_cfg
 import utility
 import args
 
-from threading import Thread
+from threading import Thread, Condition
 import traceback
-import commands
+import calendar
+import heapq
+import Queue
+import subprocess
 import urlparse
+from StringIO import StringIO
 import urllib2
-import cPickle
+import urllib
+import httplib
+import hashlib
+import tempfile
+import zlib
 import locale
 import socket
 import signal
-import fcntl
 import time
 import sys
 import os
 
+# Downloads are written to disk, and read back for parsing, this much at a
+# time.
+
+SPOOL_CHUNK = 65536
+
+# Feeds that are gone from the configuration, and the blobs nothing refers to
+# anymore (see storage.py), are pruned when canto-fetch starts and then again
+# after every PRUNE_WRITES feeds it writes, so that a daemon (or the client,
+# which runs updates itself) doesn't pile them up forever. written counts the
+# writes since the last prune, by feed directory.
+
+PRUNE_WRITES = 100
+written = {}
+
+def prune(cfg, log_func):
+    written[cfg.feed_dir] = 0
+
+    # Remove any crap out of the store. This is mostly for
+    # cleaning up when the user has removed a feed from the configuration.
+
+    valid_names = [f.URL.replace("/","_") for f in cfg.feeds]
+    try:
+        cfg.store.prune(valid_names, log_func)
+    except:
+        log_func("Exception cleaning up feeds : %s" % sys.exc_info()[1])
+
+    # The same goes for the change logs of feeds that are gone.
+
+    if os.path.isdir(cfg.feed_dir + ".changes"):
+        for file in os.listdir(cfg.feed_dir + ".changes"):
+            if not file in valid_names:
+                try:
+                    os.unlink(cfg.feed_dir + ".changes/" + file)
+                except:
+                    pass
+
 def main(enc):
     conf_dir, log_file, conf_file, feed_dir, script_dir, optlist =\
         args.parse_common_args(enc,
-            "hvVfdbi:s", ["help","version","verbose","force","daemon",\
-                    "background", "interval=", "sysfp"], "canto-fetch")
+            "hvVfdbi:sj:", ["help","version","verbose","force","daemon",\
+                    "background", "interval=", "sysfp", "jobs=", "engine=",\
+                    "stats"],
+                    "canto-fetch")
 
     try :
         cfg = get_cfg(conf_file, log_file, feed_dir, script_dir)
@@ -69,6 +128,8 @@ def main(enc):
     background = False
     verbose = False
     force = False
+    jobs = None
+    engine = None
 
     for opt, arg in optlist :
         if opt in ["-d","--daemon"]:
@@ -96,22 +157,33 @@ def main(enc):
                 feedparser = feedparser_system
             except:
                 log_func("Import failed. Falling back on builtin.")
+        if opt in ["-j","--jobs"]:
+            try:
+                arg = unicode(arg, enc, "ignore")
+                i = int(arg)
+                if i < 1:
+                    cfg.log("jobs must be >= 1")
+                else:
+                    jobs = i
+                    cfg.log("jobs = %d" % jobs)
+            except:
+                cfg.log("%s isn't a valid number of jobs" % arg)
+        if opt == "--engine":
+            arg = unicode(arg, enc, "ignore")
+            if arg not in ["thread", "async"]:
+                cfg.log("%s isn't a valid engine, try thread or async" % arg)
+            else:
+                engine = arg
+                cfg.log("engine = %s" % engine)
         if opt in ["-V","--verbose"]:
             verbose = True
         elif opt in ["-f","--force"]:
             force = True
+        elif opt == "--stats":
+            fetch_stats.report(cfg.feed_dir + ".stats")
+            sys.exit(0)
 
-    # Remove any crap out of the directory. This is mostly for
-    # cleaning up when the user has removed a feed from the configuration.
-
-    valid_names = [f.URL.replace("/","_") for f in cfg.feeds]
-    for file in os.listdir(cfg.feed_dir):
-        if not file in valid_names:
-            log_func("Deleted extraneous file: %s" % file)
-            try:
-                os.unlink(cfg.feed_dir + file)
-            except:
-                pass
+    prune(cfg, log_func)
 
     if background:
         # This is a pretty canonical way to do backgrounding.
@@ -136,20 +208,37 @@ def main(enc):
         os.close(1)
         os.close(2)
 
+    # The connection pool outlives each run, so a daemon can keep reusing the
+    # connections it made on the last update.
+
+    pool = ConnectionPool(jobs or cfg.fetch_concurrency)
+
+    # As a daemon, we only look at feeds when they're due according to the
+    # RefreshQueue, and sleep until the next one is (but never longer than the
+    # interval, so config changes are still picked up). The first run reads
+    # every feed file and fills in the RefreshQueue, after that feeds that
+    # aren't due aren't touched at all. With -f, every feed is fetched every
+    # interval, just like canto-fetch -f run from cron.
+
     if daemon:
+        refresh = RefreshQueue()
         while 1:
-            run(cfg, verbose, force)
-            time.sleep(updateInterval)
+            run(cfg, verbose, force, jobs, pool, engine, refresh)
+            if force:
+                time.sleep(updateInterval)
+            else:
+                time.sleep(refresh.wait(updateInterval))
             oldcfg = cfg
             try :
                 cfg = get_cfg(conf_file, log_file, feed_dir, script_dir)
-                self.cfg.parse()
+                cfg.parse()
             except:
                 cfg = oldcfg
     else:
-        sys.exit(run(cfg, verbose, force))
+        sys.exit(run(cfg, verbose, force, jobs, pool, engine))
 
-def run(cfg, verbose=False, force=False):
+def run(cfg, verbose=False, force=False, jobs=None, pool=None, engine=None,\
+        refresh=None):
 
     # If we don't explicitly set this, feedparser/urllib will take *forever* to
     # give up on a connection. 30 is a pretty sane default, I think, considering
@@ -158,45 +247,468 @@ def run(cfg, verbose=False, force=False):
 
     socket.setdefaulttimeout(30)
 
+    # Only a bounded number of feeds are in flight at any time. Every feed is
+    # put on the scheduler and fetch_concurrency (or --jobs) workers pull them
+    # off one by one, so the number of threads, sockets and parsed feeds in
+    # memory stays flat no matter how many feeds are configured.
+
+    if not jobs:
+        jobs = cfg.fetch_concurrency
+    if not engine:
+        engine = cfg.fetch_engine
+
+    if pool:
+        ownpool = False
+    else:
+        pool = ConnectionPool(jobs)
+        ownpool = True
+
+    reused, opened = pool.stats()
+
+    work = FetchScheduler(cfg.fetch_host_concurrency, cfg.fetch_host_delay)
     threads = []
+    fetches = []
+
+    if refresh and not force:
+        feeds = refresh.due(cfg.feeds)
+    else:
+        feeds = cfg.feeds
 
     def log_func(x):
         if verbose:
             print x
         cfg.log(x)
 
+    # The ParsePool is forked before any of the workers are started. Its
+    # processes rebuild the FetchThread from the index and finish the update,
+    # and the results are copied back so the daemon knows when the feed is due
+    # and (if it was set from the feed's title) what its tag is. The process
+    # has no Backoff, so whether the feed could be parsed is recorded here, and
+    # new_hook is run here too, with the new items sent back (only if there's
+    # a hook), so it runs in canto-fetch like it does without the pool.
+
+    def parse_work(job):
+        i, force, tags, base_set, raw = job
+        fd = cfg.feeds[i]
+        fd.tags = tags
+        fd.base_set = base_set
+
+        fpath = cfg.feed_dir + fd.URL.replace("/", "_")
+        fetch = FetchThread(cfg, fd, fpath, cfg.script_dir, force, log_func,\
+                None)
+        fetch.finish(fetch.get_curfeed(), raw)
+
+        merged = None
+        if fetch.changed and cfg.new_hook:
+            merged = fetch.merged
+        return (fetch.next, fetch.info, fd.tags, fetch.stats, fetch.changed,
+                fetch.error, merged)
+
+    # A feed that couldn't be parsed wasn't rescheduled, so it keeps the next
+    # and info that run() left it, until failed() puts it off.
+
+    def parse_done(fetch, result):
+        next, info, fetch.fd.tags, stats, fetch.changed, error,\
+                fetch.merged = result
+        if next != None:
+            fetch.next = next
+        if info != None:
+            fetch.info = info
+        for key, value in stats.items():
+            fetch.stats[key] = fetch.stats.get(key, 0) + value
+
+        if error:
+            fetch.failed(error)
+        else:
+            fetch.succeeded()
+        fetch.hook()
+
+    backoff = Backoff(cfg.feed_dir + ".backoff")
+    checks = Checked(cfg.feed_dir + ".checked")
+
+    parser = None
+    if cfg.fetch_processes and feeds:
+        parser = ParsePool(min(cfg.fetch_processes, len(feeds)),\
+                parse_work, parse_done, log_func)
+
     def imdone():
         for thread in threads:
             thread.join()
+        if parser:
+            parser.close()
         socket.setdefaulttimeout(None)
+
+        if refresh:
+            for fetch in fetches:
+                if fetch.next:
+                    refresh.set(fetch.fd.URL, fetch.next, fetch.info)
+
+        backoff.save([ f.URL for f in cfg.feeds ])
+        checks.save([ f.URL for f in cfg.feeds ])
+
+        fetched = dict([ (f.fd.URL, f.stats) for f in fetches\
+                if f.checked and f.stats ])
+        if fetched:
+            fetch_stats.record(cfg.feed_dir + ".stats", fetched,
+                    [ f.URL for f in cfg.feeds ])
+
+        notify.notify(cfg.feed_dir, [ f.fd.URL for f in fetches\
+                if f.changed ], log_func)
+
+        r, o = pool.stats()
+        log_func("Connections: %d reused, %d new." % (r - reused, o - opened))
+        if ownpool:
+            pool.close()
+
         log_func("Gracefully exiting Canto-fetch.")
         return 1
 
-    killme = lambda a, b: imdone() and sys.exit(0)
+    # Anything still queued is dropped, so the workers exit as soon as they're
+    # done with the feed they're currently working on.
+
+    def killme(a, b):
+        work.clear()
+        if parser:
+            parser.kill()
+        imdone()
+        sys.exit(0)
 
     signal.signal(signal.SIGTERM, killme)
     signal.signal(signal.SIGINT, killme)
 
     # The main canto-fetch loop.
-    for fd in cfg.feeds:
+    index = dict([ (id(fd), i) for i, fd in enumerate(cfg.feeds) ])
+    for fd in feeds:
         fpath = cfg.feed_dir + fd.URL.replace("/", "_")
         spath = cfg.script_dir
-        threads.append(FetchThread(cfg, fd, fpath, spath, force, log_func))
-        threads[-1].start()
+        fetches.append(FetchThread(cfg, fd, fpath, spath, force, log_func,\
+                pool))
+        fetches[-1].parser = parser
+        fetches[-1].index = index[id(fd)]
+        fetches[-1].backoff = backoff
+        fetches[-1].checks = checks
+        if refresh:
+            fetches[-1].info = refresh.info.get(fd.URL)
+        work.put(fetches[-1])
+
+    # The thread engine has each worker do the whole update for a feed, the
+    # async engine does all of the downloading (up to jobs downloads at once)
+    # in one event loop and just leaves parsing and writing to a few workers.
+
+    if engine == "async":
+        parse = Queue.Queue()
+
+        for i in xrange(min(PARSE_WORKERS, len(feeds))):
+            threads.append(ParseWorker(parse, work, log_func))
+            threads[-1].start()
+
+        room = lambda : parse.qsize() < jobs
+        done = lambda fetch, response, error:\
+                parse.put((fetch, response, error))
+        fallback = lambda fetch: parse.put((fetch, None, None))
+
+        AsyncEngine(work, jobs, room, done, log_func).run(fallback)
+
+        for thread in threads:
+            parse.put(None)
+    else:
+        for i in xrange(min(jobs, len(feeds))):
+            threads.append(FetchWorker(work, log_func))
+            threads[-1].start()
 
     imdone()
+
+    written[cfg.feed_dir] = written.get(cfg.feed_dir, 0) +\
+            len([ f for f in fetches if f.changed ])
+    if written[cfg.feed_dir] >= PRUNE_WRITES:
+        prune(cfg, log_func)
     return 0
 
-class FetchThread(Thread):
-    def __init__(self, cfg, fd, fpath, spath, force, log_func):
+class FetchWorker(Thread):
+    def __init__(self, work, log_func):
         Thread.__init__(self)
+        self.work = work
+        self.log_func = log_func
+
+    def run(self):
+        while 1:
+            fetch = self.work.get()
+            if not fetch:
+                return
+
+            # An exception in one feed shouldn't take the worker down with it,
+            # or the rest of the queue would be left for the other workers.
+
+            # Once a feed is put back on the scheduler as due, it can be
+            # handed out again before we call done(), so note which stage it
+            # was in now.
+
+            checked = fetch.checked
+
+            try:
+                if checked:
+                    fetch.run()
+                elif fetch.due():
+                    self.work.put_due(fetch)
+            except:
+                self.log_func("Exception updating %s : %s" %\
+                        (fetch.fd.URL, traceback.format_exc()))
+
+            self.work.done(fetch, checked)
+
+# ParseWorkers are the async engine's workers. They're handed feeds that have
+# already been downloaded, or feeds the engine can't download itself, which
+# they fetch as usual.
+
+class ParseWorker(Thread):
+    def __init__(self, parse, work, log_func):
+        Thread.__init__(self)
+        self.parse = parse
+        self.work = work
+        self.log_func = log_func
+
+    def run(self):
+        while 1:
+            item = self.parse.get()
+            if not item:
+                return
+
+            fetch, response, error = item
+            try:
+                if error:
+                    self.log_func("Exception trying to get feed %s : %s" %\
+                            (fetch.fd.URL, error))
+                    fetch.failed(error)
+                elif response:
+                    fetch.run(response)
+                else:
+                    fetch.run()
+            except:
+                self.log_func("Exception updating %s : %s" %\
+                        (fetch.fd.URL, traceback.format_exc()))
+
+            # Feeds the engine couldn't download held on to their host until
+            # now.
+
+            if not (response or error):
+                self.work.done(fetch, True)
+
+# The FetchScheduler hands out work in two stages. Feeds are first checked to
+# see if they're due for an update, which doesn't touch the network, so that's
+# done as soon as a worker is free. Feeds that are due are then queued up by
+# host, and only handed out when their host has less than host_limit requests
+# in flight and at least host_delay seconds have passed since the last request
+# to it was started. Workers skip over busy hosts, so the global concurrency is
+# still used up by feeds on other hosts, rather than hammering one aggregator
+# with every feed at once and getting throttled for it.
+
+class FetchScheduler():
+    def __init__(self, host_limit, host_delay):
+        self.cond = Condition()
+        self.host_limit = host_limit
+        self.host_delay = host_delay
+
+        self.unchecked = []
+        self.checking = 0
+
+        # Due feeds, by host. Hosts is the round-robin order.
+        self.hosts = []
+        self.waiting = {}
+
+        self.active = {}
+        self.next_start = {}
+
+    def host(self, fetch):
+        # Scripts don't have a host to be polite to.
+        if fetch.fd.URL.startswith("script:"):
+            return None
+        return urlparse.urlparse(fetch.fd.URL)[1].lower()
+
+    def put(self, fetch):
+        self.cond.acquire()
+        fetch.checked = False
+        self.unchecked.append(fetch)
+        self.cond.notify()
+        self.cond.release()
+
+    def put_due(self, fetch):
+        self.cond.acquire()
+        host = self.host(fetch)
+        if host not in self.waiting:
+            self.hosts.append(host)
+            self.waiting[host] = []
+        self.waiting[host].append(fetch)
+        self.cond.notify()
+        self.cond.release()
+
+    # get returns the next feed to work on, or None if there's nothing left.
+    # If block isn't set, None is also returned when there's nothing that can
+    # be worked on right now.
+
+    def get(self, block=True):
+        self.cond.acquire()
+        try:
+            while 1:
+                now = time.time()
+                timeout = None
+
+                for host in self.hosts:
+                    if host != None:
+                        if self.active.get(host, 0) >= self.host_limit:
+                            continue
+                        start = self.next_start.get(host, 0)
+                        if start > now:
+                            if timeout == None or start - now < timeout:
+                                timeout = start - now
+                            continue
+
+                    fetch = self.waiting[host].pop(0)
+                    self.hosts.remove(host)
+                    if self.waiting[host]:
+                        self.hosts.append(host)
+                    else:
+                        del self.waiting[host]
+
+                    self.active[host] = self.active.get(host, 0) + 1
+                    self.next_start[host] = now + self.host_delay
+                    fetch.checked = True
+                    return fetch
+
+                if self.unchecked:
+                    self.checking += 1
+                    return self.unchecked.pop(0)
+
+                # Nothing left to do, and nothing being checked that could
+                # still turn into more work.
+
+                if not block or (not self.hosts and not self.checking):
+                    return None
+
+                self.cond.wait(timeout)
+        finally:
+            self.cond.release()
+
+    def done(self, fetch, checked):
+        self.cond.acquire()
+        if checked:
+            self.active[self.host(fetch)] -= 1
+        else:
+            self.checking -= 1
+        self.cond.notifyAll()
+        self.cond.release()
+
+    def finished(self):
+        self.cond.acquire()
+        try:
+            return not (self.unchecked or self.hosts or self.checking or\
+                    [h for h in self.active if self.active[h]])
+        finally:
+            self.cond.release()
+
+    def clear(self):
+        self.cond.acquire()
+        self.unchecked = []
+        self.hosts = []
+        self.waiting = {}
+        self.cond.notifyAll()
+        self.cond.release()
+
+# The RefreshQueue is the daemon's priority queue of when each feed is next due.
+# Feeds that have never been checked (i.e. on the first run, or when they've
+# just been added to the config) are always due.
+#
+# It also keeps what the daemon needs to know about each feed without loading
+# it from disk (see FetchThread.remember), so that deciding whether a due feed
+# actually needs fetching, and with which validators, doesn't cost a read.
+# Canto-fetch is the only thing that changes these, so they can only be out of
+# date if another canto-fetch updated the feed in the meantime, and then the
+# worst that can happen is an unnecessary fetch.
+
+class RefreshQueue():
+    def __init__(self):
+        self.heap = []
+        self.next = {}
+        self.info = {}
+
+    def set(self, URL, when, info=None):
+        self.next[URL] = when
+        if info:
+            self.info[URL] = info
+        heapq.heappush(self.heap, (when, URL))
+
+    def due(self, feeds):
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            when, URL = heapq.heappop(self.heap)
+
+            # Feeds are rescheduled by pushing them again, so skip any
+            # outdated entries.
+
+            if self.next.get(URL) == when:
+                del self.next[URL]
+
+        return [ fd for fd in feeds if fd.URL not in self.next ]
+
+    # wait returns how long to sleep until the next feed is due, but not
+    # longer than limit.
+
+    def wait(self, limit):
+        while self.heap and self.next.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return limit
+        return max(min(self.heap[0][0] - time.time(), limit), 1)
+
+# FetchThread is no longer a thread of its own (the name is historical), it's a
+# unit of work that's run by a FetchWorker.
+
+class FetchThread():
+    def __init__(self, cfg, fd, fpath, spath, force, log_func, pool):
         self.fd = fd
+        self.pool = pool
         self.fpath = fpath
         self.spath = spath
         self.force = force
         self.cfg = cfg
         self.log_func = log_func
         self.prevtime = 0
+        self.checked = False
+
+        # Whether new content was written, so clients can be told.
+        self.changed = False
+
+        # What the last update did to the entries, for the change log.
+        self.delta = None
+
+        # When the feed should next be fetched, once we know, and the fields
+        # of the feed that were used to decide that.
+        self.next = None
+        self.info = None
+
+        # The ParsePool to hand downloaded feeds to, if any, and this feed's
+        # index in cfg.feeds, which is how the pool's processes find it.
+        self.parser = None
+        self.index = None
+
+        # The merged feed and its new items, for new_hook (see hook).
+        self.merged = None
+
+        # Where the time went, and how much came down, for fetch_stats.
+        self.stats = {}
+
+        # The Backoff tracking failures, if any, and the host it knows this
+        # feed by (scripts don't have one).
+        self.backoff = None
+        if fd.URL.startswith("script:"):
+            self.host = None
+        else:
+            self.host = urlparse.urlparse(fd.URL)[1].lower()
+
+        # The Checked recording when unchanged feeds were checked, if any.
+        self.checks = None
+
+        # Why what was downloaded couldn't be parsed, if it couldn't.
+        self.error = None
 
         # This emptyfeed forms a skeleton for any canto feed.
         # Canto_state is a place holder. Canto_update is the
@@ -211,24 +723,19 @@ class FetchThread(Thread):
 
     # get_curfeed loads the old feed data from disk. It blocks getting the lock,
     # so it could take awhile, but should never fail if the information isn't
-    # corrupted.
+    # corrupted. The old items are only ever written back out, so their long
+    # texts stay in the blob store (see storage.py). We're the only one that
+    # upgrades old feeds, the client just reads them.
 
     def get_curfeed(self):
         curfeed = self.emptyfeed
-        if os.path.exists(self.fpath):
-            if os.path.isfile(self.fpath):
-                f = open(self.fpath, "r")
-                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
-
-                self.prevtime = os.stat(self.fpath).st_mtime
-
-                try:
-                    curfeed = cPickle.load(f)
-                except:
-                    self.log_func("cPickle load exception on %s" % self.fpath)
-                finally:
-                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                    f.close()
+        if self.cfg.store.exists(self.fpath):
+            try:
+                curfeed, self.prevtime = self.cfg.store.load(self.fpath,\
+                        True, self.timed, False, True)
+            except:
+                self.log_func("Exception loading %s : %s" %\
+                        (self.fpath, sys.exc_info()[1]))
         else:
 
             # The file doesn't exist yet, so we write a stub so that Canto
@@ -244,29 +751,472 @@ class FetchThread(Thread):
                 }
 
             curfeed["entries"].append(d)
-            f = open(self.fpath, "w")
             try:
-                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-                cPickle.dump(curfeed, f)
-                f.flush()
+                self.cfg.store.create(self.fpath, curfeed)
             except:
                 pass
+
+        return curfeed
+
+    # headers returns the HTTP headers to send with the request for the feed.
+
+    def headers(self, curfeed):
+        headers = { 'User-Agent' :\
+            "Canto/%d.%d.%d + http://codezen.org/canto" % VERSION_TUPLE }
+
+        # Feeds compress very well, and feedparser knows how to decompress
+        # them.
+
+        headers['Accept-Encoding'] = "gzip, deflate"
+
+        # Conditional GET. If the server gave us validators last time, hand
+        # them back so it can skip sending a feed we already have.
+
+        if curfeed.get("canto_etag"):
+            headers['If-None-Match'] = curfeed["canto_etag"]
+        if curfeed.get("canto_modified"):
+            headers['If-Modified-Since'] = curfeed["canto_modified"]
+
+        return headers
+
+    # fetch returns what was downloaded for the feed (see read), or None if the
+    # server told us that nothing has changed since the last time we fetched
+    # it (304).
+
+    def fetch(self, curfeed):
+        # Feed from script
+        if self.fd.URL.startswith("script:"):
+            path, digest = self.script(self.spath + "/" + self.fd.URL[7:])
+            return (path, digest, None, None, 200, "")
+
+        # Feed from URL
+        request = urllib2.Request(self.fd.URL)
+        for header, value in self.headers(curfeed).items():
+            request.add_header(header, value)
+
+        try:
+            # Feed from URL w/ password
+            if self.fd.username or self.fd.password:
+                mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
+                domain = urlparse.urlparse(self.fd.URL)[1]
+                mgr.add_password(None, domain,\
+                        self.fd.username, self.fd.password)
+
+                # First, we try Basic Authentication
+                auth = urllib2.HTTPBasicAuthHandler(mgr)
+                opener = urllib2.build_opener(auth, *self.pool.handlers())
+                try:
+                    return self.read(opener.open(request))
+                except urllib2.HTTPError, e:
+                    if e.code == 304:
+                        raise
+
+                    # The error holds on to its connection until it's closed.
+                    if e.fp:
+                        e.fp.close()
+
+                # And, failing that, try Digest Authentication
+                auth = urllib2.HTTPDigestAuthHandler(mgr)
+                opener = urllib2.build_opener(auth, *self.pool.handlers())
+                return self.read(opener.open(request))
+            # Feed with no password.
+            else:
+                opener = urllib2.build_opener(*self.pool.handlers())
+                return self.read(opener.open(request))
+
+        # urllib2 treats 304 Not Modified like any other HTTP error. Either
+        # way, the response is done with, so its connection can go back to the
+        # pool.
+        except urllib2.HTTPError, e:
+            self.stats.update(getattr(e.fp, "timing", {}))
+            if e.fp:
+                e.fp.close()
+            if e.code == 304:
+                return None
+            raise
+
+    # read takes the whole response off the wire. What's downloaded is kept as
+    # a plain (path, digest, headers, url, status, msg) tuple, so that it can be
+    # handed to a ParsePool process. Headers and url are None for script output.
+
+    # The async engine's responses haven't been through urllib2, so HTTP errors
+    # are sorted out here too.
+
+    def read(self, response):
+        self.stats.update(getattr(response, "timing", {}))
+        status = getattr(response, "code", 200)
+        if status == 304:
+            return None
+        if status >= 400:
+            raise urllib2.HTTPError(self.fd.URL, status,
+                    response.msg, response.headers, None)
+        path, digest = self.spool(response,
+                response.info().getheader("content-encoding"))
+        return (path, digest, "".join(response.info().headers),
+                response.geturl(), status, response.msg)
+
+    # spool writes the body out to a temporary file as it comes in, rather
+    # than holding it in memory, since feeds can run to several megabytes. The
+    # digest identifies the body, so we can tell when the same feed was sent
+    # again. If the body was compressed, it's decompressed along the way (only
+    # to count how much compression saved and to digest it, feedparser does
+    # the real thing), because gzip puts a timestamp in its header, so the
+    # same feed compressed twice isn't the same bytes.
+
+    def spool(self, f, encoding=None):
+        decompressor = None
+        if encoding:
+            encoding = encoding.strip().lower()
+        if encoding == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        fd, path = tempfile.mkstemp(prefix="canto-fetch-")
+        out = os.fdopen(fd, "wb")
+        digest = hashlib.sha1()
+        decoded_digest = hashlib.sha1()
+        start = time.time()
+        size = 0
+        decoded = 0
+        try:
+            try:
+                while 1:
+                    data = f.read(SPOOL_CHUNK)
+                    if not data:
+                        break
+                    digest.update(data)
+                    out.write(data)
+                    size += len(data)
+
+                    if decompressor:
+                        try:
+                            data = decompressor.decompress(data)
+                            decoded_digest.update(data)
+                            decoded += len(data)
+                        except zlib.error:
+                            decompressor = None
+                    else:
+                        decoded += len(data)
+            finally:
+                out.close()
+        except:
+            os.unlink(path)
+            raise
+        self.timed("download", start)
+        self.stats["bytes"] = size
+        self.stats["decoded"] = decoded
+        if decompressor:
+            digest = decoded_digest
+        return (path, digest.hexdigest())
+
+    # failed notes that the feed couldn't be fetched, so it's not tried again
+    # until its backoff is over. Only a socket error (including a timeout) that
+    # urllib2 raised before there was any response, or the async engine's
+    # equivalent, counts against the host (connect is True). Anything else,
+    # like an HTTP error, a broken response or a feed that couldn't be parsed,
+    # means the host is up. Servers that are overloaded or rate limiting us may
+    # tell us when to come back.
+
+    def failed(self, e):
+        if not self.backoff:
+            return
+
+        retry = None
+        connect = False
+        if isinstance(e, urllib2.HTTPError):
+            if e.code in [429, 503] and e.hdrs:
+                retry = fetch_backoff.retry_after(e.hdrs.get("retry-after"))
+        elif isinstance(e, urllib2.URLError):
+            connect = isinstance(e.reason, socket.error)
+        elif isinstance(e, DownloadError):
+            connect = e.connect
+
+        self.next = self.backoff.failed(self.fd.URL, self.host, self.fd.rate,
+                retry, connect)
+        self.log_func("Not trying %s again until %s" %\
+                (self.fd.URL, time.ctime(self.next)))
+
+    # parse_failed notes that what was downloaded couldn't be used. In a
+    # ParsePool process there's no Backoff, so the error is also kept for
+    # canto-fetch to record when the result comes back.
+
+    def parse_failed(self, e):
+        self.error = str(e)
+        self.failed(e)
+
+    # succeeded clears the feed's backoff, once it's been updated (or found to
+    # be unchanged).
+
+    def succeeded(self):
+        if self.backoff:
+            self.backoff.succeeded(self.fd.URL, self.host)
+
+    # script runs a script feed, with its output (stdout and stderr, as always)
+    # going straight into a spool file. The script gets its own process group,
+    # so that if it runs longer than fetch_script_timeout, it can be killed
+    # along with anything it started, rather than holding up the update.
+
+    def script(self, command):
+        fd, path = tempfile.mkstemp(prefix="canto-fetch-")
+        out = os.fdopen(fd, "wb")
+        try:
+            start = time.time()
+            try:
+                null = open(os.devnull, "r")
+                try:
+                    proc = subprocess.Popen(command, shell=True, stdin=null,
+                            stdout=out, stderr=subprocess.STDOUT,
+                            close_fds=True, preexec_fn=os.setsid)
+                finally:
+                    null.close()
+
+                timeout = self.cfg.fetch_script_timeout
+                while proc.poll() == None:
+                    if timeout and time.time() - start > timeout:
+                        try:
+                            os.killpg(proc.pid, signal.SIGKILL)
+                        except OSError:
+                            pass
+                        proc.wait()
+                        raise Exception("%s timed out after %s seconds" %\
+                                (command, timeout))
+                    time.sleep(0.05)
+            finally:
+                out.close()
+            self.timed("download", start)
+
+            if proc.returncode:
+                self.log_func("%s exited with status %d" %\
+                        (command, proc.returncode))
+
+            digest = hashlib.sha1()
+            f = open(path, "rb")
+            try:
+                while 1:
+                    data = f.read(SPOOL_CHUNK)
+                    if not data:
+                        break
+                    digest.update(data)
             finally:
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                self.stats["bytes"] = self.stats["decoded"] = f.tell()
                 f.close()
+        except:
+            os.unlink(path)
+            raise
+        return (path, digest.hexdigest())
 
-        return curfeed
+    # timed adds the time since start to one of the stats (see fetch_stats).
 
-    def run(self):
-        curfeed = self.get_curfeed()
+    def timed(self, key, start):
+        self.stats[key] = self.stats.get(key, 0) + time.time() - start
+
+    # parse turns what was downloaded back into something that looks enough
+    # like the original response for feedparser, and parses it. The spooled
+    # body is only read a chunk at a time by feedparser, and removed after.
+
+    def parse(self, raw):
+        path, digest, headers, url, status, msg = raw
+        body = open(path, "rb")
+        try:
+            if headers == None:
+                return feedparser.parse(body)
+
+            response = urllib.addinfourl(body,
+                    httplib.HTTPMessage(StringIO(headers + "\r\n")), url)
+            response.seek = body.seek
+            response.status = status
+            response.code = status
+            response.msg = msg
+            return feedparser.parse(response)
+        finally:
+            body.close()
+            os.unlink(path)
+
+    # write dumps the result of update(curfeed) to disk. The store only
+    # replaces the feed if it's still the one we read (see storage.py). If the
+    # client changed it in the meantime, curfeed is reread and update is called
+    # again so the client's state changes aren't lost. If update returns None,
+    # nothing is written.
+
+    # write returns whether it actually wrote the feed out.
+
+    def write(self, curfeed, update):
+        while 1:
+            start = time.time()
+            newfeed = update(curfeed)
+            self.timed("merge", start)
+            if newfeed == None:
+                return False
+
+            seq = curfeed.get("canto_seq", 0)
+            newfeed["canto_seq"] = seq + 1
+
+            # The pickle store calls log while it still has the feed locked,
+            # so records go in in order. The SQLite store calls it once the
+            # write is committed, and a record that goes in out of order
+            # breaks the chain (see changelog.follow). Either way, a client
+            # that can't follow the log, or sees the new feed before the log,
+            # just reloads it.
+
+            log = lambda mtime: changelog.append(self.fpath,\
+                    (seq, seq + 1, mtime, self.delta))
+
+            try:
+                written = self.cfg.store.write(self.fpath, newfeed,\
+                        self.prevtime, log, self.timed)
+            except:
+                self.log_func("Exception writing %s : %s" %\
+                        (self.fpath, sys.exc_info()[1]))
+                return False
+
+            # The feed was modified out from under us.
+            if written == None:
+                # Reread the state from disk.
+                newer_curfeed = self.get_curfeed()
+
+                # There was an actual c-f update done, bail. Every one of
+                # those bumps canto_seq, the client never touches it.
+
+                if newer_curfeed.get("canto_seq", 0) !=\
+                        curfeed.get("canto_seq", 0) or\
+                        newer_curfeed["canto_update"] != curfeed["canto_update"]:
+                    self.log_func("%s updated already, bailing" %
+                            self.fd.tags[0])
+                    self.remember(newer_curfeed)
+                    return False
+
+                # Just a state modification by the client, update and continue.
+                else:
+                    curfeed = newer_curfeed
+                    continue
+
+            # If we managed to write to disk, we're done.
+
+            self.remember(newfeed)
+            return True
+
+    # remember keeps the fields needed to schedule the feed and to make a
+    # conditional request for it, so the daemon doesn't have to load the feed
+    # again to find out when it's due. If the feed has been checked and found
+    # unchanged since it was written, those times win.
+
+    def remember(self, feed):
+        self.info = {}
+        for key in ["canto_update", "canto_next", "canto_etag",
+                "canto_modified"]:
+            if key in feed:
+                self.info[key] = feed[key]
+
+        checked = self.checks and self.checks.get(self.fd.URL)
+        if checked and checked[0] > self.info["canto_update"]:
+            self.info["canto_update"], self.info["canto_next"] = checked
+
+        self.next = max(self.info["canto_update"] + self.fd.rate * 60,
+                self.info.get("canto_next", 0))
+
+    # Determine whether it's been long enough between
+    # updates to warrant refetching the feed. The rate is
+    # always respected, even if it was changed since
+    # canto_next was set.
+
+    def due(self):
+        if self.force:
+            return True
+
+        if self.info:
+            self.remember(self.info)
+        else:
+            self.remember(self.get_curfeed())
+
+        # A feed that keeps failing isn't due until its backoff is over.
+        if self.backoff:
+            self.next = max(self.next,
+                    self.backoff.until(self.fd.URL, self.host))
+
+        return time.time() >= self.next
+
+    # schedule sets canto_next, the time the feed should next be fetched. The
+    # user's rate is the lower bound and fetch_max_rate the upper bound. In
+    # between, it depends on how often the feed has actually published new
+    # items, and on any hints the feed gives about how often it changes (RSS
+    # ttl and the syndication module's updatePeriod / updateFrequency). If the
+    # time lands in one of the feed's skipHours, it's put off until the hours
+    # are over.
+
+    def schedule(self, feed):
+        now = time.time()
+        interval = self.fd.rate * 60
+
+        if self.cfg.fetch_max_rate:
+            # Posts are usually irregular, so check about twice as often as the
+            # average time between the most recent ones.
+
+            stamps = []
+            for entry in feed["entries"]:
+                for key in ["updated_parsed", "published_parsed"]:
+                    if entry.get(key):
+                        stamps.append(calendar.timegm(entry[key]))
+                        break
+
+            stamps = dict.fromkeys(stamps).keys()
+            stamps.sort()
+            stamps = stamps[-10:]
+            if len(stamps) > 1:
+                interval = max(interval,
+                        (stamps[-1] - stamps[0]) / (len(stamps) - 1) / 2)
+
+            info = feed.get("feed", {})
+            try:
+                interval = max(interval, int(info.get("ttl", 0)) * 60)
+            except ValueError:
+                pass
+
+            periods = { "hourly" : 3600, "daily" : 86400, "weekly" : 604800,
+                    "monthly" : 2592000, "yearly" : 31536000 }
+            period = info.get("sy_updateperiod", "").strip().lower()
+            if period in periods:
+                try:
+                    frequency = int(info.get("sy_updatefrequency", 1))
+                except ValueError:
+                    frequency = 1
+                interval = max(interval, periods[period] / max(frequency, 1))
+
+            interval = min(interval,
+                    max(self.cfg.fetch_max_rate, self.fd.rate) * 60)
 
-        # Determine whether it's been long enough between
-        # updates to warrant refetching the feed.
+        next = now + interval
 
-        if time.time() - curfeed["canto_update"] < self.fd.rate * 60 and\
-                not self.force:
+        skip = feed.get("feed", {}).get("skiphours", [])
+        if skip:
+            for i in xrange(24):
+                if time.gmtime(next)[3] not in skip:
+                    break
+                next = next - (next % 3600) + 3600
+
+        feed["canto_next"] = next
+        return feed
+
+    # run is only called by the FetchScheduler if due() returned True. If the
+    # feed has already been downloaded, the response is passed in.
+
+    def run(self, response=None):
+        # Only count the time spent on the update itself, not checking whether
+        # it was due.
+        self.stats = {}
+
+        # If the feed's host went down since the feed was queued, don't bother.
+        if self.backoff and not self.force and\
+                self.backoff.host_down(self.host):
+            self.log_func("Skipping %s, %s is down" % (self.fd.URL, self.host))
+            self.next = self.backoff.until(self.fd.URL, self.host)
             return
 
+        curfeed = self.get_curfeed()
+
+        # If we can't get the feed this time, try again after the rate.
+        self.next = time.time() + self.fd.rate * 60
+
         # Attempt to set the tag, if unspecified, by grabbing
         # it out of the previously downloaded info.
 
@@ -284,42 +1234,13 @@ class FetchThread(Thread):
         else:
             self.log_func("Updating %s" % self.fd.tags[0])
 
-        # This block set newfeed to a parsed feed.
+        # This block sets raw to the downloaded feed.
 
         try:
-            # Feed from script
-            if self.fd.URL.startswith("script:"):
-                script = self.spath + "/" + self.fd.URL[7:]
-                out = commands.getoutput(script)
-                newfeed = feedparser.parse(out)
-            # Feed from URL
+            if response:
+                raw = self.read(response)
             else:
-                request = urllib2.Request(self.fd.URL)
-                request.add_header('User-Agent',\
-                    "Canto/%d.%d.%d + http://codezen.org/canto" %\
-                    VERSION_TUPLE)
-
-                # Feed from URL w/ password
-                if self.fd.username or self.fd.password:
-                    mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                    domain = urlparse.urlparse(self.fd.URL)[1]
-                    mgr.add_password(None, domain,\
-                            self.fd.username, self.fd.password)
-
-                    # First, we try Basic Authentication
-                    auth = urllib2.HTTPBasicAuthHandler(mgr)
-                    opener = urllib2.build_opener(auth)
-                    try:
-                        newfeed = feedparser.parse(opener.open(request))
-                    except:
-                        # And, failing that, try Digest Authentication
-                        auth = urllib2.HTTPDigestAuthHandler(mgr)
-                        opener = urllib2.build_opener(auth)
-                        newfeed = feedparser.parse(opener.open(request))
-                # Feed with no password.
-                else:
-                    newfeed = feedparser.parse(\
-                            feedparser.urllib2.urlopen(request))
+                raw = self.fetch(curfeed)
         except:
             # Generally an exception is a connection refusal, but in any
             # case we either won't get data or can't trust the data, so
@@ -329,8 +1250,62 @@ class FetchThread(Thread):
             self.log_func("Exception trying to get feed %s : %s" % \
                     (self.fd.URL.encode(enc, "ignore"), sys.exc_info()[1]))
 
+            self.failed(sys.exc_info()[1])
+            return
+
+        # Plenty of servers don't support conditional GET, but send exactly the
+        # same feed every time. If what we got is what we got last time, it's
+        # treated just like a 304.
+
+        if raw and curfeed.get("canto_digest") == raw[1]:
+            os.unlink(raw[0])
+            raw = None
+
+        # Leave the rest to the ParsePool, if there is one. Its process will
+        # load curfeed for itself.
+
+        if raw and self.parser:
+            self.parser.submit(self, (self.index, self.force, self.fd.tags,
+                self.fd.base_set, raw))
             return
 
+        self.finish(curfeed, raw)
+        self.hook()
+
+    # finish is the CPU bound half of run, parsing the feed and merging it into
+    # what's on disk.
+
+    def finish(self, curfeed, raw):
+        # The server says the feed hasn't changed, so there's nothing to parse
+        # or merge. All that's left is to note that we checked, so we don't
+        # check again until the rate is up. That's kept apart from the feed
+        # (see fetch_checked.py), so the feed isn't written at all.
+
+        if raw == None:
+            self.log_func("%s unchanged" % self.fd.tags[0])
+
+            feed = curfeed.copy()
+            feed["canto_update"] = time.time()
+            self.schedule(feed)
+
+            if self.checks:
+                self.checks.set(self.fd.URL, feed["canto_update"],
+                        feed["canto_next"])
+            self.remember(feed)
+            self.succeeded()
+            return
+
+        start = time.time()
+        try:
+            newfeed = self.parse(raw)
+        except:
+            enc = locale.getpreferredencoding()
+            self.log_func("Exception parsing feed %s : %s" % \
+                    (self.fd.URL.encode(enc, "ignore"), sys.exc_info()[1]))
+            self.parse_failed(sys.exc_info()[1])
+            return
+        self.timed("parse", start)
+
         # I don't know why feedparser doesn't actually throw this
         # since all URLErrors are basically unrecoverable.
 
@@ -339,17 +1314,16 @@ class FetchThread(Thread):
                 self.log_func(\
                     "Feedparser exception getting %s : %s, bailing." %\
                     (self.fd.URL, newfeed["bozo_exception"].reason))
+                self.parse_failed(newfeed["bozo_exception"].reason)
                 return
             if not len(newfeed["entries"]):
                 self.log_func(\
                     "Feedparser exception, no content in %s : %s, bailing." %\
                     (self.fd.URL, newfeed["bozo_exception"]))
+                self.parse_failed(newfeed["bozo_exception"])
                 return
 
-        # Filter out "No Content" message since we apparently have real content
-
-        curfeed["entries"] = [ x for x in curfeed["entries"] if x["id"] !=\
-                "canto-internal"]
+        self.succeeded()
 
         # For new feeds whose base tag is still not set, attempt to get a title
         # again.
@@ -384,6 +1358,19 @@ class FetchThread(Thread):
         newfeed["canto_state"] = curfeed["canto_state"]
         newfeed["canto_update"] = time.time()
 
+        # Keep the validators, if any, for the next conditional GET. The
+        # modified time is kept as the server sent it, so we can just echo it
+        # back.
+
+        if newfeed.get("etag"):
+            newfeed["canto_etag"] = newfeed["etag"]
+        if newfeed.get("headers", {}).get("last-modified"):
+            newfeed["canto_modified"] = newfeed["headers"]["last-modified"]
+
+        # And the digest, in case the server doesn't do conditional GET.
+
+        newfeed["canto_digest"] = raw[1]
+
         # We can set this here, without checking curfeed.
         # Any migration should be done in the get_curfeed function,
         # when the old data is first loaded.
@@ -395,6 +1382,7 @@ class FetchThread(Thread):
         # which is escaped in the reader when it is displayed. This is to
         # prevent sending garbeled links to the exteranl browser.
 
+        start = time.time()
         for key in newfeed["feed"]:
             if type(newfeed["feed"][key]) in [unicode,str]:
                 newfeed["feed"][key] = utility.stripchars(newfeed["feed"][key])
@@ -423,23 +1411,37 @@ class FetchThread(Thread):
                 else:
                     entry["id"] = None
 
-        # Then search through the current feed to
-        # make item state persistent, and loop until
-        # it's safe to update on disk.
+        self.timed("normalize", start)
 
-        new = []
-        while 1:
-            for entry in newfeed["entries"]:
-                for centry in curfeed["entries"]:
-                    if entry["id"] == centry["id"]:
-                        entry["canto_state"] = centry["canto_state"]
-                        
-                        # The entry is removed so that later it's
-                        # not a candidate for being appended to the
-                        # end of the feed.
-
-                        curfeed["entries"].remove(centry)
-                        break
+        # Then search through the current feed to
+        # make item state persistent. The merge is redone
+        # by write() until it's safe to update on disk, so
+        # each time it starts over from a copy of what was
+        # parsed and leaves curfeed alone.
+
+        def merge(curfeed):
+            feed = copy_feed(newfeed)
+
+            # Filter out "No Content" message since we apparently have real
+            # content.
+
+            current = [ x for x in curfeed["entries"] if x["id"] !=\
+                    "canto-internal"]
+
+            # Index the current entries by id. If more than one entry has the
+            # same id, they're matched up in order.
+
+            index = {}
+            for i, centry in enumerate(current):
+                index.setdefault(centry["id"], []).append(i)
+
+            matched = {}
+            new = []
+            for entry in feed["entries"]:
+                if index.get(entry["id"]):
+                    i = index[entry["id"]].pop(0)
+                    entry["canto_state"] = list(current[i]["canto_state"])
+                    matched[i] = True
                 else:
                     new.append(entry)
 
@@ -447,6 +1449,12 @@ class FetchThread(Thread):
                 if "canto_state" not in entry:
                     entry["canto_state"] = self.fd.tags + [u"*"]
 
+            # Matched entries are removed so that later they're
+            # not candidates for being appended to the end of
+            # the feed.
+
+            current = [ e for i, e in enumerate(current) if i not in matched ]
+
             # Tailor the list to the correct number of items. In canto < 0.7.0,
             # you could specify a keep that was lower than the number of items
             # in the feed. This was simply done, but ultimately it caused too
@@ -460,76 +1468,58 @@ class FetchThread(Thread):
             # and put back into the feed (and the item isn't in the extra kept
             # items), but then it becomes a site problem, not a reader problem.
 
-            if self.fd.keep and len(newfeed["entries"]) < self.fd.keep:
-                newfeed["entries"] += curfeed["entries"]\
-                        [:self.fd.keep - len(newfeed["entries"])]
+            if self.fd.keep and len(feed["entries"]) < self.fd.keep:
+                feed["entries"] += current[:self.fd.keep - len(feed["entries"])]
 
             # Enforce the "never_discard" setting
             # We iterate through the stories and then the tag so that
-            # feed order is preserved.
+            # feed order is preserved. Only entries with the same
+            # id can be equal, so those are the only ones that have
+            # to be compared.
+
+            kept = {}
+            for e in feed["entries"]:
+                kept.setdefault(e["id"], []).append(e)
 
-            for e in curfeed["entries"]:
+            for e in current:
                 for tag in self.cfg.never_discard:
                     if tag == "unread":
                         if "read" in e["canto_state"]:
                             continue
                     elif tag not in e["canto_state"]:
                         continue
-                    if e not in newfeed["entries"]:
-                        newfeed["entries"].append(e)
-
-            if self.cfg.new_hook:
-                for entry in [e for e in new if e in newfeed["entries"]]:
-                    self.cfg.new_hook(newfeed, entry, entry == new[-1])
-
-            # Dump the output to the new file.
-
-            # Locking and writing is counter-intuitive using fcntl. If you open
-            # with "w" and fail to get the lock, the data is still deleted. The
-            # solution is to open with "a", get the lock and then truncate the
-            # file.
-
-            f = open(self.fpath, "a")
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-
-            # The feed was modified out from under us.
-            if self.prevtime and self.prevtime != os.stat(self.fpath).st_mtime:
-                # Unlock.
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
-
-                # Reread the state from disk.
-                newer_curfeed = self.get_curfeed()
-
-                # There was an actual c-f update done, bail.
-                if newer_curfeed["canto_update"] != curfeed["canto_update"]:
-                    self.log_func("%s updated already, bailing" %
-                            self.fd.tags[0])
-                    break
-
-                # Just a state modification by the client, update and continue.
+                    if e not in kept.get(e["id"], []):
+                        feed["entries"].append(e)
+                        kept.setdefault(e["id"], []).append(e)
+
+            self.merged = (feed, new)
+            self.stats["entries"] = len(feed["entries"])
+            self.stats["new"] = len(new)
+
+            # Only new items go in the change log, the client already has the
+            # rest. Their long texts are blobs, just like in the feed.
+
+            isnew = dict([ (id(e), True) for e in new ])
+            self.delta = []
+            for e in feed["entries"]:
+                if id(e) in isnew:
+                    self.delta.append((e["id"], e["canto_state"],
+                        self.cfg.store.refer(e)))
                 else:
-                    curfeed = newer_curfeed
-                    continue
+                    self.delta.append((e["id"], e["canto_state"], None))
 
-            # Truncate the file
-            f.seek(0, 0)
-            f.truncate()
+            return self.schedule(feed)
 
-            try:
-                # Dump the feed item. It's important to flush afterwards to
-                # avoid unlocking the file before all the IO is finished.
-                cPickle.dump(newfeed, f)
-                f.flush()
-            except:
-                self.log_func("cPickle dump exception on %s" % self.fpath)
-            finally:
-                # Unlock.
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
+        self.changed = self.write(curfeed, merge)
 
-            # If we managed to write to disk, break out of the while loop and
-            # the thread will exit.
+    # hook hands every new item in the merged feed to new_hook. It's only
+    # called once the feed has been written, so each of them is only seen
+    # once, and always in canto-fetch itself, not in a ParsePool process.
 
-            break
+    def hook(self):
+        if not (self.changed and self.merged and self.cfg.new_hook):
+            return
 
+        feed, new = self.merged
+        for i, entry in enumerate(new):
+            self.cfg.new_hook(feed, entry, i == len(new) - 1)
@@ -23,9 +23,11 @@ import triggers
 import gui
 import sorts
 import sources
+import fetch
+import storage
 
 handlers = [tags, feeds, keys, style,\
-        links, hooks, filters, triggers, gui, sorts, sources]
+        links, hooks, filters, triggers, gui, sorts, sources, fetch, storage]
 
 import xml.parsers.expat
 import traceback
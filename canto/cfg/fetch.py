@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# These settings are only used by canto-fetch. Canto-fetch never calls
+# validate() (it has no use for the interface settings), so the settings are
+# checked in post_parse instead.
+
+import os
+
+# By default, canto-fetch parses with one process per CPU.
+
+def cpus():
+    try:
+        return max(int(os.sysconf("SC_NPROCESSORS_ONLN")), 1)
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+def register(c):
+    c.fetch_concurrency = 16
+    c.fetch_host_concurrency = 2
+    c.fetch_host_delay = 0.25
+    c.fetch_engine = "thread"
+    c.fetch_max_rate = 1440
+    c.fetch_processes = cpus()
+    c.fetch_script_timeout = 60
+
+    c.locals.update({
+        "fetch_concurrency" : c.fetch_concurrency,
+        "fetch_host_concurrency" : c.fetch_host_concurrency,
+        "fetch_host_delay" : c.fetch_host_delay,
+        "fetch_engine" : c.fetch_engine,
+        "fetch_max_rate" : c.fetch_max_rate,
+        "fetch_processes" : c.fetch_processes,
+        "fetch_script_timeout" : c.fetch_script_timeout})
+
+def post_parse(c):
+    for attr in ["fetch_concurrency", "fetch_host_concurrency",
+            "fetch_host_delay", "fetch_engine", "fetch_max_rate",
+            "fetch_processes", "fetch_script_timeout"]:
+        setattr(c, attr, c.locals[attr])
+
+    for attr in ["fetch_concurrency", "fetch_host_concurrency"]:
+        if type(getattr(c, attr)) != int or getattr(c, attr) < 1:
+            raise Exception, "%s must be an integer >= 1 (%s)" %\
+                    (attr, getattr(c, attr))
+
+    if type(c.fetch_host_delay) not in [int, float] or c.fetch_host_delay < 0:
+        raise Exception, "fetch_host_delay must be a number >= 0 (%s)" %\
+                c.fetch_host_delay
+
+    if type(c.fetch_max_rate) != int or c.fetch_max_rate < 0:
+        raise Exception, "fetch_max_rate must be an integer >= 0 (%s)" %\
+                c.fetch_max_rate
+
+    if type(c.fetch_processes) != int or c.fetch_processes < 0:
+        raise Exception, "fetch_processes must be an integer >= 0 (%s)" %\
+                c.fetch_processes
+
+    if type(c.fetch_script_timeout) not in [int, float] or\
+            c.fetch_script_timeout < 0:
+        raise Exception, "fetch_script_timeout must be a number >= 0 (%s)" %\
+                c.fetch_script_timeout
+
+    if c.fetch_engine not in ["thread", "async"]:
+        raise Exception, "fetch_engine must be \"thread\" or \"async\" (%s)" %\
+                c.fetch_engine
+
+def validate(c):
+    pass
+
+def test(c):
+    pass
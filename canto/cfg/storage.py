@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# feed_storage picks how feeds are kept on disk (see canto/storage.py). Both
+# canto and canto-fetch need it before validate() would be called, so it's
+# checked in post_parse.
+
+from canto import storage
+
+def register(c):
+    c.feed_storage = "pickle"
+    c.locals.update({"feed_storage" : c.feed_storage})
+
+def post_parse(c):
+    c.feed_storage = c.locals["feed_storage"]
+
+    if c.feed_storage not in storage.STORES:
+        raise Exception, "feed_storage must be \"pickle\" or \"sqlite\" (%s)" %\
+                c.feed_storage
+
+    if c.feed_storage == "sqlite" and not storage.sqlite3:
+        raise Exception, "feed_storage = \"sqlite\" needs the sqlite3 module"
+
+    c.store = storage.get_store(c.feed_storage, c.feed_dir)
+
+def validate(c):
+    pass
+
+def test(c):
+    pass
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# The change log lets the client pick up what canto-fetch did to a feed without
+# loading the whole feed from disk and comparing every entry to what it already
+# has in memory.
+#
+# Every time canto-fetch writes a feed, it bumps canto_seq in the feed and adds
+# a record to the feed's log (in .changes in the feed directory, under the same
+# name as the feed), while it still holds the feed's write lock with the pickle
+# store, or once the write is committed with the SQLite store (see append).
+# Each record is a tuple:
+#
+#       (seq before, seq after, mtime of the feed after the write, entries)
+#
+# Where entries is every entry in the feed, in order, as
+#
+#       (id, canto_state, entry)
+#
+# and entry is the new entry for new items, or None for items the feed already
+# had, which the client already has too. Long texts in new entries are
+# references to the blob store, just as they are in the feed file (see
+# storage.py), so a record is never much bigger than the ids in it. A feed
+# that's found unchanged isn't written at all (see fetch_checked.py), so it
+# doesn't get a record either.
+#
+# A client that last saw the feed at some seq can follow the records from
+# there, as long as the mtime of the last one matches the feed (i.e. nobody else
+# has written the feed since). Otherwise it has to reload the feed.
+
+import storage
+
+import cPickle
+import fcntl
+import os
+
+# Only so many records are kept, a client that's further behind than that just
+# reloads.
+
+MAX_RECORDS = 16
+
+def path(fpath):
+    head, tail = os.path.split(fpath)
+    return os.path.join(head, ".changes", tail)
+
+def load(fpath):
+    try:
+        f = open(path(fpath), "r")
+    except IOError:
+        return []
+
+    try:
+        try:
+            return cPickle.load(f)
+        except:
+            return []
+    finally:
+        f.close()
+
+# The SQLite store calls append once the write is committed, not with the feed
+# locked, so several writers can append at once. They take turns on .lock in
+# .changes, so that none of them replaces the log without the others' records.
+# Readers don't lock at all, so the log is still replaced in one go.
+
+def append(fpath, record):
+    logpath = path(fpath)
+    dir = os.path.dirname(logpath)
+    if not os.path.exists(dir):
+        try:
+            os.mkdir(dir)
+        except OSError:
+            pass
+
+    try:
+        lock = open(os.path.join(dir, ".lock"), "a")
+    except IOError:
+        return
+
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        records = load(fpath)[-(MAX_RECORDS - 1):] + [record]
+        storage.replace(logpath, cPickle.dumps(records))
+    finally:
+        lock.close()
+
+# follow returns the records leading from seq to the current state of the feed,
+# given its mtime, or None if there's no way to get there.
+
+def follow(fpath, seq, mtime):
+    chain = []
+    for record in load(fpath):
+        if record[0] == seq:
+            chain.append(record)
+            seq = record[1]
+        elif chain:
+            return None
+
+    if not chain or chain[-1][2] != mtime:
+        return None
+    return chain
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# The ConnectionPool keeps HTTP connections alive between requests so that
+# feeds living on the same host don't each pay for a new TCP (and TLS)
+# handshake. It's shared by all of canto-fetch's workers and, when canto-fetch
+# is run as a daemon, it lives across update cycles.
+#
+# urllib2's own handlers always send "Connection: close", so the pool comes
+# with its own handlers that take a connection from the pool, make the request
+# and put the connection back once the response has been completely read.
+# Everything else (redirects, authentication, errors) is still handled by
+# urllib2 as usual.
+
+from threading import Lock
+from StringIO import StringIO
+import urllib2
+import httplib
+import socket
+import errno
+import time
+
+# When a response is closed before its body was read (i.e. an error page), the
+# rest of the body is read off and the connection kept, as long as the server
+# said how long it is and it's no longer than this.
+
+DRAIN_SIZE = 65536
+
+class ConnectionPool():
+    def __init__(self, max_idle=16):
+        self.lock = Lock()
+
+        # Idle connections, oldest first, as (key, connection) tuples where key
+        # is (scheme, host). This is capped at max_idle, so file descriptor use
+        # stays flat no matter how many hosts we fetch from.
+
+        self.idle = []
+        self.max_idle = max_idle
+
+        self.reused = 0
+        self.opened = 0
+
+    # get returns (connection, reused). If fresh is set, a new connection is
+    # opened even if there's an idle one available.
+
+    def get(self, key, fresh=False):
+        self.lock.acquire()
+        try:
+            if not fresh:
+                for i in xrange(len(self.idle) - 1, -1, -1):
+                    if self.idle[i][0] == key:
+                        conn = self.idle.pop(i)[1]
+                        self.reused += 1
+                        return (conn, True)
+            self.opened += 1
+        finally:
+            self.lock.release()
+
+        scheme, host = key
+        if scheme == "https":
+            return (httplib.HTTPSConnection(host), False)
+        return (httplib.HTTPConnection(host), False)
+
+    def put(self, key, conn):
+        self.lock.acquire()
+        try:
+            self.idle.append((key, conn))
+            if len(self.idle) > self.max_idle:
+                self.idle.pop(0)[1].close()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return (self.reused, self.opened)
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for key, conn in self.idle:
+                conn.close()
+            self.idle = []
+        finally:
+            self.lock.release()
+
+    def handlers(self):
+        h = [PooledHTTPHandler(self)]
+        if hasattr(httplib, "HTTPSConnection"):
+            h.append(PooledHTTPSHandler(self))
+        return h
+
+# PooledResponse looks enough like the urllib2 response for feedparser and
+# urllib2's error handling. Once the body has been read to the end, the
+# connection is handed back to the pool. If it's closed early, the connection
+# is thrown away, unless what's left of the body is short enough to read off
+# (see DRAIN_SIZE).
+
+class PooledResponse():
+    def __init__(self, pool, key, conn, response, url, timing):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+
+        # How long the DNS lookup, connecting and waiting for the response
+        # headers took. Reused connections skip the first two.
+        self.timing = timing
+
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        self.lines = None
+
+        # Bodiless responses (i.e. 304) are already complete.
+        if response.length == 0:
+            response.read()
+            self.release()
+
+    def read(self, amt=None):
+        if self.lines:
+            return self.lines.read(amt or -1)
+        if amt == None:
+            data = self.response.read()
+        else:
+            data = self.response.read(amt)
+        if self.response.isclosed():
+            self.release()
+        return data
+
+    # Nothing in canto reads feeds by line, but urllib2's HTTPError insists on
+    # having readline, so the rest of the body is just buffered.
+
+    def readline(self):
+        if not self.lines:
+            self.lines = StringIO(self.read())
+        return self.lines.readline()
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def release(self):
+        if not self.conn:
+            return
+        if self.response.will_close:
+            self.conn.close()
+        else:
+            self.pool.put(self.key, self.conn)
+        self.conn = None
+
+    def close(self):
+        if self.conn and not self.response.isclosed():
+            length = self.response.length
+            if length != None and length <= DRAIN_SIZE:
+                try:
+                    self.response.read()
+                except (socket.error, httplib.HTTPException):
+                    pass
+            if not self.response.isclosed():
+                self.conn.close()
+                self.conn = None
+        self.release()
+
+# stale returns whether the error is what using a connection the server has
+# closed since we last used it looks like: the request can't be sent (the
+# connection is reset, or the pipe broken) or the server hangs up without a
+# word (BadStatusLine). A timeout isn't one of them, the server may just be
+# slow, and trying again would only double the wait.
+
+def stale(e):
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    if isinstance(e, socket.timeout) or not isinstance(e, socket.error):
+        return False
+    return len(e.args) > 0 and e.args[0] in [errno.ECONNRESET, errno.EPIPE]
+
+class PooledHandlerMixin():
+    def __init__(self, pool):
+        self.pool = pool
+
+    def pooled_open(self, scheme, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.headers)
+        headers.update(req.unredirected_hdrs)
+
+        key = (scheme, host)
+        conn, reused = self.pool.get(key)
+
+        while 1:
+            timing = {}
+            try:
+                # New connections are opened by hand to time them. The lookup
+                # is done again by connect(), but by then it's usually cached.
+
+                if not reused:
+                    start = time.time()
+                    socket.getaddrinfo(conn.host, conn.port, 0,
+                            socket.SOCK_STREAM)
+                    timing["dns"] = time.time() - start
+
+                    start = time.time()
+                    conn.connect()
+                    timing["connect"] = time.time() - start
+
+                start = time.time()
+                conn.request(req.get_method(), req.get_selector(),
+                        req.data, headers)
+                response = conn.getresponse()
+                timing["ttfb"] = time.time() - start
+                break
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+
+                # The server may have closed an idle connection since we last
+                # used it, so a reused connection that turned out to be stale
+                # gets a second chance on a new connection.
+
+                if not (reused and stale(e)):
+                    raise urllib2.URLError(e)
+                conn, reused = self.pool.get(key, True)
+
+        return PooledResponse(self.pool, key, conn, response,
+                req.get_full_url(), timing)
+
+class PooledHTTPHandler(PooledHandlerMixin, urllib2.HTTPHandler):
+    def __init__(self, pool):
+        urllib2.HTTPHandler.__init__(self)
+        PooledHandlerMixin.__init__(self, pool)
+
+    def http_open(self, req):
+        return self.pooled_open("http", req)
+
+if hasattr(httplib, "HTTPSConnection"):
+    class PooledHTTPSHandler(PooledHandlerMixin, urllib2.HTTPSHandler):
+        def __init__(self, pool):
+            urllib2.HTTPSHandler.__init__(self)
+            PooledHandlerMixin.__init__(self, pool)
+
+        def https_open(self, req):
+            return self.pooled_open("https", req)
@@ -22,9 +22,6 @@
 from const import STORY_QD, STORY_SAVED, STORY_UPDATED
 import story
 
-import cPickle
-import fcntl
-
 class Feed(list):
     def __init__(self, cfg, dirpath, URL, tags, rate, keep, \
             filter, username, password):
@@ -57,47 +54,122 @@ class Feed(list):
         self.path = dirpath
         self.cfg = cfg
 
+        # The canto_seq of the feed on disk that the items reflect, and the
+        # mtime of the feed when they did, so update() can tell what's changed
+        # since (see changelog.py). The items go back and forth between
+        # processes, so these go with them.
+
+        self.seq = 0
+        self.mtime = None
+
+        # The mtime of the feed when get_ufp() last read it.
+        self.ufp_mtime = None
+
+        # ids maps the id of each item to the item (the first, if there's more
+        # than one), so finding an item doesn't mean comparing it against
+        # every other one in the feed.
+        self.ids = {}
+
     def __eq__(self, other):
         return self.URL == other.URL
 
-    def get_ufp(self):
-        lockflags = fcntl.LOCK_SH
-        if self.base_set:
-            lockflags |= fcntl.LOCK_NB
+    # All of the items in a feed have the same feed, so they're equal if their
+    # ids are (see Story.__eq__). find returns the item equal to item, or None,
+    # like self[self.index(item)] without the search.
+
+    def find(self, item):
+        cur = self.ids.get(item["id"])
+        if cur and cur == item:
+            return cur
+        return None
+
+    def reindex(self):
+        self.ids = {}
+        for item in self:
+            if item["id"] not in self.ids:
+                self.ids[item["id"]] = item
+
+    # Everything that changes the list (including the interface, which empties
+    # it) has to keep ids up to date, so the list's own methods that could are
+    # wrapped. extend is already taken, replace is what it would've been.
+
+    def replace(self, items):
+        list.__delslice__(self, 0, len(self))
+        list.extend(self, items)
+        self.reindex()
+
+    def append(self, item):
+        list.append(self, item)
+        if item["id"] not in self.ids:
+            self.ids[item["id"]] = item
+
+    def insert(self, i, item):
+        list.insert(self, i, item)
+        self.reindex()
+
+    def remove(self, item):
+        list.remove(self, item)
+        self.reindex()
+
+    def pop(self, i=-1):
+        item = list.pop(self, i)
+        self.reindex()
+        return item
+
+    def __setitem__(self, i, item):
+        list.__setitem__(self, i, item)
+        self.reindex()
+
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        self.reindex()
+
+    def __setslice__(self, i, j, items):
+        list.__setslice__(self, i, j, items)
+        self.reindex()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self.reindex()
+
+    # get_ufp loads the whole feed from the store (see storage.py). Neither
+    # store makes readers wait on writers. Only a few fields of each item are
+    # kept (see strip), so the long texts are left on disk.
 
+    def get_ufp(self):
         try:
-            f = open(self.path, "r")
-            try:
-                fcntl.flock(f.fileno(), lockflags)
-                ufp = cPickle.load(f)
-            except ImportError:
-                try:
-
-                    # Fortunately, I don't think forcing the cpickle
-                    # to use feedparser_builtin is harmful, since they're
-                    # basically the same class, feedparser_builtin is just the
-                    # only way to properly look up the toplevel module now.
-
-                    f.seek(0)
-                    data = f.read()
-                    data = data.replace("feedparser\n","feedparser_builtin\n",1)
-                    ufp = cPickle.loads(data)
-                except:
-                    return 0
-            except:
-                return 0
-            finally:
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
+            ufp, self.ufp_mtime = self.cfg.store.load(self.path,
+                    not self.base_set, None, False)
         except:
             return 0
         return ufp
 
+    # get_changes returns the change log records that bring the items up to
+    # date with the feed on disk (an empty list if it hasn't been written since
+    # we last saw it), or None if the whole feed has to be reloaded.
+
+    def get_changes(self):
+        if not self.seq or not self.base_set:
+            return None
+
+        try:
+            return self.cfg.store.changes(self.path, self.seq, self.mtime)
+        except:
+            return None
+
     def update(self):
+        changes = self.get_changes()
+        if changes != None and self.apply(changes):
+            self.todisk()
+            return 1
+
         ufp = self.get_ufp()
         if not ufp:
             return 0
 
+        self.seq = ufp.get("canto_seq", 0)
+        self.mtime = self.ufp_mtime
+
         # If the base hasn't been set, attempt to set it from the data we just
         # picked up. get_ufp() blocks if base isn't set so it's impossible that
         # we'll just bail out unless there's a cPickle.load exception, but at
@@ -116,147 +188,205 @@ class Feed(list):
         self.todisk(ufp)
         return 1
 
+    # apply follows the change log records from get_changes. The items canto-fetch
+    # kept are kept (with their state from disk, unless we've changed it) and
+    # new ones are added, so none of the feed has to be read. If one of the
+    # kept items isn't here (the hard filter dropped it), it's impossible to
+    # know what it should look like now, so apply gives up and leaves the items
+    # alone.
+
+    def apply(self, records):
+        if not records:
+            return 1
+
+        items = self[:]
+        for before, after, mtime, entries in records:
+            current = {}
+            for item in items:
+                current[item["id"]] = item
+
+            newlist = []
+            seen = {}
+            for id, state, entry in entries:
+                if entry:
+                    if id not in seen:
+                        newlist.append(self.strip(entry))
+                        seen[id] = True
+                elif id in current:
+                    centry = current.pop(id)
+                    if (not centry.updated) and\
+                        (centry["canto_state"] != state):
+                        centry["canto_state"] = list(state)
+                    newlist.append(centry)
+                    seen[id] = True
+                elif id not in seen:
+                    return 0
+
+            items = [ x for x in newlist\
+                    if not self.filter or self.filter(self, x) ]
+
+        self.replace(items)
+
+        self.seq = records[-1][1]
+        self.mtime = records[-1][2]
+        return 1
+
     # Extend's job is to take items from disk, strip them down to the items that
     # we want to keep in memory (i.e. stuff that's used often) and add them to
     # the feed, applying the hard filter if necessary.
 
     def extend(self, entries):
         newlist = []
+        seen = {}
         for entry in entries:
 
-            # This checks existence in newlist as well to avoid
+            # Only the first of any items with the same id is kept, to avoid
             # duplicate items on feeds with duplicates in them.
             # (i.e. broken)
 
-            if entry in self and entry not in newlist:
-                centry = self[self.index(entry)]
+            if entry["id"] in seen:
+                continue
+            seen[entry["id"]] = True
+
+            centry = self.find(entry)
+            if centry:
                 if (not centry.updated) and\
                     (centry["canto_state"] != entry["canto_state"]):
-                    centry["canto_state"] = entry["canto_state"]
+                    centry["canto_state"] = list(entry["canto_state"])
                 newlist.append(centry)
                 continue
 
-            # nentry is the new, stripped down version of the item
-            nentry = {}
-            nentry["id"] = entry["id"]
-            nentry["feed"] = self.URL
-            nentry["canto_state"] = entry["canto_state"]
+            newlist.append(self.strip(entry))
 
-            if "title" not in entry:
-                nentry["title"] = ""
-            else:
-                nentry["title"] = entry["title"]
+        del self[:]
+        for item in newlist:
+            if not self.filter or self.filter(self, item):
+                self.append(item)
 
-            if "title_detail" in entry:
-                nentry["title_detail"] = entry["title_detail"]
+    # strip makes the new, stripped down Story for an item from disk. Stories
+    # change their state in place, so they get their own copy of it, or
+    # todisk would compare them to their own changes (see update_states).
 
-            for pc in self.cfg.precache:
-                if pc in entry:
-                    nentry[pc] = entry[pc]
-                else:
-                    nentry[pc] = None
+    def strip(self, entry):
+        nentry = {}
+        nentry["id"] = entry["id"]
+        nentry["feed"] = self.URL
+        nentry["canto_state"] = list(entry["canto_state"])
 
-            if "link" in entry:
-                nentry["link"] = entry["link"]
-            elif "href" in entry:
-                nentry["link"] = entry["href"]
+        if "title" not in entry:
+            nentry["title"] = ""
+        else:
+            nentry["title"] = entry["title"]
 
-            # If tags were added in the configuration, c-f won't
-            # notice (doesn't care about tags), so we check and
-            # append as needed.
+        if "title_detail" in entry:
+            nentry["title_detail"] = entry["title_detail"]
 
-            updated = STORY_SAVED
-            if self.tags[0] != nentry["canto_state"][0]:
-                nentry["canto_state"][0] = self.tags[0]
-                updated = STORY_UPDATED
+        for pc in self.cfg.precache:
+            if pc in entry:
+                nentry[pc] = self.cfg.store.resolve(entry[pc])
+            else:
+                nentry[pc] = None
 
-            for tag in self.tags[1:]:
-                if tag not in nentry["canto_state"]:
-                    nentry["canto_state"].append(tag)
-                    updated = STORY_UPDATED
+        if "link" in entry:
+            nentry["link"] = entry["link"]
+        elif "href" in entry:
+            nentry["link"] = entry["href"]
 
-            if nentry not in newlist:
-                newlist.append(story.Story(nentry, self.path, updated))
+        # If tags were added in the configuration, c-f won't
+        # notice (doesn't care about tags), so we check and
+        # append as needed.
 
-        del self[:]
-        for item in newlist:
-            if not self.filter or self.filter(self, item):
-                list.append(self, item)
+        updated = STORY_SAVED
+        if self.tags[0] != nentry["canto_state"][0]:
+            nentry["canto_state"][0] = self.tags[0]
+            updated = STORY_UPDATED
+
+        for tag in self.tags[1:]:
+            if tag not in nentry["canto_state"]:
+                nentry["canto_state"].append(tag)
+                updated = STORY_UPDATED
+
+        return story.Story(nentry, self.path, updated)
 
     # Merging items means that they're unvalidated and unfiltered. This is
     # used when story objects are read in from a pipe.
 
     def merge(self, iter):
         for i, item in enumerate(iter):
-            if item in self:
-                cur = self[self.index(item)]
+            cur = self.find(item)
+            if cur:
                 if cur.updated in [STORY_SAVED, STORY_QD]:
                     cur["canto_state"] = item["canto_state"]
                     cur.updated = 0
                 iter[i] = cur
 
-        del self[:]
-        list.extend(self, iter)
+        self.replace(iter)
 
     # todisk is the complement to get_ufp, however, since the state may have
     # changed on any of the items, it has to intelligently merge the changes
-    # before writing to disk.
+    # before writing to disk. Only the states of the changed items are looked
+    # at, so the store only has to touch those (see storage.update_states).
+    # The store calls merge with the feed locked, so state_change_hook isn't
+    # run until the changes are written and the lock is released.
 
     def todisk(self, ufp=None):
-        if ufp == None:
-            ufp = self.get_ufp()
-        if not ufp:
-            return
-
         changed = self.changed()
         if not changed :
             return
 
-        for entry in changed:
-            # We've stopped caring about this item
-            if entry not in ufp["entries"]:
-                continue
-
-            old = ufp["entries"][ufp["entries"].index(entry)]
-            if old["canto_state"] != entry["canto_state"]:
-                # States differ, and we've recorded an update, that means we
-                # probably have the newer information, so we handle the
-                # state_change_hook in a batch and overwrite the old data
-
-                if entry.updated:
-                    if self.cfg.state_change_hook:
-                        add = [t for t in entry["canto_state"] if\
-                               t not in old["canto_state"]]
-                        rem = [t for t in old["canto_state"] if\
-                               t not in entry["canto_state"]]
-                        self.cfg.state_change_hook(self, entry, add, rem)
-                    old["canto_state"] = entry["canto_state"]
+        hooked = []
+        def merge(states):
+            del hooked[:]
+            write = {}
+            for entry in changed:
+                # We've stopped caring about this item
+                if entry["id"] not in states:
+                    continue
+
+                old = states[entry["id"]]
+                if old != entry["canto_state"]:
+                    # States differ, and we've recorded an update, that means
+                    # we probably have the newer information, so we handle the
+                    # state_change_hook in a batch and overwrite the old data
+
+                    if entry.updated:
+                        if self.cfg.state_change_hook:
+                            add = [t for t in entry["canto_state"] if\
+                                   t not in old]
+                            rem = [t for t in old if\
+                                   t not in entry["canto_state"]]
+                            hooked.append((entry, add, rem))
+                        write[entry["id"]] = entry["canto_state"]
+
+                    # States differ, but we have no change, most likely the on
+                    # disk info is newer (i.e. changed by another running
+                    # canto instance). We count on the other canto instance
+                    # handling the state_change_hook.
+
+                    else:
+                        entry["canto_state"] = list(old)
+            return write
+
+        loaded = None
+        if ufp:
+            loaded = (ufp, self.ufp_mtime)
+
+        r = self.cfg.store.update_states(self.path,
+                [ x["id"] for x in changed ], merge, loaded)
+        if not r:
+            return 0
 
+        for entry, add, rem in hooked:
+            self.cfg.state_change_hook(self, entry, add, rem)
 
-                # States differ, but we have no change, most likely the on disk
-                # info is newer (i.e. changed by another running canto
-                # instance). We count on the other canto instance handling the
-                # state_change_hook.
+        for x in changed:
+            x.updated = STORY_SAVED
 
-                else:
-                    entry["canto_state"] = old["canto_state"]
+        # If the items were up to date with what we just wrote over, they
+        # still are.
 
-        # Dump the feed to disk.
-        f = open(self.path, "r+")
-        try:
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-            f.seek(0, 0)
-            f.truncate()
-            cPickle.dump(ufp, f)
-            f.flush()
-            for x in changed:
-                x.updated = STORY_SAVED
-        except:
-            return 0
-        finally:
-            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-            f.close()
-        del ufp
+        if self.mtime != None and self.mtime == r[0]:
+            self.mtime = r[1]
         return 1
 
     def changed(self):
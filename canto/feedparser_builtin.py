@@ -67,7 +67,7 @@ TIDY_MARKUP = 0
 PREFERRED_TIDY_INTERFACES = ["uTidy", "mxTidy"]
 
 # ---------- required modules (should come with any Python distribution) ----------
-import sgmllib, re, sys, copy, urlparse, time, rfc822, types, cgi, urllib, urllib2
+import sgmllib, re, sys, copy, urlparse, time, rfc822, types, cgi, urllib, urllib2, codecs
 try:
     from cStringIO import StringIO as _StringIO
 except:
@@ -373,6 +373,7 @@ class _FeedParserMixin:
         self.incontent = 0
         self.intextinput = 0
         self.inimage = 0
+        self.inskiphours = 0
         self.inauthor = 0
         self.incontributor = 0
         self.inpublisher = 0
@@ -816,6 +817,26 @@ class _FeedParserMixin:
         self.intextinput = 0
     _end_textInput = _end_textinput
 
+    def _start_skiphours(self, attrsD):
+        self.inskiphours = 1
+        self.push('skiphours', 0)
+        self.feeddata.setdefault('skiphours', [])
+
+    def _end_skiphours(self):
+        self.pop('skiphours')
+        self.inskiphours = 0
+
+    def _start_hour(self, attrsD):
+        self.push('hour', 1)
+
+    def _end_hour(self):
+        value = self.pop('hour')
+        if self.inskiphours:
+            try:
+                self.feeddata['skiphours'].append(int(value))
+            except ValueError:
+                pass
+
     def _start_author(self, attrsD):
         self.inauthor = 1
         self.push('author', 1)
@@ -2456,6 +2477,159 @@ def _stripDoctype(data):
     data = doctype_pattern.sub('', data)
     return version, data
     
+# Amount of data read from a stream at a time by _parseStream
+_STREAM_CHUNK = 65536
+
+def _parseStream(f):
+    '''Parse a feed from a seekable stream, without reading it all into memory
+
+    The data is decompressed, converted to UTF-8 and handed to an incremental
+    SAX parser one chunk at a time, so only one chunk of the document is held
+    in memory at once, rather than several copies of the whole thing.
+
+    Returns the result, or None if the feed is anything but a well-formed
+    document in the first encoding parse() would try (or has a DOCTYPE that
+    doesn't fit in the first chunk). In that case, the caller should seek back
+    to the start and give the stream to parse() as usual, which knows how to
+    cope. The complaints parse() makes about feeds it can read anyway (a
+    content type that isn't XML, an encoding other than the one declared) are
+    made here too.
+    '''
+    result = FeedParserDict()
+    result['feed'] = FeedParserDict()
+    result['entries'] = []
+    result['bozo'] = 0
+
+    if hasattr(f, 'info'):
+        info = f.info()
+        if info.has_key('Etag'):
+            result['etag'] = info.getheader('ETag')
+        last_modified = info.getheader('Last-Modified')
+        if last_modified:
+            result['modified'] = _parse_date(last_modified)
+    if hasattr(f, 'url'):
+        result['href'] = f.url
+        result['status'] = 200
+    if hasattr(f, 'status'):
+        result['status'] = f.status
+    if hasattr(f, 'headers'):
+        result['headers'] = f.headers.dict
+    http_headers = result.get('headers', {})
+
+    if result.get('status', 0) == 304:
+        return None
+
+    decompressor = None
+    if zlib and http_headers.get('content-encoding', '') == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif zlib and http_headers.get('content-encoding', '') == 'deflate':
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def chunks():
+        while 1:
+            data = f.read(_STREAM_CHUNK)
+            if not data:
+                break
+            if decompressor:
+                data = decompressor.decompress(data)
+            yield data
+        if decompressor:
+            yield decompressor.flush()
+
+    try:
+        stream = chunks()
+        head = ''
+        for data in stream:
+            head += data
+            if len(head) >= _STREAM_CHUNK:
+                break
+
+        result['encoding'], http_encoding, xml_encoding, sniffed_xml_encoding, acceptable_content_type = \
+            _getCharacterEncoding(http_headers, head)
+        if not head:
+            return None
+        if http_headers and (not acceptable_content_type):
+            if http_headers.has_key('content-type'):
+                bozo_message = '%s is not an XML media type' % http_headers['content-type']
+            else:
+                bozo_message = 'no Content-type specified'
+            result['bozo'] = 1
+            result['bozo_exception'] = NonXMLContentType(bozo_message)
+
+        # the first encoding parse() would try; if the data turns out not to
+        # be in it, parse() goes on to the others (and chardet)
+        proposed_encoding = None
+        for encoding in (result['encoding'], xml_encoding, sniffed_xml_encoding):
+            if not encoding: continue
+            try:
+                codecs.lookup(encoding)
+            except LookupError:
+                continue
+            proposed_encoding = encoding
+            break
+        if not proposed_encoding:
+            return None
+        if proposed_encoding != result['encoding']:
+            result['bozo'] = 1
+            result['bozo_exception'] = CharacterEncodingOverride( \
+                'documented declared as %s, but parsed as %s' % \
+                (result['encoding'], proposed_encoding))
+            result['encoding'] = proposed_encoding
+
+        if (head.find('<!DOCTYPE') != -1 or head.find('<!ENTITY') != -1) and (len(head) >= _STREAM_CHUNK):
+            return None
+        result['version'], head = _stripDoctype(head)
+
+        # a BOM that disagrees with the encoding is left to _toUTF8
+        encoding = codecs.lookup(result['encoding']).name
+        if head[:3] == '\xef\xbb\xbf' and encoding == 'utf-8':
+            head = head[3:]
+        elif head[:2] in ('\xfe\xff', '\xff\xfe') or head[:4] == '\x00\x00\xfe\xff':
+            return None
+        decoder = codecs.getincrementaldecoder(result['encoding'])()
+
+        text = decoder.decode(head)
+        declmatch = re.compile(u'^<\?xml[^>]*?>')
+        newdecl = u'''<?xml version='1.0' encoding='utf-8'?>'''
+        if declmatch.search(text):
+            text = declmatch.sub(newdecl, text)
+        else:
+            text = newdecl + u'\n' + text
+        head = None
+
+        baseuri = http_headers.get('content-location', result.get('href'))
+        baselang = http_headers.get('content-language', None)
+
+        feedparser = _StrictFeedParser(baseuri, baselang, 'utf-8')
+        saxparser = xml.sax.make_parser(PREFERRED_XML_PARSERS)
+        if not isinstance(saxparser, xml.sax.xmlreader.IncrementalParser):
+            return None
+        saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
+        saxparser.setContentHandler(feedparser)
+        saxparser.setErrorHandler(feedparser)
+        if hasattr(saxparser, '_ns_stack'):
+            saxparser._ns_stack.append({'http://www.w3.org/XML/1998/namespace':'xml'})
+
+        saxparser.feed(text.encode('utf-8'))
+        for data in stream:
+            text = decoder.decode(data)
+            if text:
+                saxparser.feed(text.encode('utf-8'))
+        text = decoder.decode('', True)
+        if text:
+            saxparser.feed(text.encode('utf-8'))
+        saxparser.close()
+    except Exception, e:
+        if _debug:
+            sys.stderr.write('streaming parse failed: %s\n' % e)
+        return None
+
+    result['feed'] = feedparser.feeddata
+    result['entries'] = feedparser.entries
+    result['version'] = result['version'] or feedparser.version
+    result['namespaces'] = feedparser.namespacesInUse
+    return result
+
 def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[]):
     '''Parse a feed from a URL, file, stream, or string'''
     result = FeedParserDict()
@@ -2467,6 +2641,13 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
         handlers = [handlers]
     try:
         f = _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, handlers)
+        if _XML_AVAILABLE and hasattr(f, 'seek'):
+            streamed = _parseStream(f)
+            if streamed:
+                if hasattr(f, 'close'):
+                    f.close()
+                return streamed
+            f.seek(0)
         data = f.read()
     except Exception, e:
         result['bozo'] = 1
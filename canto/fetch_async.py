@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# This is the event loop engine for canto-fetch (--engine=async). Instead of
+# each worker blocking on its own urllib2 request, all of the downloads are
+# multiplexed on non-blocking sockets in a single asyncore loop, and the
+# workers are only used to parse and write out what's been downloaded.
+#
+# The HTTP client here is deliberately dumb. It speaks HTTP/1.0, so the body
+# is everything up until the server closes the connection, and it only follows
+# redirects. Feeds that need more than that (scripts, https, authentication)
+# are handed to the workers to be fetched the usual way, as are feeds on hosts
+# that are down, which the workers skip.
+#
+# Looking up a host name blocks, and there's no non-blocking way to do it in
+# the standard library, so lookups are done by a few Resolver threads and
+# their answers picked up by the loop.
+
+from threading import Thread
+from StringIO import StringIO
+import asyncore
+import urlparse
+import httplib
+import urllib
+import socket
+import Queue
+import time
+import sys
+
+REDIRECTS = [301, 302, 303, 307]
+MAX_REDIRECTS = 5
+
+# Parsing is CPU bound, so more parsing threads than this just fight over the
+# GIL.
+
+PARSE_WORKERS = 4
+
+# Lookups are mostly waiting on the network, but a handful at once is plenty.
+
+RESOLVERS = 4
+
+# A DownloadError is what went wrong with a download. connect is whether the
+# server never got as far as taking the connection, since only that says
+# anything about the host being down (see FetchThread.failed).
+
+class DownloadError(Exception):
+    def __init__(self, message, connect=True):
+        Exception.__init__(self, message)
+        self.connect = connect
+
+def can_fetch(fd):
+    return fd.URL.startswith("http://") and\
+            not (fd.username or fd.password)
+
+# The Resolver looks up (host, port) for downloads in its threads. Answers are
+# queued up, as (download, addresses, error, time taken), for the loop to
+# collect with ready().
+
+class Resolver():
+    def __init__(self, threads):
+        self.requests = Queue.Queue()
+        self.results = Queue.Queue()
+        self.threads = []
+        for i in xrange(threads):
+            self.threads.append(Thread(target=self.work))
+            self.threads[-1].setDaemon(True)
+            self.threads[-1].start()
+
+    def work(self):
+        while 1:
+            item = self.requests.get()
+            if not item:
+                return
+
+            download, host, port = item
+            start = time.time()
+            try:
+                addrs = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+                error = None
+            except:
+                addrs = None
+                error = str(sys.exc_info()[1])
+            self.results.put((download, addrs, error, time.time() - start))
+
+    def lookup(self, download, host, port):
+        self.requests.put((download, host, port))
+
+    def ready(self):
+        results = []
+        while 1:
+            try:
+                results.append(self.results.get(False))
+            except Queue.Empty:
+                return results
+
+    def close(self):
+        for thread in self.threads:
+            self.requests.put(None)
+
+# An AsyncDownload starts out waiting on the Resolver, and only gets a socket
+# (and joins the loop) once its host has been looked up. Whatever happens, its
+# engine's finished() is called exactly once for it, or for the download it
+# was redirected to.
+
+class AsyncDownload(asyncore.dispatcher):
+    def __init__(self, fetch, url, headers, engine, redirects=0):
+        asyncore.dispatcher.__init__(self, map=engine.sockmap)
+        self.fetch = fetch
+        self.url = url
+        self.headers = headers
+        self.engine = engine
+        self.redirects = redirects
+
+        self.data = []
+        self.done = False
+        self.last = time.time()
+        self.timing = {}
+        self.addrs = []
+        self.answered = False
+
+        parts = urlparse.urlsplit(url)
+        host = parts.hostname
+        port = parts.port or 80
+
+        selector = parts.path or "/"
+        if parts.query:
+            selector += "?" + parts.query
+
+        request = ["GET %s HTTP/1.0" % selector, "Host: %s" % parts.netloc]
+        for k, v in headers.items():
+            request.append("%s: %s" % (k, v))
+        self.out = "\r\n".join(request) + "\r\n\r\n"
+
+        engine.resolver.lookup(self, host, port)
+
+    # resolved is called by the loop with the Resolver's answer. A host can
+    # have several addresses (i.e. IPv6 and IPv4), they're tried in order
+    # until one of them takes the connection.
+
+    def resolved(self, addrs, error, elapsed):
+        self.timing["dns"] = elapsed
+        if error:
+            self.finish(error)
+            return
+
+        self.addrs = addrs
+        self.connect_next()
+
+    def connect_next(self):
+        error = "no addresses for host"
+        while self.addrs:
+            family, type, proto, name, addr = self.addrs.pop(0)
+            try:
+                self.create_socket(family, type)
+                self.started = self.last = time.time()
+                self.connect(addr)
+                return
+            except socket.error, e:
+                self.close()
+                error = str(e)
+        self.finish(error)
+
+    def writable(self):
+        return not self.connected or len(self.out) > 0
+
+    def handle_connect(self):
+        self.answered = True
+        self.timing["connect"] = time.time() - self.started
+        self.started = time.time()
+
+    def handle_write(self):
+        sent = self.send(self.out)
+        self.out = self.out[sent:]
+        self.last = time.time()
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            if not self.data:
+                self.timing["ttfb"] = time.time() - self.started
+                self.started = time.time()
+            self.data.append(data)
+            self.last = time.time()
+
+    def handle_close(self):
+        self.close()
+        self.finish()
+
+    def handle_error(self):
+        connected = self.connected
+        self.close()
+        if not connected and self.addrs:
+            self.connect_next()
+        else:
+            self.finish(str(sys.exc_info()[1]))
+
+    def timeout(self, limit):
+        if time.time() - self.last > limit:
+            self.close()
+            self.finish("timed out")
+
+    # finish hands the download's result to the engine. Nothing that goes
+    # wrong while sorting out the response can keep it from doing so, or the
+    # engine would wait on it forever.
+
+    def finish(self, error=None):
+        if self.done:
+            return
+        self.done = True
+
+        if not error:
+            try:
+                response = self.response()
+            except:
+                error = str(sys.exc_info()[1]) or "malformed response"
+
+        if error:
+            self.engine.finished(self.fetch, None,
+                    DownloadError(error, not self.answered))
+        elif response:
+            self.engine.finished(self.fetch, response, None)
+
+    # response returns what was downloaded, as a response, or None if it was a
+    # redirect that's been followed.
+
+    def response(self):
+        if self.data:
+            self.timing["download"] = time.time() - self.started
+
+        data = "".join(self.data)
+        self.data = None
+
+        try:
+            head, body = data.split("\r\n\r\n", 1)
+            status, head = head.split("\r\n", 1)
+            version, code, reason = (status.split(None, 2) + [""])[:3]
+            code = int(code)
+        except:
+            raise Exception, "malformed response"
+
+        headers = httplib.HTTPMessage(StringIO(head + "\r\n\r\n"))
+
+        if code in REDIRECTS and headers.getheader("location"):
+            if self.redirects >= MAX_REDIRECTS:
+                raise Exception, "too many redirects"
+
+            url = urlparse.urljoin(self.url, headers.getheader("location"))
+            if not url.startswith("http://"):
+                raise Exception, "can't follow redirect to %s" % url
+
+            AsyncDownload(self.fetch, url, self.headers, self.engine,
+                    self.redirects + 1)
+            return None
+
+        # This looks enough like a urllib2 response for feedparser.
+
+        response = urllib.addinfourl(StringIO(body), headers, self.url)
+        response.status = code
+        response.code = code
+        response.msg = reason.strip()
+        response.timing = self.timing
+        return response
+
+# AsyncEngine starts downloads as the FetchScheduler allows, and hands finished
+# ones to done(fetch, response, error). At most max_active downloads are in
+# flight, and new ones are only started while room() is true, so that
+# downloaded feeds don't pile up in memory faster than the workers can parse
+# them.
+
+class AsyncEngine():
+    def __init__(self, sched, max_active, room, done, log_func, timeout=30):
+        self.sched = sched
+        self.max_active = max_active
+        self.room = room
+        self.done = done
+        self.log_func = log_func
+        self.timeout = timeout
+        self.sockmap = {}
+        self.active = 0
+        self.resolver = None
+
+    # The host is free as soon as the download is over, there's no need for it
+    # to wait for the feed to be parsed. Even if handing it over fails, the
+    # download is over.
+
+    def finished(self, fetch, response, error):
+        try:
+            self.sched.done(fetch, True)
+            self.done(fetch, response, error)
+        finally:
+            self.active -= 1
+
+    def start(self, fetch):
+        self.active += 1
+        try:
+            AsyncDownload(fetch, fetch.fd.URL,
+                    fetch.headers(fetch.info or fetch.get_curfeed()), self)
+        except:
+            self.finished(fetch, None,
+                    DownloadError(str(sys.exc_info()[1]), False))
+
+    def run(self, fallback):
+        self.resolver = Resolver(RESOLVERS)
+        try:
+            self.loop(fallback)
+        finally:
+            self.resolver.close()
+
+    def loop(self, fallback):
+        while 1:
+            while self.active < self.max_active and self.room():
+                fetch = self.sched.get(False)
+                if not fetch:
+                    break
+
+                # Checking whether a feed is due doesn't touch the network, so
+                # it's just done in line.
+
+                if not fetch.checked:
+                    try:
+                        if fetch.due():
+                            self.sched.put_due(fetch)
+                    except:
+                        self.log_func("Exception checking %s : %s" %\
+                                (fetch.fd.URL, sys.exc_info()[1]))
+                    self.sched.done(fetch, False)
+                elif can_fetch(fetch.fd) and not (fetch.backoff and\
+                        fetch.backoff.host_down(fetch.host)):
+                    self.start(fetch)
+                else:
+                    fallback(fetch)
+
+            if self.sched.finished() and not self.active:
+                break
+
+            for download, addrs, error, elapsed in self.resolver.ready():
+                download.resolved(addrs, error, elapsed)
+
+            if self.sockmap:
+                asyncore.loop(0.05, False, self.sockmap, 1)
+                for d in self.sockmap.values():
+                    d.timeout(self.timeout)
+            else:
+                time.sleep(0.05)
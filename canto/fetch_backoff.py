@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Backoff keeps track of feeds that keep failing, so that a dead feed doesn't
+# cost a socket timeout on every update forever.
+#
+# Each failure in a row doubles the time until the feed is tried again,
+# starting at its rate, up to a day. If the server told us when to come back
+# (Retry-After on a 429 or 503), we wait that long instead. Any successful
+# fetch (including a 304) resets the count.
+#
+# When a whole host is down, its feeds would each take their own timeout to
+# find out, so hosts are tracked too. Once HOST_FAILURES feeds on a host in a
+# row fail to even connect, the host is left alone for a while (doubling again
+# for every failure after that) and any of its feeds still queued are skipped.
+#
+# The state lives in .backoff in the feed directory (see StateFile) so it
+# survives restarts. It's tab separated, one line per feed or host:
+#
+#       "feed" or "host", URL or host, failures, time to try again
+
+from fetch_state import StateFile
+
+import rfc822
+import time
+
+MAX_BACKOFF = 86400
+HOST_FAILURES = 3
+HOST_BACKOFF = 300
+
+class Backoff(StateFile):
+    def parse(self, values):
+        if len(values) != 4 or values[0] not in ["feed", "host"]:
+            return None
+        return ((values[0], values[1]), [int(values[2]), float(values[3])])
+
+    def format(self, (kind, key), (failures, until)):
+        return "%s\t%s\t%d\t%.2f\n" % (kind, key, failures, until)
+
+    # Hosts aren't forgotten, they aren't in the config.
+
+    def feed(self, (kind, key)):
+        if kind == "feed":
+            return key
+        return None
+
+    # until returns when the feed (or host, if it's down) can be tried again,
+    # or 0 if it isn't backing off.
+
+    def until(self, URL, host=None):
+        u = self.state.get(("feed", URL), [0, 0])[1]
+        if host:
+            h = self.state.get(("host", host), [0, 0])
+            if h[0] >= HOST_FAILURES:
+                u = max(u, h[1])
+        return u
+
+    def host_down(self, host):
+        h = self.state.get(("host", host), [0, 0])
+        return h[0] >= HOST_FAILURES and h[1] > time.time()
+
+    # failed records a failure and returns when the feed should be tried again.
+    # Only failures to connect at all count against the host, a feed that
+    # returns 404 doesn't mean anything about the rest of the host's feeds.
+
+    def failed(self, URL, host, rate, retry_after=None, connect=False):
+        now = time.time()
+
+        self.lock.acquire()
+        try:
+            s = self.state.setdefault(("feed", URL), [0, 0])
+            s[0] += 1
+            if retry_after != None:
+                s[1] = now + min(retry_after, MAX_BACKOFF)
+            else:
+                s[1] = now + min(rate * 60 * 2 ** min(s[0] - 1, 16),
+                        MAX_BACKOFF)
+
+            if host and connect:
+                h = self.state.setdefault(("host", host), [0, 0])
+                h[0] += 1
+                if h[0] >= HOST_FAILURES:
+                    h[1] = now + min(HOST_BACKOFF *\
+                            2 ** min(h[0] - HOST_FAILURES, 16), MAX_BACKOFF)
+
+            self.dirty = True
+            return s[1]
+        finally:
+            self.lock.release()
+
+    def succeeded(self, URL, host):
+        self.lock.acquire()
+        try:
+            for key in [("feed", URL), ("host", host)]:
+                if key in self.state:
+                    del self.state[key]
+                    self.dirty = True
+        finally:
+            self.lock.release()
+
+# retry_after parses a Retry-After header, which is either a number of seconds
+# or an HTTP date, into a number of seconds from now.
+
+def retry_after(value):
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    date = rfc822.parsedate_tz(value)
+    if not date:
+        return None
+    return max(rfc822.mktime_tz(date) - time.time(), 0)
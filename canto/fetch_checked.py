@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Checked remembers when feeds that turned out not to have changed (a 304, or
+# the same body as last time) were checked, and when they're due again.
+#
+# Those are the only things that change about the feed in that case, and
+# writing the whole feed out again just to store them would cost a rewrite of
+# the file, a change log record and every client's cached copy of it. So they
+# go here instead, and override canto_update and canto_next in the feed when
+# they're newer (see FetchThread.remember). Once the feed is written again,
+# the feed's own are newer.
+#
+# The state lives in .checked in the feed directory (see StateFile). It's tab
+# separated, one line per feed:
+#
+#       URL, canto_update, canto_next
+
+from fetch_state import StateFile
+
+class Checked(StateFile):
+    def parse(self, values):
+        if len(values) != 3:
+            return None
+        return (values[0], (float(values[1]), float(values[2])))
+
+    def format(self, URL, (update, next)):
+        return "%s\t%.2f\t%.2f\n" % (URL, update, next)
+
+    def feed(self, URL):
+        return URL
+
+    # get returns (canto_update, canto_next) for the feed, or None.
+
+    def get(self, URL):
+        return self.state.get(URL)
+
+    def set(self, URL, update, next):
+        self.lock.acquire()
+        try:
+            if self.state.get(URL) != (update, next):
+                self.state[URL] = (update, next)
+                self.dirty = True
+        finally:
+            self.lock.release()
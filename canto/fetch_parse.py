@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# The ParsePool moves the CPU bound half of canto-fetch (feedparser, stripchars
+# and the merge) out of the fetching threads and into worker processes, for the
+# same reason the client uses processes (see process.py). The threads (or the
+# async engine) only download the feeds and submit what they got here.
+#
+# The pool is forked at the start of an update, so, just like the client's
+# worker, the processes have their own copy of the config and its feeds, and
+# jobs only carry an index into cfg.feeds, along with the downloaded data. All
+# of the processes are forked before any of the collecting threads are
+# started, so no process is forked with threads running.
+# What a job is and what's done with the result is up to the caller: work(job)
+# is run in a worker process and its return value is handed to
+# done(fetch, result) back in canto-fetch.
+
+from process import Queue
+
+from threading import Thread, Lock
+import traceback
+import signal
+import os
+
+class ParseProcess():
+    def __init__(self, work, done, log_func):
+        self.done = done
+        self.log_func = log_func
+
+        self.jobs = Queue()
+        self.results = Queue()
+
+        # Submitted, but not yet finished jobs by sequence number.
+        self.pending = {}
+        self.seq = 0
+
+        self.pid = os.fork()
+        if not self.pid:
+            self.run(work)
+
+        self.thread = Thread(target = self.collect)
+
+    def start(self):
+        self.thread.start()
+
+    # The worker process. Jobs are (seq, job) tuples, and a (None,) tuple tells
+    # the process to exit once it's done with everything before it.
+
+    def run(self, work):
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        while True:
+            try:
+                r = self.jobs.get(True, 0.1)
+            except:
+                # If canto-fetch is dead, don't hang around.
+                if os.getppid() == 1:
+                    os._exit(0)
+                continue
+
+            if r[0] == None:
+                self.results.put(r)
+                self.results.close()
+                os._exit(0)
+
+            seq, job = r
+            try:
+                result = work(job)
+            except:
+                self.log_func("Exception parsing : %s" %\
+                        traceback.format_exc())
+                result = None
+            self.results.put((seq, result))
+
+    def submit(self, fetch, job):
+        self.seq += 1
+        self.pending[self.seq] = fetch
+        self.jobs.put((self.seq, job))
+
+    # The collecting thread lives in canto-fetch and hands the results back.
+    # Whatever done does (it can end up in the user's hooks), it mustn't take
+    # the thread down with it.
+
+    def collect(self):
+        while True:
+            try:
+                r = self.results.get(True, 0.1)
+            except:
+                # If the worker died without telling us, there's nothing left
+                # to wait for.
+                try:
+                    pid, status = os.waitpid(self.pid, os.WNOHANG)
+                except OSError:
+                    pid = self.pid
+                if pid:
+                    self.pid = 0
+                    for fetch in self.pending.values():
+                        self.log_func("Parser died while updating %s" %\
+                                fetch.fd.URL)
+                    self.pending = {}
+                    return
+                continue
+
+            if r[0] == None:
+                return
+
+            fetch = self.pending.pop(r[0])
+            if r[1] != None:
+                try:
+                    self.done(fetch, r[1])
+                except:
+                    self.log_func("Exception updating %s : %s" %\
+                            (fetch.fd.URL, traceback.format_exc()))
+
+    def close(self):
+        if self.pid:
+            self.jobs.put((None,))
+        self.thread.join()
+        if self.pid:
+            os.waitpid(self.pid, 0)
+            self.pid = 0
+        self.jobs.close()
+        self.results.close()
+
+    def kill(self):
+        if self.pid:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+class ParsePool():
+    def __init__(self, processes, work, done, log_func):
+        self.lock = Lock()
+        self.procs = []
+        for i in xrange(processes):
+            self.procs.append(ParseProcess(work, done, log_func))
+        for proc in self.procs:
+            proc.start()
+
+    # Jobs go to the process with the least outstanding work.
+
+    def submit(self, fetch, job):
+        self.lock.acquire()
+        try:
+            proc = self.procs[0]
+            for p in self.procs[1:]:
+                if len(p.pending) < len(proc.pending):
+                    proc = p
+            proc.submit(fetch, job)
+        finally:
+            self.lock.release()
+
+    # close waits for all of the submitted jobs to be done.
+
+    def close(self):
+        for proc in self.procs:
+            proc.close()
+
+    def kill(self):
+        for proc in self.procs:
+            proc.kill()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# A StateFile is one of the tables canto-fetch keeps about feeds in the feed
+# directory (see fetch_backoff.py and fetch_checked.py), one tab separated line
+# per key. It's loaded whole when it's created, and replaced in one go when
+# it's saved (see storage.replace), but only if something changed, so an
+# update that had nothing to do doesn't write anything.
+#
+# Subclasses say how a line is read (parse returns (key, value), or None for a
+# line that doesn't belong), how it's written (format) and which feed a key
+# belongs to (feed, or None if it doesn't belong to one), so that feeds that
+# are gone from the config are forgotten. Anything that changes state holds
+# the lock and sets dirty.
+
+from threading import Lock
+import storage
+
+class StateFile():
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.state = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            f = open(self.path, "r")
+        except IOError:
+            return
+
+        try:
+            for line in f:
+                try:
+                    item = self.parse(line.rstrip("\n").split("\t"))
+                except ValueError:
+                    continue
+                if item:
+                    self.state[item[0]] = item[1]
+        finally:
+            f.close()
+
+    # save writes out the state, forgetting feeds that aren't in URLs anymore.
+
+    def save(self, URLs):
+        URLs = dict.fromkeys(URLs)
+
+        self.lock.acquire()
+        try:
+            lines = []
+            for key, value in self.state.items():
+                URL = self.feed(key)
+                if URL != None and URL not in URLs:
+                    del self.state[key]
+                    self.dirty = True
+                else:
+                    lines.append(self.format(key, value))
+
+            if not self.dirty:
+                return
+            self.dirty = False
+        finally:
+            self.lock.release()
+
+        storage.replace(self.path, "".join(lines))
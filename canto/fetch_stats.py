@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Canto-fetch keeps a breakdown of where the time went the last time each feed
+# was fetched in .stats in the feed directory, and canto-fetch --stats prints
+# it out, slowest feeds first.
+#
+# The file is tab separated, one line per feed, with a header line (starting
+# with #) naming the columns:
+#
+#       URL, time of the fetch, total, then everything in FIELDS
+#
+# Times are in seconds. Bytes is the size of the body as it was downloaded,
+# decoded is its size after decompression (the same, if it wasn't compressed).
+# Total is the sum of the timings, which isn't the same as
+# the wall clock time of the fetch since feeds spend time waiting on their host
+# or for a parser. Fields that don't apply to a fetch (i.e. parse time for a
+# feed that hadn't changed) are 0.
+
+import storage
+
+import time
+
+TIMINGS = ["dns", "connect", "ttfb", "download", "parse", "normalize",
+        "merge", "lock", "write"]
+
+COUNTS = ["bytes", "decoded", "entries", "new"]
+
+FIELDS = TIMINGS + COUNTS
+
+def load(path):
+    stats = {}
+    try:
+        f = open(path, "r")
+    except IOError:
+        return stats
+
+    try:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            values = line.rstrip("\n").split("\t")
+            if len(values) != len(FIELDS) + 3:
+                continue
+            try:
+                stats[values[0]] = [float(values[1]), float(values[2])] +\
+                        [ float(v) for v in values[3:] ]
+            except ValueError:
+                continue
+    finally:
+        f.close()
+    return stats
+
+# record adds the stats of the feeds that were just fetched (a dict of
+# URL -> stats dict) to the file, forgetting any feeds no longer in URLs. The
+# file is replaced in one go, so readers never see half of it.
+
+def record(path, fetched, URLs):
+    stats = load(path)
+
+    now = time.time()
+    for URL, s in fetched.items():
+        total = 0
+        for key in TIMINGS:
+            total += s.get(key, 0)
+        stats[URL] = [now, total] + [ s.get(key, 0) for key in FIELDS ]
+
+    lines = ["#" + "\t".join(["url", "time", "total"] + FIELDS) + "\n"]
+    for URL in URLs:
+        if URL in stats:
+            lines.append("\t".join([URL] +\
+                    [ "%.4f" % v for v in stats[URL][:len(TIMINGS) + 2] ] +\
+                    [ "%d" % v for v in stats[URL][len(TIMINGS) + 2:] ])\
+                    + "\n")
+
+    storage.replace(path, "".join(lines))
+
+# report prints the table for --stats. Times are in milliseconds to keep the
+# columns narrow.
+
+def report(path):
+    stats = load(path)
+    if not stats:
+        print "No fetch stats recorded yet."
+        return
+
+    print "%7s " % "total" +\
+            " ".join([ "%7s" % k for k in TIMINGS ]) +\
+            " %9s %9s %7s %5s  %s" % ("bytes", "decoded", "entries", "new",
+                    "feed")
+
+    rows = stats.items()
+    rows.sort(lambda a, b: cmp(b[1][1], a[1][1]))
+    for URL, values in rows:
+        times = values[1:len(TIMINGS) + 2]
+        counts = values[len(TIMINGS) + 2:]
+        print " ".join([ "%7d" % (v * 1000) for v in times ]) +\
+                " %9d %9d %7d %5d  %s" % (counts[0], counts[1], counts[2],
+                        counts[3], URL)
@@ -35,6 +35,7 @@ from gui import Gui
 
 import canto_fetch
 import utility
+import notify
 import args
 import tag
 
@@ -161,17 +162,17 @@ class Main():
             self.cfg.log("Pausing to update...")
             canto_fetch.run(self.cfg, True, True)
 
-        # Detect if there are any new feeds by whether their
-        # set path exists. If not, run canto-fetch but don't
+        # Detect if there are any new feeds by whether they're
+        # in the store yet. If not, run canto-fetch but don't
         # force it, so canto-fetch intelligently updates.
 
         for i,f in enumerate(self.cfg.feeds) :
-            if not os.path.exists(f.path):
+            if not self.cfg.store.exists(f.path):
                 self.cfg.log("Detected unfetched feed: %s." % f.URL)
                 canto_fetch.run(self.cfg, True, False)
 
                 #Still no go?
-                if not os.path.exists(f.path):
+                if not self.cfg.store.exists(f.path):
                     self.cfg.log("Failed to fetch %s, removing" % f.URL)
                     self.cfg.feeds[i] = None
                 else:
@@ -274,6 +275,10 @@ class Main():
         for f in self.cfg.feeds:
             del f[:]
 
+        # Listen for canto-fetch telling us which feeds it's changed.
+
+        self.notify = notify.Listener(self.cfg.feed_dir)
+
         signal.signal(signal.SIGCHLD, self.chld)
         self.update(1, self.cfg.feeds, PROC_BOTH)
 
@@ -371,6 +376,15 @@ class Main():
                     if "signal" in self.cfg.triggers:
                         self.update()
 
+                # Feeds canto-fetch has changed are updated as they come in,
+                # so the interval updates can be few and far between (see
+                # tick()).
+
+                changed = self.notify.changed()
+                if changed and "interval" in self.cfg.triggers:
+                    self.update(0, [ f for f in self.cfg.feeds\
+                            if f.URL in changed ])
+
                 # Get the key
                 k = self.cfg.stdscr.getch()
 
@@ -406,6 +420,7 @@ class Main():
                                 old.append((gf, tf, s, l))
 
                             feed.merge(r[2])
+                            feed.seq, feed.mtime = r[5]
 
                             new = []
                             for gf, tf, s, l in r[3]:
@@ -484,6 +499,8 @@ class Main():
         # Kill the message log
         self.cfg.msg = None
 
+        self.notify.close()
+
         # Kill curses
         if not self.restart:
             try:
@@ -553,13 +570,20 @@ class Main():
     # valid update trigger), and one for the message box at the bottom of the
     # interface so that messages don't persist for very long.
 
+    # If canto-fetch can tell us what's changed, the feeds it changed are
+    # reread as soon as it does, so every feed only has to be reread once in a
+    # while, in case a notification went missing.
+
     def tick(self, refilter=0):
         # Possible update tick
         self.ticks -= 1
         if self.ticks <= 0:
             if "interval" in self.cfg.triggers:
                 self.update(0, self.cfg.feeds)
-            self.ticks = 60
+            if self.notify.sock:
+                self.ticks = notify.REREAD_TICKS
+            else:
+                self.ticks = 60
 
         # Message tick
         self.cfg.msg_tick -= 1
@@ -617,7 +641,7 @@ class Main():
                       self.cfg.all_filters.index(t.filters.cur()),\
                       self.cfg.all_sorts.index(t.sorts.cur()))\
                       for t in self.cfg.tags.cur()],\
-                      refilter))
+                      refilter, (f.seq, f.mtime)))
 
             for s in f.changed():
                 s.updated = STORY_QD
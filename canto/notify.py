@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Canto-fetch tells running clients which feeds it changed, so that they only
+# have to reread those from disk, instead of rereading every feed every minute
+# on the off chance that something changed.
+#
+# Each client binds a Unix datagram socket in .clients in the feed directory,
+# named after its pid. At the end of a run, canto-fetch sends every socket in
+# there the URLs of the feeds it wrote, one per line. Sockets that nobody is
+# listening on anymore (i.e. the client crashed) are removed.
+#
+# Datagrams are used so that canto-fetch never has to wait on a client, and so
+# a client can just check for them without blocking whenever it's idle.
+
+import socket
+import errno
+import os
+
+# URLs are packed into datagrams of about this size, well under the limits of
+# any platform.
+
+PACKET_SIZE = 4096
+
+# The largest datagram we'll take, in case a single URL is bigger than
+# PACKET_SIZE.
+
+MAX_PACKET = 65536
+
+# Notifications can go missing (a full socket buffer, a canto-fetch that
+# couldn't send them, a feed written by something else), so clients that get
+# them still reread every feed, just this much less often than every minute.
+
+REREAD_TICKS = 600
+
+def client_dir(feed_dir):
+    return feed_dir + ".clients/"
+
+class Listener():
+    def __init__(self, feed_dir):
+        self.sock = None
+        self.path = None
+
+        # If the socket can't be made (the path is too long for a Unix socket,
+        # for example), the client just goes without.
+
+        path = client_dir(feed_dir) + "%d" % os.getpid()
+        try:
+            if not os.path.exists(client_dir(feed_dir)):
+                os.mkdir(client_dir(feed_dir))
+            if os.path.exists(path):
+                os.unlink(path)
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(0)
+            sock.bind(path)
+        except (OSError, socket.error):
+            return
+
+        self.sock = sock
+        self.path = path
+
+    # changed returns the URLs of the feeds that canto-fetch has changed since
+    # the last call, if any.
+
+    def changed(self):
+        URLs = []
+        if not self.sock:
+            return URLs
+
+        while 1:
+            try:
+                data = self.sock.recv(MAX_PACKET)
+            except socket.error:
+                break
+            for line in data.split("\n"):
+                if line:
+                    URL = unicode(line, "UTF-8", "ignore")
+                    if URL not in URLs:
+                        URLs.append(URL)
+        return URLs
+
+    def close(self):
+        if not self.sock:
+            return
+        self.sock.close()
+        self.sock = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+def packets(URLs):
+    packets = []
+    packet = ""
+    for URL in URLs:
+        if type(URL) == unicode:
+            URL = URL.encode("UTF-8")
+        if packet and len(packet) + len(URL) + 1 > PACKET_SIZE:
+            packets.append(packet)
+            packet = ""
+        packet += URL + "\n"
+    if packet:
+        packets.append(packet)
+    return packets
+
+# notify sends URLs to every client. A client that's too busy to take them
+# within a second misses out this time, since canto-fetch shouldn't hang on a
+# wedged client.
+
+def notify(feed_dir, URLs, log_func):
+    if not URLs:
+        return
+
+    try:
+        names = os.listdir(client_dir(feed_dir))
+    except OSError:
+        return
+
+    data = packets(URLs)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.settimeout(1)
+    try:
+        for name in names:
+            path = client_dir(feed_dir) + name
+            try:
+                for packet in data:
+                    sock.sendto(packet, path)
+            except socket.timeout:
+                log_func("Client %s busy, not notified." % name)
+            except socket.error, e:
+                if e[0] in [errno.ECONNREFUSED, errno.ENOENT,\
+                        errno.ENOTSOCK]:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+    finally:
+        sock.close()
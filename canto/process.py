@@ -40,13 +40,17 @@
 #       collisions resolved)
 #
 #   (PROC_FILTER / PROCESS_BOTH , URL, old items, global filter index,
-#       [tag_info], refilter) performs the filtering/sorting (in addition to
-#       update for BOTH) this is the most common full update. PROC_FILTER is
-#       only used after PROC_UPDATE early on. [tag_info] is a list of one tuple
-#       per tag containing:
+#       [tag_info], refilter, (seq, mtime)) performs the filtering/sorting (in
+#       addition to update for BOTH) this is the most common full update.
+#       PROC_FILTER is only used after PROC_UPDATE early on. [tag_info] is a
+#       list of one tuple per tag containing:
 #
 #         (tag string, tag filter index, tag sort index)
 #
+#       (seq, mtime) says which version of the feed on disk the old items came
+#       from, so only what canto-fetch has changed since needs to be read
+#       (see changelog.py).
+#
 #   (PROC_FLUSH, ) This essentially serves as a marker in the pipe that's
 #       returned verbatim when the worker thread receives it. In practice, the
 #       ProcessHandler's flush() call puts it into the pipe and discards any
@@ -66,7 +70,7 @@
 # Most of the return tuples are self-explanatory. The most common return from
 # PROC_BOTH looks like this:
 #
-#       (URL, stories, newdiff, olddiff)
+#       (URL, stories, newdiff, olddiff, (seq, mtime))
 #
 # Where both diffs are arrays that match up with all of the currently used tags.
 # For each tag, the diff contains
@@ -341,6 +345,15 @@ class ProcessHandler(object):
             if action >= PROC_UPDATE:
                 feed = [ f for f in feeds if f.URL == args[0] ][0]
                 feed.merge(args[1])
+
+                # The items are only good for the feed as it was when the
+                # interface got them (see feed.update).
+
+                if action == PROC_UPDATE:
+                    feed.seq, feed.mtime = 0, None
+                else:
+                    feed.seq, feed.mtime = args[5]
+
                 if not feed.update():
                     send((PROC_DEQD, feed.URL))
                     continue
@@ -423,7 +436,8 @@ class ProcessHandler(object):
                     odiff[i] = (filter, tf, ts, odiff[i])
 
                 # Step 6: Queue up the results for the interface process.
-                send((PROC_UPDATE, feed.URL, feed[:], ndiff, odiff))
+                send((PROC_UPDATE, feed.URL, feed[:], ndiff, odiff,
+                    (feed.seq, feed.mtime)))
 
             if action > PROC_UPDATE:
                 del feed[:]
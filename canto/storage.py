@@ -0,0 +1,1609 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Everything that reads or writes feeds on disk (canto-fetch's FetchThread, and
+# the client's Feed and Story) goes through a store, chosen with the
+# feed_storage setting. Feeds are still named by the path of their file in the
+# feed directory (feed_dir + URL with / replaced by _), whether or not that
+# file is actually used.
+#
+# PickleStore is the traditional format, one file of cPickles per feed. Reading
+# one entry doesn't mean reading the whole file (see INDEX below) and neither
+# does changing the state of a few (see JOURNAL_SIZE). Files are only ever
+# replaced whole, so reading doesn't need a lock (see PickleStore.writelock).
+# The bodies of entries are kept apart from the feeds, once for every feed
+# that has them (see BlobStore).
+#
+# SQLiteStore keeps every feed in one database (.feeds.db in the feed
+# directory) with three tables, feeds (everything but the entries), entries
+# and states, so that the state of an entry can be changed, or an entry read,
+# with one indexed lookup. It needs the sqlite3 module (Python 2.5+). Feeds
+# that are still in pickles are moved into the database the next time
+# canto-fetch loads or writes them.
+#
+# Both stores keep an mtime for each feed, which changes on every write, so
+# writers can tell whether the feed changed since they read it and readers can
+# tell whether the change log (see changelog.py) is current. For PickleStore,
+# it's the generation of the file (see FORMAT) along with the length of its
+# journal.
+
+from feedparser_builtin import FeedParserDict
+import changelog
+
+from threading import local, Lock
+import cPickle
+import hashlib
+import copy
+import tempfile
+import fcntl
+import time
+import os
+import gc
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# syncfs (Linux 2.6.39+) flushes a whole filesystem in one call, which is
+# what BlobStore.sync wants. Elsewhere, it syncs the blobs one at a time.
+
+try:
+    import ctypes
+    syncfs = ctypes.CDLL(None).syncfs
+except:
+    syncfs = None
+
+# The format of feed files is versioned:
+#
+#   0 - a single pickle of the whole feedparser dict, so the reader had to
+#       unpickle every entry in the feed to show one of them.
+#
+#   1 - each entry is pickled separately, after a header that indexes them:
+#
+#       (MAGIC, 1, generation)
+#       [SHA-1 of every blob the file refers to, ...]
+#       [(INDEX, offset, length), (id, offset, length), ...]
+#       the feed, without its entries
+#       the entries, in order
+#
+#       Every time the file is replaced, the new one is the next generation
+#       (version 0 files are generation 0). It comes first, so it can be read
+#       on its own. The blobs are the long texts of the entries, which are
+#       kept in the blob store (see BLOB). Offsets are from the end of the
+#       index. The feed itself comes first, its entry in the index has the id
+#       INDEX.
+#
+#       Everything is pickled with the binary protocol 2, as plain dicts and
+#       lists. Unpickling a FeedParserDict goes through its __setitem__ for
+#       every key, which made loads slower than the old text pickles, so only
+#       the feed, its "feed" and its entries are made FeedParserDicts again
+#       when they're loaded (they're what feedparser's aliases, like
+#       "description", are used on).
+#
+# The version is in the header, rather than in canto_version, so it can be
+# told without unpickling the feed. Old files are read as they are. Only
+# canto-fetch rewrites them in the current format, when it loads them (or, if
+# someone else is writing the feed, the next time it writes it). The client
+# leaves them alone.
+
+MAGIC = "canto-feed"
+FORMAT = 1
+
+INDEX = "canto-index-1"
+
+# plain turns FeedParserDicts back into dicts, all the way down.
+
+def plain(obj):
+    if isinstance(obj, dict):
+        return dict([ (k, plain(v)) for k, v in obj.iteritems() ])
+    if type(obj) == list:
+        return [ plain(v) for v in obj ]
+    return obj
+
+# unpickle works around old pickles that refer to the feedparser module, which
+# canto no longer installs.
+
+def unpickle(data):
+    try:
+        return cPickle.loads(data)
+    except ImportError:
+
+        # Fortunately, I don't think forcing the cpickle
+        # to use feedparser_builtin is harmful, since they're
+        # basically the same class, feedparser_builtin is just the
+        # only way to properly look up the toplevel module now.
+
+        data = data.replace("feedparser\n","feedparser_builtin\n",1)
+        return cPickle.loads(data)
+
+# The client used to save the state of entries by loading the whole feed,
+# changing their canto_state and writing it all back out, for every few items
+# read. Now the states are appended to a journal (in .journal in the feed
+# directory, under the same name as the feed). It starts with the generation
+# of the feed file it goes with, followed by one pickle per update_states:
+#
+#       [(id, canto_state), ...]
+#
+# Anything that loads the feed plays the journal back over it, later states
+# winning. Whenever the whole feed is written (canto-fetch's writes, or once
+# the journal gets bigger than JOURNAL_SIZE bytes) the states are folded into
+# it and the journal is removed. A journal for another generation has already
+# been folded into the feed, and is ignored. The journal is only changed with
+# the feed's write lock held.
+
+JOURNAL_SIZE = 65536
+
+# In one update, the client could read the same feed file several times: the
+# whole feed to update it, the states of the items it changed to save them, and
+# entries one at a time for any Story item that wasn't precached (i.e. for a
+# sort or filter on the content). Every PickleStore keeps what it's read, for
+# as long as the file doesn't change, in a cache shared by everything in the
+# process that uses the store.
+#
+# Files are identified by their generation, the length of their journal and
+# their inode (in case a feed was removed and added again). The cache holds up
+# to CACHE_SIZE bytes worth of feed files (for partially read feeds, just the
+# parts that were read), dropping the least recently used feeds first.
+#
+# Callers change what they get from the store (a Story's canto_state is the
+# entry's list, for example), so they're given copies of the entries and their
+# states. Nothing changes the rest of an entry, so that's shared.
+
+CACHE_SIZE = 16 * 1024 * 1024
+
+# The same article often turns up in several feeds (planets, cross-posts), and
+# its text is most of what a feed file holds. So, the texts in the fields of
+# entries in BLOB_FIELDS (and the values in their details and content) that
+# are at least BLOB_SIZE characters long are kept in the blob store (.blobs in
+# the feed directory) instead, one file per text, named by its SHA-1 and
+# written once, however many feeds have it. In the feed file, the text is
+# replaced by
+#
+#       (BLOB, SHA-1)
+#
+# Shorter texts stay where they are, they'd take up more room as files of
+# their own than they would inline.
+#
+# Nothing but the store ever sees a reference. Both load and entry put the
+# texts back, unless load is told not to (canto-fetch, which only ever writes
+# the old entries back out, and the client, which only keeps a few fields of
+# each entry, and asks for them with resolve).
+#
+# Blobs aren't counted as they're written, since a writer that's killed, or
+# loses the race to replace a feed, would leave the counts wrong. Instead,
+# prune counts the references to each blob from every feed file and removes
+# the blobs that nobody refers to, once they're old enough that nobody could
+# be writing a feed that does.
+
+BLOB = "canto-blob"
+BLOB_SIZE = 4096
+BLOB_FIELDS = ["summary", "summary_detail", "content"]
+
+def is_ref(value):
+    return type(value) == tuple and len(value) == 2 and value[0] == BLOB
+
+def copy_entry(entry):
+    c = FeedParserDict(entry)
+
+    # FeedParserDict's "in" is painfully slow.
+
+    if dict.__contains__(c, "canto_state"):
+        dict.__setitem__(c, "canto_state",
+                list(dict.__getitem__(c, "canto_state")))
+    return c
+
+def copy_feed(feed):
+    c = copy_entry(feed)
+    dict.__setitem__(c, "entries",
+            [ copy_entry(e) for e in dict.__getitem__(feed, "entries") ])
+    return c
+
+# mkstemp makes a new file in dir, to be renamed into place. tempfile only lets
+# its owner read it, but feeds used to be written with open(), so anyone the
+# umask allows to (i.e. other users sharing a feed directory) could read them,
+# and still should.
+#
+# The umask can only be read by setting it, which would change it for every
+# thread in the process for a moment, so it's only read once.
+
+umask = []
+umask_lock = Lock()
+
+def mkstemp(dir):
+    umask_lock.acquire()
+    try:
+        if not umask:
+            umask.append(os.umask(0))
+            os.umask(umask[0])
+    finally:
+        umask_lock.release()
+
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=dir)
+    try:
+        os.chmod(tmp, 0666 & ~umask[0])
+    except:
+        os.close(fd)
+        os.unlink(tmp)
+        raise
+    return (fd, tmp)
+
+# replace writes data over the file at path in one go, by writing it to a new
+# file next to it and renaming that into place, so that readers (which don't
+# lock) see either the old file or the new one, whole. Nothing is synced, that's
+# up to the caller, if it matters. It returns whether the file was written.
+
+def replace(path, data):
+    dir = os.path.dirname(path)
+    try:
+        if not os.path.exists(dir):
+            os.mkdir(dir)
+        fd, tmp = mkstemp(dir)
+    except (IOError, OSError):
+        return False
+
+    try:
+        f = os.fdopen(fd, "w")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        return False
+    return True
+
+# A CachedFeed is either the whole feed (feed is set) or the index of the file
+# (index maps ids to where their entries are, from base) along with whatever
+# entries have been read. Either way, entries maps each id to the first entry
+# with it, with its state from the journal.
+
+class CachedFeed():
+    def __init__(self, key, version, feed=None, index=None, base=0):
+        self.key = key
+        self.version = version
+        self.feed = feed
+        self.index = index
+        self.base = base
+        self.entries = {}
+        self.journal = None
+        self.size = 0
+
+        if feed != None:
+            for entry in feed["entries"]:
+                if entry["id"] not in self.entries:
+                    self.entries[entry["id"]] = entry
+
+class Cache():
+    def __init__(self, limit):
+        self.limit = limit
+        self.records = {}
+
+        # Paths, least recently used first.
+        self.order = []
+        self.size = 0
+
+        # Canto-fetch's threads share the store.
+        self.lock = Lock()
+
+    # get returns the record for fpath, if it's for the file as it is now.
+
+    def get(self, fpath, key):
+        self.lock.acquire()
+        try:
+            if fpath not in self.records:
+                return None
+            if self.records[fpath].key != key:
+                self.remove(fpath)
+                return None
+            self.order.remove(fpath)
+            self.order.append(fpath)
+            return self.records[fpath]
+        finally:
+            self.lock.release()
+
+    def put(self, fpath, record, size):
+        self.lock.acquire()
+        try:
+            self.remove(fpath)
+            if size > self.limit:
+                return
+            record.size = size
+            self.records[fpath] = record
+            self.order.append(fpath)
+            self.size += size
+            self.evict()
+        finally:
+            self.lock.release()
+
+    # grow accounts for another entry read into a record.
+
+    def grow(self, fpath, record, size):
+        self.lock.acquire()
+        try:
+            if self.records.get(fpath) is record:
+                record.size += size
+                self.size += size
+                self.evict()
+        finally:
+            self.lock.release()
+
+    # rekey updates a record after states were added to the file's journal.
+
+    def rekey(self, fpath, record, key, states):
+        self.lock.acquire()
+        try:
+            if self.records.get(fpath) is not record:
+                return
+            record.key = key
+            for id, state in states.items():
+                if id in record.entries:
+                    record.entries[id]["canto_state"] = list(state)
+                if record.journal != None:
+                    record.journal[id] = list(state)
+        finally:
+            self.lock.release()
+
+    def drop(self, fpath):
+        self.lock.acquire()
+        try:
+            self.remove(fpath)
+        finally:
+            self.lock.release()
+
+    # remove and evict expect the lock to be held.
+
+    def remove(self, fpath):
+        if fpath in self.records:
+            self.size -= self.records[fpath].size
+            del self.records[fpath]
+            self.order.remove(fpath)
+
+    def evict(self):
+        while self.size > self.limit and self.order:
+            self.remove(self.order[0])
+
+class BlobStore():
+    def __init__(self, feed_dir):
+        self.dir = feed_dir + ".blobs/"
+
+        # The paths of the blobs that have been put, but not synced yet. The
+        # lock is held until they are, see sync.
+
+        self.unsynced = []
+        self.lock = Lock()
+
+    # Blobs are spread over 256 directories, by the first two digits of their
+    # SHA-1, so that no one directory gets too big.
+
+    def path(self, digest):
+        return self.dir + digest[:2] + "/" + digest[2:]
+
+    # put stores a text, if it isn't stored already, and returns the
+    # reference to it. A blob that's already there is touched, so that prune
+    # doesn't take it out from under the feed that's about to refer to it.
+    #
+    # Blobs are written with replace, so a blob is either whole or not there
+    # at all. They aren't synced to disk one by one,
+    # a feed full of new entries would wait on every one of them. Instead,
+    # everything that refers to them calls sync before it's written.
+
+    def put(self, text):
+        data = text.encode("UTF-8")
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.path(digest)
+
+        try:
+            os.utime(path, None)
+            return (BLOB, digest)
+        except OSError:
+            pass
+
+        if not os.path.exists(self.dir):
+            try:
+                os.mkdir(self.dir)
+            except OSError:
+                pass
+
+        if not replace(path, data):
+            raise IOError, "Couldn't write blob %s" % digest
+
+        self.lock.acquire()
+        try:
+            self.unsynced.append(path)
+        finally:
+            self.lock.release()
+        return (BLOB, digest)
+
+    # sync makes sure every blob that's been put is on disk, along with the
+    # directories they were renamed into, all at once. Whoever's syncing holds
+    # the lock until they're done, so nobody else can think the blobs they
+    # put are on disk while they're still being synced.
+
+    def sync(self):
+        self.lock.acquire()
+        try:
+            if not self.unsynced:
+                return
+
+            if syncfs:
+                fd = os.open(self.dir, os.O_RDONLY)
+                try:
+                    synced = syncfs(fd) == 0
+                finally:
+                    os.close(fd)
+            else:
+                synced = False
+
+            if not synced:
+                dirs = { self.dir : True }
+                for path in self.unsynced:
+                    dirs[os.path.dirname(path)] = True
+                for path in self.unsynced + dirs.keys():
+                    try:
+                        fd = os.open(path, os.O_RDONLY)
+                    except OSError:
+                        continue
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+
+            self.unsynced = []
+        finally:
+            self.lock.release()
+
+    # get returns the text of a blob. One that's gone missing (i.e. someone
+    # removed .blobs) comes back empty, rather than taking the feed with it.
+
+    def get(self, digest):
+        try:
+            f = open(self.path(digest), "r")
+        except IOError:
+            return u""
+        try:
+            return unicode(f.read(), "UTF-8", "replace")
+        finally:
+            f.close()
+
+    # take replaces the long texts in the value of a field (of an entry
+    # that's about to be dumped, so it can be changed) with references,
+    # putting them in the store, and adds the blobs it refers to to refs.
+    # written remembers what's already been put during this dump, the
+    # summary and its detail are usually the same text.
+
+    def take(self, value, refs, written):
+        if type(value) == unicode:
+            if len(value) < BLOB_SIZE:
+                return value
+            if value not in written:
+                written[value] = self.put(value)
+            value = written[value]
+            refs[value[1]] = True
+        elif is_ref(value):
+            refs[value[1]] = True
+        elif isinstance(value, dict):
+            if "value" in value:
+                value["value"] = self.take(value["value"], refs, written)
+        elif type(value) == list:
+            value = [ self.take(v, refs, written) for v in value ]
+        return value
+
+    # resolve returns the value of a field with the texts it refers to put
+    # back. Values are shared with the cache, so the parts that refer to blobs
+    # are copied, never changed.
+
+    def resolve(self, value):
+        if is_ref(value):
+            return self.get(value[1])
+        if isinstance(value, dict):
+            if "value" in value and is_ref(value["value"]):
+                value = copy.copy(value)
+                value["value"] = self.get(value["value"][1])
+        elif type(value) == list:
+            value = [ self.resolve(v) for v in value ]
+        return value
+
+    # find adds the blobs a value refers to to refs.
+
+    def find(self, value, refs):
+        if is_ref(value):
+            refs[value[1]] = refs.get(value[1], 0) + 1
+        elif isinstance(value, dict):
+            if "value" in value:
+                self.find(value["value"], refs)
+        elif type(value) == list:
+            for v in value:
+                self.find(v, refs)
+
+    # resolve_entry resolves the fields of an entry (a copy, see copy_entry)
+    # in place, and returns it.
+
+    def resolve_entry(self, entry):
+        for field in BLOB_FIELDS:
+            if dict.__contains__(entry, field):
+                dict.__setitem__(entry, field,
+                        self.resolve(dict.__getitem__(entry, field)))
+        return entry
+
+    # collect removes the blobs that aren't in refs (a dict of SHA-1 -> the
+    # number of feed files and change logs that refer to it) and are more than
+    # an hour old, along with anything left over from a put that was killed.
+    # It returns the number of blobs removed.
+
+    def collect(self, refs):
+        if not os.path.isdir(self.dir):
+            return 0
+
+        removed = 0
+        for sub in os.listdir(self.dir):
+            dir = self.dir + sub + "/"
+            if not os.path.isdir(dir):
+                continue
+            for file in os.listdir(dir):
+                if file.startswith(".tmp-"):
+                    blob = False
+                elif sub + file not in refs:
+                    blob = True
+                else:
+                    continue
+                try:
+                    if time.time() - os.stat(dir + file).st_mtime > 3600:
+                        os.unlink(dir + file)
+                        if blob:
+                            removed += 1
+                except OSError:
+                    pass
+        return removed
+
+class PickleStore():
+    def __init__(self, feed_dir):
+        self.feed_dir = feed_dir
+        self.cache = Cache(CACHE_SIZE)
+        self.blobs = BlobStore(feed_dir)
+
+    def exists(self, fpath):
+        return os.path.exists(fpath)
+
+    def journal(self, fpath):
+        head, tail = os.path.split(fpath)
+        return os.path.join(head, ".journal", tail)
+
+    def lockpath(self, fpath):
+        head, tail = os.path.split(fpath)
+        return os.path.join(head, ".locks", tail)
+
+    # Feed files are never changed in place. The new feed is written to a file
+    # next to it, synced to disk and renamed over it, so anyone that has the
+    # feed open keeps reading the old file, whole, and readers never have to
+    # lock anything.
+    #
+    # Writers still have to take turns, so that one doesn't replace what
+    # another just wrote without having seen it. They lock the feed's file in
+    # .locks in the feed directory, but only for as long as it takes to check
+    # that the feed is still the generation they read (or to add to the
+    # journal) and rename the new file into place. If given, timed is called
+    # with ("lock", when we started waiting) once the lock is held, for
+    # canto-fetch's stats.
+
+    def writelock(self, fpath, block=True, timed=None):
+        lpath = self.lockpath(fpath)
+        if not os.path.exists(os.path.dirname(lpath)):
+            try:
+                os.mkdir(os.path.dirname(lpath))
+            except OSError:
+                pass
+
+        lockflags = fcntl.LOCK_EX
+        if not block:
+            lockflags |= fcntl.LOCK_NB
+
+        f = open(lpath, "a")
+        try:
+            start = time.time()
+            fcntl.flock(f.fileno(), lockflags)
+        except:
+            f.close()
+            raise
+        if timed:
+            timed("lock", start)
+        return f
+
+    def unlock(self, f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+    # prepare writes the feed as the given generation to a new file in the same
+    # directory (so it can be renamed over the feed) and returns its path. It
+    # doesn't need the lock, canto-fetch writes the feed out before it waits for
+    # it. The blobs the feed refers to are synced before it is.
+
+    def prepare(self, fpath, feed, gen):
+        fd, tmp = mkstemp(os.path.dirname(fpath))
+        try:
+            f = os.fdopen(fd, "w")
+            try:
+                self.dump(feed, gen, f)
+                self.blobs.sync()
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+        except:
+            self.discard(tmp)
+            raise
+        return tmp
+
+    def discard(self, tmp):
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+    # commit renames a prepared file over the feed, with the lock held. The
+    # feed's journal was played into it, so that goes, as does anything
+    # cached about the old file.
+
+    def commit(self, fpath, tmp):
+        os.rename(tmp, fpath)
+        self.clear(fpath)
+        self.cache.drop(fpath)
+
+    # snapshot calls work with the feed's file open and returns what it does,
+    # as long as the file wasn't replaced before work was done with it (and
+    # its journal). Otherwise, it tries again with the new file.
+
+    def snapshot(self, fpath, work):
+        while 1:
+            f = open(fpath, "r")
+            try:
+                r = work(f)
+                if os.fstat(f.fileno()).st_ino == os.stat(fpath).st_ino:
+                    return r
+            finally:
+                f.close()
+
+    # generation reads the generation of an open feed, and leaves the file
+    # after it. Version 0 files are generation 0.
+
+    def generation(self, f):
+        try:
+            h = cPickle.load(f)
+        except ImportError:
+            return 0
+        if type(h) == tuple and len(h) == 3 and h[0] == MAGIC:
+            return h[2]
+        return 0
+
+    # current returns the mtime of the feed, which is its generation and the
+    # length of its journal. Only writers, with the lock held, can be sure
+    # it's still the same when they're done with it.
+
+    def current(self, fpath):
+        f = open(fpath, "r")
+        try:
+            gen = self.generation(f)
+            return (gen, self.states(fpath, gen)[1])
+        finally:
+            f.close()
+
+    # states returns the states in the journal, as a dict of id ->
+    # canto_state, and how much of the journal they came from, if the journal
+    # goes with the given generation of the feed. If the last record was cut
+    # short (i.e. canto was killed while writing it, or it's being written
+    # now) it's ignored, and it's cut off before anything else is added.
+
+    def states(self, fpath, gen):
+        states = {}
+        try:
+            f = open(self.journal(fpath), "r")
+        except IOError:
+            return (states, 0)
+
+        try:
+            try:
+                if cPickle.load(f) != gen:
+                    return (states, 0)
+            except:
+                return (states, 0)
+            good = f.tell()
+
+            while 1:
+                try:
+                    record = cPickle.load(f)
+                except:
+                    break
+                for id, state in record:
+                    states[id] = state
+                good = f.tell()
+        finally:
+            f.close()
+        return (states, good)
+
+    # replay sets the states from the journal in the feed. Like update_states,
+    # only the first entry with a given id counts.
+
+    def replay(self, feed, states):
+        if not states:
+            return
+        seen = {}
+        for entry in feed["entries"]:
+            if entry["id"] in states and entry["id"] not in seen:
+                entry["canto_state"] = states[entry["id"]]
+                seen[entry["id"]] = True
+
+    # clear removes the journal, once the feed has been written with the states
+    # in it.
+
+    def clear(self, fpath):
+        try:
+            os.unlink(self.journal(fpath))
+        except OSError:
+            pass
+
+    # dump writes a feed to a file opened for writing, in the current format,
+    # putting the long texts of its entries in the blob store.
+
+    def dump(self, feed, gen, f):
+        rest = plain(feed)
+        entries = rest["entries"]
+        del rest["entries"]
+
+        pickles = [cPickle.dumps(rest, 2)]
+        index = [(INDEX, 0, len(pickles[0]))]
+        offset = len(pickles[0])
+
+        refs = {}
+        written = {}
+        for entry in entries:
+            for field in BLOB_FIELDS:
+                if field in entry:
+                    entry[field] = self.blobs.take(entry[field], refs, written)
+
+            pickles.append(cPickle.dumps(entry, 2))
+            index.append((entry["id"], offset, len(pickles[-1])))
+            offset += len(pickles[-1])
+
+        refs = refs.keys()
+        refs.sort()
+
+        cPickle.dump((MAGIC, FORMAT, gen), f, 2)
+        cPickle.dump(refs, f, 2)
+        cPickle.dump(index, f, 2)
+        f.write("".join(pickles))
+
+    # header reads the start of a feed file, returning (version, index, None)
+    # with the file at the end of the header, or (0, None, feed) for version 0
+    # files.
+    #
+    # cPickle.load only reads as much of a real file as it needs to, so this
+    # doesn't read any further than the header.
+
+    def header(self, f):
+        try:
+            h = cPickle.load(f)
+        except ImportError:
+            f.seek(0)
+            return (0, None, unpickle(f.read()))
+
+        if type(h) == tuple and len(h) == 3 and h[0] == MAGIC:
+            if h[1] > FORMAT:
+                raise Exception, "Feed written by a newer canto (format %d)"\
+                        % h[1]
+            cPickle.load(f)
+            return (h[1], cPickle.load(f), None)
+        return (0, None, h)
+
+    # refs returns the blobs an open feed file refers to. Version 0 files
+    # don't refer to any.
+
+    def refs(self, f):
+        try:
+            h = cPickle.load(f)
+        except ImportError:
+            return []
+        if type(h) == tuple and len(h) == 3 and h[0] == MAGIC:
+            return cPickle.load(f)
+        return []
+
+    # resolve returns the value of a field of an entry loaded without its
+    # blobs, as it would have been loaded with them.
+
+    def resolve(self, value):
+        return self.blobs.resolve(value)
+
+    # refer returns a copy of an entry with its long texts replaced by
+    # references, as dump would write it, for the change log.
+
+    def refer(self, entry):
+        entry = copy_entry(entry)
+        refs = {}
+        written = {}
+        for field in BLOB_FIELDS:
+            if dict.__contains__(entry, field):
+                dict.__setitem__(entry, field, self.blobs.take(
+                    plain(dict.__getitem__(entry, field)), refs, written))
+        return entry
+
+    # handout returns a copy of a feed for the caller, with its blobs, if
+    # asked.
+
+    def handout(self, feed, blobs):
+        feed = copy_feed(feed)
+        if blobs:
+            for entry in dict.__getitem__(feed, "entries"):
+                self.blobs.resolve_entry(entry)
+        return feed
+
+    # piece unpickles the feed or an entry.
+
+    def piece(self, data):
+        return FeedParserDict(cPickle.loads(data))
+
+    # load returns the feed and its mtime. Readers don't lock, so block is only
+    # there for SQLiteStore, and timed isn't called. If blobs is False, the
+    # long texts of the entries are left as references (see BLOB). If upgrade
+    # is set (only by canto-fetch), an old file is rewritten in the current
+    # format.
+
+    def load(self, fpath, block=True, timed=None, blobs=True, upgrade=False):
+        def work(f):
+            gen = self.generation(f)
+            journal, good = self.states(fpath, gen)
+            key = (gen, good, os.fstat(f.fileno()).st_ino)
+            record = self.cache.get(fpath, key)
+            if record and record.feed != None:
+                return (key, record.version, record.feed, None)
+
+            f.seek(0)
+            version, feed = self.read(f, journal)
+            return (key, version, feed, os.fstat(f.fileno()).st_size)
+
+        key, version, feed, size = self.snapshot(fpath, work)
+        if size == None:
+            return (self.handout(feed, blobs), key[:2])
+
+        if upgrade and version < FORMAT:
+            upgraded = self.upgrade(fpath, feed, key[:2])
+            if upgraded:
+                key, version, size = upgraded
+
+        self.cache.put(fpath, CachedFeed(key, version, feed), size)
+        return (self.handout(feed, blobs), key[:2])
+
+    # read reads the whole feed from the start of its file and plays the
+    # journal's states over it, returning it with the version of the file.
+    #
+    # Unpickling a big feed makes a lot of objects, and nothing else, so the
+    # garbage collector (which would otherwise run over and over, finding
+    # nothing) is kept out of the way.
+
+    def read(self, f, journal):
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            version, index, feed = self.header(f)
+            if index != None:
+                data = f.read()
+                feed = self.piece(data[:index[0][2]])
+                if type(feed.get("feed", None)) == dict:
+                    feed["feed"] = FeedParserDict(feed["feed"])
+                feed["entries"] = [ self.piece(data[o:o + l])\
+                        for id, o, l in index[1:] ]
+        finally:
+            if enabled:
+                gc.enable()
+
+        self.replay(feed, journal)
+        return (version, feed)
+
+    # upgrade rewrites a feed that was read from an old file, unless someone
+    # else is writing it, or already has. It returns the cache key, version
+    # and size of the new file, or None.
+
+    def upgrade(self, fpath, feed, mtime):
+        try:
+            l = self.writelock(fpath, False)
+        except:
+            return None
+
+        try:
+            try:
+                if self.current(fpath) != mtime:
+                    return None
+                self.commit(fpath, self.prepare(fpath, feed, mtime[0] + 1))
+                st = os.stat(fpath)
+                return ((mtime[0] + 1, 0, st.st_ino), FORMAT, st.st_size)
+            except:
+                return None
+        finally:
+            self.unlock(l)
+
+    # changes returns what changelog.follow does, or [] if the feed hasn't been
+    # written since mtime.
+
+    def changes(self, fpath, seq, mtime):
+        def work(f):
+            gen = self.generation(f)
+            return (gen, self.states(fpath, gen)[1])
+
+        current = self.snapshot(fpath, work)
+        if current == mtime:
+            return []
+        return changelog.follow(fpath, seq, current)
+
+    # create writes a feed that doesn't exist yet.
+
+    def create(self, fpath, feed):
+        l = self.writelock(fpath)
+        try:
+            gen = 1
+            if os.path.exists(fpath):
+                try:
+                    gen = self.current(fpath)[0] + 1
+                except:
+                    pass
+            self.commit(fpath, self.prepare(fpath, feed, gen))
+        finally:
+            self.unlock(l)
+
+    # write replaces the feed and returns its new mtime, unless it was changed
+    # since prevtime (the mtime it had when it was loaded), in which case it
+    # returns None and doesn't touch it. log, if given, is called with the new
+    # mtime before anyone else can write the feed.
+    #
+    # The generation is what makes this work, so the new file is written as
+    # the next one before waiting for the lock, and only renamed into place if
+    # the feed is still at prevtime once we have it.
+
+    def write(self, fpath, feed, prevtime, log=None, timed=None):
+        tmp = None
+        if prevtime:
+            start = time.time()
+            gen = prevtime[0] + 1
+            tmp = self.prepare(fpath, feed, gen)
+            if timed:
+                timed("write", start)
+
+        try:
+            l = self.writelock(fpath, True, timed)
+            try:
+                if prevtime:
+                    if self.current(fpath) != prevtime:
+                        return None
+                else:
+                    gen = 1
+                    if os.path.exists(fpath):
+                        gen = self.current(fpath)[0] + 1
+                    tmp = self.prepare(fpath, feed, gen)
+
+                # The feed was loaded with the journal played back, and
+                # nothing's been added to it since (or its mtime would've
+                # changed), so the states are all in the new file.
+
+                self.commit(fpath, tmp)
+                tmp = None
+
+                mtime = (gen, 0)
+                if log:
+                    log(mtime)
+                return mtime
+            finally:
+                self.unlock(l)
+        finally:
+            if tmp:
+                self.discard(tmp)
+
+    # record returns the cache's record for an open file, reading the index
+    # into the cache if it isn't there.
+
+    def record(self, f, fpath, key, journal):
+        record = self.cache.get(fpath, key)
+        if record:
+            return record
+
+        f.seek(0)
+        version, index, feed = self.header(f)
+        if index == None:
+            self.replay(feed, journal)
+            record = CachedFeed(key, version, feed)
+            self.cache.put(fpath, record, os.fstat(f.fileno()).st_size)
+            return record
+
+        first = {}
+        for id, offset, length in index[1:]:
+            if id not in first:
+                first[id] = (offset, length)
+        record = CachedFeed(key, version, None, first, f.tell())
+        record.journal = journal
+        self.cache.put(fpath, record, f.tell())
+        return record
+
+    # cached_entry returns the (cache's own) entry with the given id from a
+    # record, reading it from the open file if it hasn't been yet, or None if
+    # there isn't one.
+
+    def cached_entry(self, f, fpath, record, id):
+        if id in record.entries:
+            return record.entries[id]
+        if record.feed != None or id not in record.index:
+            return None
+
+        offset, length = record.index[id]
+        f.seek(record.base + offset)
+        entry = self.piece(f.read(length))
+        if id in record.journal:
+            entry["canto_state"] = record.journal[id]
+
+        record.entries[id] = entry
+        self.cache.grow(fpath, record, length)
+        return entry
+
+    # update_states is how the client saves the state of entries. It looks up
+    # the states on disk of the entries with the given ids, hands them to
+    # merge (as a dict of id -> canto_state, missing entries that are no
+    # longer in the feed) and writes out the states that merge returns (in the
+    # same format). If the caller already has the feed, it can pass it (and
+    # its mtime) as loaded.
+    #
+    # It returns the mtime of the feed before and after, or None if the feed
+    # couldn't be written.
+
+    def update_states(self, fpath, ids, merge, loaded=None):
+        ids = dict.fromkeys(ids)
+        try:
+            l = self.writelock(fpath)
+        except:
+            return None
+
+        try:
+            try:
+
+                # We have the lock, so the feed can't change under us.
+
+                f = open(fpath, "r")
+                try:
+                    gen = self.generation(f)
+                    journal, good = self.states(fpath, gen)
+                    before = (gen, good)
+                    ino = os.fstat(f.fileno()).st_ino
+                    record = self.record(f, fpath, before + (ino,), journal)
+
+                    # A feed whose journal has grown too big is rewritten.
+
+                    compact = good > JOURNAL_SIZE
+
+                    feed = None
+                    if loaded and loaded[1] == before:
+                        feed = loaded[0]
+                    elif compact:
+                        f.seek(0)
+                        feed = self.read(f, journal)[1]
+
+                    states = {}
+                    if feed != None:
+                        for entry in feed["entries"]:
+                            if entry["id"] in ids and\
+                                    entry["id"] not in states:
+                                states[entry["id"]] = entry["canto_state"]
+                    else:
+                        for id in ids:
+                            entry = self.cached_entry(f, fpath, record, id)
+                            if entry:
+                                states[id] = list(entry["canto_state"])
+                finally:
+                    f.close()
+
+                write = merge(states)
+                if not write:
+                    return (before, before)
+
+                if compact:
+                    self.replay(feed, write)
+                    self.commit(fpath, self.prepare(fpath, feed, gen + 1))
+                    return (before, (gen + 1, 0))
+
+                # A journal that goes with this generation is added to.
+                # Otherwise, there's either none or one that was already
+                # played into the feed, so a new one replaces it.
+
+                data = cPickle.dumps(write.items())
+                jpath = self.journal(fpath)
+                if good:
+                    j = open(jpath, "a")
+                    try:
+                        j.truncate(good)
+                        j.write(data)
+                    finally:
+                        j.close()
+                else:
+                    if not os.path.exists(os.path.dirname(jpath)):
+                        os.mkdir(os.path.dirname(jpath))
+                    data = cPickle.dumps(gen) + data
+                    fd, tmp = mkstemp(os.path.dirname(jpath))
+                    j = os.fdopen(fd, "w")
+                    try:
+                        j.write(data)
+                    finally:
+                        j.close()
+                    os.rename(tmp, jpath)
+
+                after = (gen, good + len(data))
+                self.cache.rekey(fpath, record, after + (ino,), write)
+                return (before, after)
+            except:
+                return None
+        finally:
+            self.unlock(l)
+
+    # entry returns the entry with the given id, or None. This is what the
+    # reader uses to get the content of a story, so it only reads the header and
+    # the entry itself, if they aren't cached, and the blobs it refers to.
+
+    def entry(self, fpath, id):
+        def work(f):
+            gen = self.generation(f)
+            journal, good = self.states(fpath, gen)
+            key = (gen, good, os.fstat(f.fileno()).st_ino)
+            record = self.record(f, fpath, key, journal)
+            entry = self.cached_entry(f, fpath, record, id)
+            if entry:
+                return copy_entry(entry)
+            return None
+
+        try:
+            entry = self.snapshot(fpath, work)
+        except:
+            return None
+
+        if entry:
+            self.blobs.resolve_entry(entry)
+        return entry
+
+    # prune removes the feeds that aren't named in names (the file names of the
+    # feeds in the config), i.e. when the user has removed a feed from the
+    # configuration, along with their journals and locks. Dotfiles are
+    # canto-fetch's own (i.e. .stats), feeds never start with a dot. New files
+    # that were never renamed into place (i.e. canto-fetch was killed) are
+    # removed once they're an hour old. Then, the blobs that none of the
+    # remaining feeds refer to are removed.
+
+    def prune(self, names, log_func):
+        for file in os.listdir(self.feed_dir):
+            if file.startswith(".tmp-"):
+                try:
+                    if time.time() - os.stat(self.feed_dir + file).st_mtime\
+                            > 3600:
+                        os.unlink(self.feed_dir + file)
+                except OSError:
+                    pass
+            if file.startswith("."):
+                continue
+            if not file in names:
+                log_func("Deleted extraneous file: %s" % file)
+                try:
+                    os.unlink(self.feed_dir + file)
+                except:
+                    pass
+
+        for dir in [".journal", ".locks"]:
+            if os.path.isdir(self.feed_dir + dir):
+                for file in os.listdir(self.feed_dir + dir):
+                    if not file.startswith(".") and not file in names:
+                        try:
+                            os.unlink(self.feed_dir + dir + "/" + file)
+                        except OSError:
+                            pass
+
+        refs = {}
+        for file in names:
+            try:
+                f = open(self.feed_dir + file, "r")
+            except IOError:
+                continue
+            try:
+                try:
+                    for digest in self.refs(f):
+                        refs[digest] = refs.get(digest, 0) + 1
+                except:
+
+                    # If a feed can't be read, there's no telling what it
+                    # refers to, so nothing goes this time.
+
+                    log_func("Couldn't read %s, not removing blobs." % file)
+                    return
+            finally:
+                f.close()
+
+        # New entries in the change logs refer to blobs too, and a client
+        # that's behind might still follow them after the feed has dropped the
+        # entry.
+
+        for file in names:
+            for record in changelog.load(self.feed_dir + file):
+                for id, state, entry in record[3]:
+                    if entry:
+                        for field in BLOB_FIELDS:
+                            if dict.__contains__(entry, field):
+                                self.blobs.find(dict.__getitem__(entry, field),
+                                        refs)
+
+        removed = self.blobs.collect(refs)
+        if removed:
+            log_func("Removed %d unused blobs." % removed)
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS feeds (name TEXT PRIMARY KEY, mtime REAL,"
+        " data BLOB)",
+    "CREATE TABLE IF NOT EXISTS entries (feed TEXT, pos INTEGER, id TEXT,"
+        " data BLOB, PRIMARY KEY (feed, pos))",
+    "CREATE TABLE IF NOT EXISTS states (feed TEXT, pos INTEGER, state BLOB,"
+        " PRIMARY KEY (feed, pos))",
+    "CREATE INDEX IF NOT EXISTS entries_id ON entries (feed, id)"]
+
+def dump(obj):
+    return sqlite3.Binary(cPickle.dumps(obj, 2))
+
+def load(blob):
+    return cPickle.loads(str(blob))
+
+# Entries are looked up by id. Ids are normally unicode, but can be None (see
+# canto-fetch) and the sqlite3 module won't take 8-bit strings.
+
+def key(id):
+    if type(id) == str:
+        return unicode(id, "UTF-8", "replace")
+    return id
+
+def id_clause(id):
+    if id == None:
+        return ("entries.id IS NULL", ())
+    return ("entries.id = ?", (key(id),))
+
+class SQLiteStore():
+    def __init__(self, feed_dir):
+        self.feed_dir = feed_dir
+        self.path = feed_dir + ".feeds.db"
+        self.pickles = PickleStore(feed_dir)
+
+        # sqlite3 connections can't be shared between threads, or survive a
+        # fork, so there's one per thread, per process.
+
+        self.local = local()
+
+    def db(self):
+        if getattr(self.local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+            # Readers don't have to wait on writers with a write-ahead log,
+            # but older SQLites don't have one.
+
+            try:
+                db.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.Error:
+                pass
+
+            for statement in SCHEMA:
+                db.execute(statement)
+
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return self.local.db
+
+    def name(self, fpath):
+        return os.path.basename(fpath)
+
+    def mtime(self, db, fpath):
+        row = db.execute("SELECT mtime FROM feeds WHERE name = ?",
+                (self.name(fpath),)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    # Everything in the database is written in one transaction. If it fails,
+    # it's rolled back and the exception is passed on.
+
+    def transaction(self, db, work, immediate=True):
+        if immediate:
+            db.execute("BEGIN IMMEDIATE")
+        else:
+            db.execute("BEGIN")
+        try:
+            r = work()
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return r
+
+    # pickled is whether a feed is still in its pickle, rather than the
+    # database. Only canto-fetch moves it (see migrate), until then the client
+    # reads and journals it like PickleStore would.
+
+    def pickled(self, db, fpath):
+        return self.mtime(db, fpath) == None and os.path.isfile(fpath)
+
+    # migrate moves a feed from its pickle into the database, if it's there.
+    # The pickle's lock is held throughout, so the client can't add to its
+    # journal after it's been read.
+
+    def migrate(self, db, fpath):
+        if not self.pickled(db, fpath):
+            return
+
+        l = self.pickles.writelock(fpath)
+        try:
+            if not os.path.isfile(fpath):
+                return
+
+            # The pickle's read directly rather than loaded, there's no point
+            # in upgrading it first.
+
+            def work(f):
+                gen = self.pickles.generation(f)
+                journal = self.pickles.states(fpath, gen)[0]
+                f.seek(0)
+                return self.pickles.read(f, journal)[1]
+
+            feed = self.pickles.snapshot(fpath, work)
+            mtime = os.stat(fpath).st_mtime
+
+            # The database has the whole entries, the blobs they refer to go
+            # once nothing else does (see PickleStore.prune).
+
+            for entry in feed["entries"]:
+                self.pickles.blobs.resolve_entry(entry)
+
+            def work():
+                if self.mtime(db, fpath) == None:
+                    self.store(db, fpath, feed, mtime)
+            self.transaction(db, work)
+
+            os.unlink(fpath)
+            self.pickles.clear(fpath)
+            self.pickles.cache.drop(fpath)
+        finally:
+            self.pickles.unlock(l)
+
+    def store(self, db, fpath, feed, mtime):
+        name = self.name(fpath)
+        db.execute("DELETE FROM entries WHERE feed = ?", (name,))
+        db.execute("DELETE FROM states WHERE feed = ?", (name,))
+
+        # The feeds and entries are FeedParserDicts, copy.copy keeps them that
+        # way (dict.copy wouldn't) so that their aliases still work.
+
+        rest = copy.copy(feed)
+        del rest["entries"]
+        db.execute("INSERT OR REPLACE INTO feeds VALUES (?, ?, ?)",
+                (name, mtime, dump(rest)))
+
+        for pos, entry in enumerate(feed["entries"]):
+            state = entry.get("canto_state", [])
+            entry = copy.copy(entry)
+            if "canto_state" in entry:
+                del entry["canto_state"]
+            db.execute("INSERT INTO entries VALUES (?, ?, ?, ?)",
+                    (name, pos, key(entry.get("id")), dump(entry)))
+            db.execute("INSERT INTO states VALUES (?, ?, ?)",
+                    (name, pos, dump(state)))
+
+    def exists(self, fpath):
+        db = self.db()
+        return self.mtime(db, fpath) != None or os.path.isfile(fpath)
+
+    # Reads don't lock anybody out, so there's nothing to time, and the
+    # entries are whole in the database, so blobs makes no difference.
+
+    def load(self, fpath, block=True, timed=None, blobs=True, upgrade=False):
+        db = self.db()
+        if upgrade:
+            self.migrate(db, fpath)
+        elif self.pickled(db, fpath):
+            return self.pickles.load(fpath, block, timed, blobs)
+        name = self.name(fpath)
+
+        def work():
+            row = db.execute("SELECT mtime, data FROM feeds WHERE name = ?",
+                    (name,)).fetchone()
+            if not row:
+                raise IOError, "%s not in %s" % (name, self.path)
+
+            feed = load(row[1])
+            feed["entries"] = []
+            for data, state in db.execute("SELECT entries.data, states.state"
+                    " FROM entries, states WHERE entries.feed = ? AND"
+                    " states.feed = entries.feed AND"
+                    " states.pos = entries.pos ORDER BY entries.pos", (name,)):
+                entry = load(data)
+                entry["canto_state"] = load(state)
+                feed["entries"].append(entry)
+            return (feed, row[0])
+
+        return self.transaction(db, work, False)
+
+    # Entries in the database are whole, but the change log's refer to the
+    # blob store (see refer).
+
+    def resolve(self, value):
+        return self.pickles.resolve(value)
+
+    def refer(self, entry):
+        return self.pickles.refer(entry)
+
+    def changes(self, fpath, seq, mtime):
+        if self.pickled(self.db(), fpath):
+            return self.pickles.changes(fpath, seq, mtime)
+        current = self.mtime(self.db(), fpath)
+        if current == None:
+            return None
+        if current == mtime:
+            return []
+        return changelog.follow(fpath, seq, current)
+
+    def create(self, fpath, feed):
+        db = self.db()
+
+        def work():
+            if self.mtime(db, fpath) == None:
+                self.store(db, fpath, feed, time.time())
+        self.transaction(db, work)
+
+    def write(self, fpath, feed, prevtime, log=None, timed=None):
+        db = self.db()
+        self.migrate(db, fpath)
+
+        # The entries are whole, but the change log's refer to blobs (see
+        # refer), which have to be on disk before the log is written.
+
+        self.pickles.blobs.sync()
+
+        start = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        if timed:
+            timed("lock", start)
+
+        try:
+            current = self.mtime(db, fpath)
+            if prevtime and prevtime != current:
+                db.execute("ROLLBACK")
+                return None
+
+            # The mtime has to change, even if the clock hasn't.
+
+            start = time.time()
+            mtime = max(time.time(), (current or 0) + 0.001)
+            self.store(db, fpath, feed, mtime)
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+        db.execute("COMMIT")
+        if timed:
+            timed("write", start)
+
+        # The log is only added to once the write is committed, so it never
+        # has a record of one that was rolled back, and the database isn't
+        # locked while it's written.
+
+        if log:
+            log(mtime)
+        return mtime
+
+    # If canto-fetch moves the feed into the database while we're waiting for
+    # the pickle's lock, the states are written there instead.
+
+    def update_states(self, fpath, ids, merge, loaded=None):
+        db = self.db()
+        name = self.name(fpath)
+
+        if self.pickled(db, fpath):
+            r = self.pickles.update_states(fpath, ids, merge, loaded)
+            if r != None or self.pickled(db, fpath):
+                return r
+
+        def work():
+            before = self.mtime(db, fpath)
+            if before == None:
+                return None
+
+            found = {}
+            for id in ids:
+                clause, args = id_clause(id)
+                row = db.execute("SELECT states.pos, states.state FROM"
+                        " entries, states WHERE entries.feed = ? AND " +\
+                        clause + " AND states.feed = entries.feed AND"
+                        " states.pos = entries.pos ORDER BY entries.pos"
+                        " LIMIT 1", (name,) + args).fetchone()
+                if row:
+                    found[id] = (row[0], load(row[1]))
+
+            states = {}
+            for id, (pos, state) in found.items():
+                states[id] = state
+
+            # If nothing changed, the feed didn't either, so its mtime stays
+            # put and nobody has to reload it.
+
+            write = merge(states)
+            if not write:
+                return (before, before)
+
+            for id, state in write.items():
+                db.execute("UPDATE states SET state = ? WHERE feed = ? AND"
+                        " pos = ?", (dump(state), name, found[id][0]))
+
+            after = max(time.time(), before + 0.001)
+            db.execute("UPDATE feeds SET mtime = ? WHERE name = ?",
+                    (after, name))
+            return (before, after)
+
+        try:
+            return self.transaction(db, work)
+        except:
+            return None
+
+    def entry(self, fpath, id):
+        try:
+            db = self.db()
+            if self.pickled(db, fpath):
+                return self.pickles.entry(fpath, id)
+            clause, args = id_clause(id)
+            row = db.execute("SELECT entries.data, states.state FROM entries,"
+                    " states WHERE entries.feed = ? AND " + clause +\
+                    " AND states.feed = entries.feed AND"
+                    " states.pos = entries.pos ORDER BY entries.pos LIMIT 1",
+                    (self.name(fpath),) + args).fetchone()
+        except:
+            return None
+
+        if not row:
+            return None
+        entry = load(row[0])
+        entry["canto_state"] = load(row[1])
+        return entry
+
+    def prune(self, names, log_func):
+        self.pickles.prune(names, log_func)
+
+        db = self.db()
+        def work():
+            for row in db.execute("SELECT name FROM feeds").fetchall():
+                if row[0] not in names:
+                    log_func("Deleted extraneous feed: %s" % row[0])
+                    for table, column in [("feeds", "name"),
+                            ("entries", "feed"), ("states", "feed")]:
+                        db.execute("DELETE FROM %s WHERE %s = ?" %\
+                                (table, column), (row[0],))
+        self.transaction(db, work)
+
+STORES = { "pickle" : PickleStore, "sqlite" : SQLiteStore }
+
+# Stores are shared by everything using the same feed directory (i.e. when
+# canto-fetch rereads the config), and Stories only know the path of their
+# feed, so for_path has to find the store from that.
+
+stores = {}
+current = {}
+
+def get_store(kind, feed_dir):
+    if (kind, feed_dir) not in stores:
+        stores[(kind, feed_dir)] = STORES[kind](feed_dir)
+    current[feed_dir] = stores[(kind, feed_dir)]
+    return current[feed_dir]
+
+def for_path(fpath):
+    feed_dir = os.path.dirname(fpath) + "/"
+    if feed_dir not in current:
+        return get_store("pickle", feed_dir)
+    return current[feed_dir]
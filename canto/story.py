@@ -16,11 +16,11 @@
 # Story doesn't care which feed or tag it's associated with. If you really want
 # to get the feed, story["feed"] contains the unique URL, but you'd have to use
 # the config to get the Feed() object. The only thing that the Story() gets from
-# the feed is the get_ufp function that gets the feedparser dict from disk.
+# the feed is its path, which is enough to look the full entry up in the store
+# (see storage.py).
 
 from const import STORY_SAVED, STORY_UPDATED
-import cPickle
-import fcntl
+import storage
 
 class Story():
     def __init__(self, d, ufp_path, updated):
@@ -56,25 +56,8 @@ class Story():
         if not self.ufp_path:
             return {}
 
-        try:
-            f = open(self.ufp_path, "r")
-            try:
-                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
-                ufp = cPickle.load(f)
-            except:
-                return {}
-            finally:
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
-        except:
-            return {}
-
-        for ondisk in ufp["entries"]:
-            if ondisk["id"] == self["id"]:
-                break
-        else:
-            self.ondisk = None
-        self.ondisk = ondisk
+        self.ondisk = storage.for_path(self.ufp_path).entry(self.ufp_path,
+                self["id"])
 
     def __getitem__(self, key):
         if key in self.d:
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# How long the client takes to bring the items of a big feed up to date: with
+# extend, from the feed on disk (first into an empty feed, then again over the
+# items it made), with merge, from items sent over a pipe, and with apply, from
+# a change log record that touches every item.
+#
+#       python test/bench_feed.py [entries]
+#
+# For comparison, the same is done with ListFeed, which finds items the way
+# Feed did before it indexed them by id, by scanning the whole list. That's
+# quadratic, so the default is a few thousand entries rather than 10000.
+
+from common import Home, rss
+from canto import canto_fetch, story, feed
+from canto.const import STORY_SAVED, STORY_QD
+
+import time
+import sys
+
+# ListFeed's extend, merge and apply are Feed's from before the index.
+
+class ListFeed(feed.Feed):
+    def apply(self, records):
+        if not records:
+            return 1
+
+        items = self[:]
+        for before, after, mtime, entries in records:
+            current = {}
+            for item in items:
+                current[item["id"]] = item
+
+            newlist = []
+            for id, state, entry in entries:
+                if entry:
+                    nentry = self.strip(entry)
+                    if nentry not in newlist:
+                        newlist.append(nentry)
+                elif id in current:
+                    centry = current.pop(id)
+                    if (not centry.updated) and\
+                        (centry["canto_state"] != state):
+                        centry["canto_state"] = state
+                    newlist.append(centry)
+                elif id not in [ x["id"] for x in newlist ]:
+                    return 0
+
+            items = [ x for x in newlist\
+                    if not self.filter or self.filter(self, x) ]
+
+        del self[:]
+        list.extend(self, items)
+
+        self.seq = records[-1][1]
+        self.mtime = records[-1][2]
+        return 1
+
+    def extend(self, entries):
+        newlist = []
+        for entry in entries:
+            if entry in self and entry not in newlist:
+                centry = self[self.index(entry)]
+                if (not centry.updated) and\
+                    (centry["canto_state"] != entry["canto_state"]):
+                    centry["canto_state"] = entry["canto_state"]
+                newlist.append(centry)
+                continue
+
+            nentry = self.strip(entry)
+            if nentry not in newlist:
+                newlist.append(nentry)
+
+        del self[:]
+        for item in newlist:
+            if not self.filter or self.filter(self, item):
+                list.append(self, item)
+
+    def merge(self, iter):
+        for i, item in enumerate(iter):
+            if item in self:
+                cur = self[self.index(item)]
+                if cur.updated in [STORY_SAVED, STORY_QD]:
+                    cur["canto_state"] = item["canto_state"]
+                    cur.updated = 0
+                iter[i] = cur
+
+        del self[:]
+        list.extend(self, iter)
+
+def timed(work, *args):
+    start = time.time()
+    work(*args)
+    return time.time() - start
+
+def bench(cls, cfg):
+    c = cfg.feeds[0]
+    f = cls(cfg, c.path, c.URL, c.tags, c.rate, c.keep, c.filter,
+            c.username, c.password)
+    entries = f.get_ufp()["entries"]
+    first = timed(f.extend, entries)
+    again = timed(f.extend, entries)
+
+    items = [ story.Story({ "id" : s["id"], "feed" : s["feed"],
+        "title" : s["title"], "canto_state" : list(s["canto_state"]) },
+        f.path, 0) for s in f ]
+    merge = timed(f.merge, items)
+
+    records = [ (0, 1, 1.0, [ (s["id"], s["canto_state"] + [u"read"],
+        None) for s in f ]) ]
+    apply = timed(f.apply, records)
+
+    print "%s, %d entries: extend %.3fs, again %.3fs, merge %.3fs,"\
+            " apply %.3fs" % (cls.__name__, len(f), first, again, merge, apply)
+    return [ (s["id"], s["canto_state"]) for s in f ]
+
+def main(n):
+    home = Home()
+    try:
+        URL = home.script("big", rss("Big", [ "urn:%d" % i\
+                for i in xrange(n) ]))
+        home.configure([ "add(\"%s\", keep=%d)" % (URL, n),
+            "fetch_processes = 0" ])
+        canto_fetch.run(home.cfg(), False, True, 1)
+
+        cfg = home.cfg()
+        if bench(feed.Feed, cfg) != bench(ListFeed, cfg):
+            print "The feeds don't agree!"
+    finally:
+        home.remove()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main(3000)
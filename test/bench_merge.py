@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# How long canto-fetch takes to merge a big feed with the one on disk, half of
+# whose entries are new, with keep above the feed's length and never_discard
+# set so that every pass of the merge has work to do.
+#
+#       python test/bench_merge.py [entries]
+#
+# Merge is the merge itself, from .stats, total the whole second fetch
+# (mostly parsing). For comparison, the old merge, which scanned the list of
+# current entries for every new one, is run over the same entries. It's
+# quadratic, so it takes a while at 10000.
+
+from common import Home, rss
+from canto import canto_fetch, fetch_stats, storage
+from canto import feedparser_builtin as feedparser
+
+import time
+import sys
+
+# old_merge is the merge from before it was indexed by id, without the write
+# and the retry, which are the same either way. It merges current into
+# entries and returns the new ones.
+
+def old_merge(entries, current, tags, keep, never_discard):
+    new = []
+    for entry in entries:
+        for centry in current:
+            if entry["id"] == centry["id"]:
+                entry["canto_state"] = centry["canto_state"]
+                current.remove(centry)
+                break
+        else:
+            new.append(entry)
+
+        if "canto_state" not in entry:
+            entry["canto_state"] = tags + [u"*"]
+
+    if keep and len(entries) < keep:
+        entries += current[:keep - len(entries)]
+
+    for e in current:
+        for tag in never_discard:
+            if tag == "unread":
+                if "read" in e["canto_state"]:
+                    continue
+            elif tag not in e["canto_state"]:
+                continue
+            if e not in entries:
+                entries.append(e)
+    return new
+
+def main(n):
+    home = Home()
+    try:
+        URL = home.script("big", rss("Big", [ "urn:%d" % i for i in xrange(n) ]))
+        home.configure([ "add(\"%s\", keep=%d)" % (URL, n * 12 / 10),
+            "never_discard(\"unread\")", "fetch_processes = 0" ])
+        cfg = home.cfg()
+        canto_fetch.run(cfg, False, True, 1)
+        current = storage.PickleStore(home.feed_dir).load(home.fpath(URL),
+                blobs=False)[0]["entries"]
+
+        data = rss("Big", [ "urn:%d" % i for i in xrange(n / 2, n + n / 2) ])
+        home.script("big", data)
+        start = time.time()
+        canto_fetch.run(home.cfg(), False, True, 1)
+        total = time.time() - start
+
+        stats = fetch_stats.load(home.feed_dir + ".stats")[URL]
+        merge = stats[2 + fetch_stats.FIELDS.index("merge")]
+        print "%d entries, %d new: merge %.3fs, total %.2fs" %\
+                (n, n / 2, merge, total)
+
+        entries = feedparser.parse(data)["entries"]
+        start = time.time()
+        old_merge(entries, current, cfg.feeds[0].tags, n * 12 / 10,
+                ["unread"])
+        print "old merge %.3fs" % (time.time() - start)
+
+        merged = storage.PickleStore(home.feed_dir).load(home.fpath(URL),
+                blobs=False)[0]["entries"]
+        if [ e["id"] for e in merged ] != [ e["id"] for e in entries ]:
+            print "The merges don't agree!"
+    finally:
+        home.remove()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main(10000)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# How long PickleStore takes to write and read back a big feed, in the format
+# canto used to write (one text pickle of the whole feed) and in the current
+# one.
+#
+#       python test/bench_storage.py [entries]
+#
+# Every load is from a new store, so nothing comes out of its cache. Each time
+# is the best of three.
+
+from common import Home, rss
+from canto import canto_fetch, storage
+
+import cPickle
+import time
+import sys
+import os
+
+TEXT = u"<p>Some text here. " * 40
+
+def best(work):
+    times = []
+    for i in xrange(3):
+        start = time.time()
+        work()
+        times.append(time.time() - start)
+    return min(times)
+
+def main(n):
+    home = Home()
+    try:
+        URL = home.script("big", rss("Big", [ "urn:%d" % i\
+                for i in xrange(n) ], TEXT))
+        home.configure([ "add(\"%s\", keep=%d)" % (URL, n),
+            "fetch_processes = 0" ])
+        canto_fetch.run(home.cfg(), False, True, 1)
+
+        fpath = home.fpath(URL)
+        feed = storage.PickleStore(home.feed_dir).load(fpath)[0]
+        old = home.feed_dir + "old"
+
+        def dump():
+            f = open(old, "w")
+            cPickle.dump(feed, f)
+            f.close()
+
+        def prepare():
+            store = storage.PickleStore(home.feed_dir)
+            store.discard(store.prepare(fpath, feed, 1))
+
+        def load(path, blobs=True):
+            return lambda: storage.PickleStore(home.feed_dir).load(path,
+                    blobs=blobs)
+
+        def entry():
+            storage.PickleStore(home.feed_dir).entry(fpath, u"urn:%d" % (n / 2))
+
+        print "%d entries" % n
+        dumped = best(dump)
+        print "format 0: %8d bytes, dump %.3fs, load %.3fs" %\
+                (os.stat(old).st_size, dumped, best(load(old)))
+        print "format %d: %8d bytes, dump %.3fs, load %.3fs,"\
+                " without blobs %.3fs, one entry %.4fs" %\
+                (storage.FORMAT, os.stat(fpath).st_size, best(prepare),
+                 best(load(fpath)), best(load(fpath, False)), best(entry))
+    finally:
+        home.remove()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main(5000)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# What the tests share. They run against the source tree, with widecurse built
+# in place:
+#
+#       python setup.py build_ext -i
+#       python -m unittest discover -s test
+#
+# Any test file can also be run on its own.
+
+import __builtin__
+import BaseHTTPServer
+import SocketServer
+import threading
+import tempfile
+import shutil
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# setup.py fills in the version in const.py when canto is installed.
+
+__builtin__.SET_VERSION_TUPLE = (0, 7, 10)
+__builtin__.SET_GIT_SHA = "test"
+
+# canto.main and canto.utility import each other, main has to go first.
+
+import canto.main
+
+from canto.cfg.base import get_cfg
+
+def rss(title, ids, text=u"", link="http://example.com/"):
+    items = "".join([ "<item><title>%s</title><guid>%s</guid>"
+        "<link>%s%s</link><description>%s</description></item>" %\
+            (id, id, link, id, text) for id in ids ])
+    return ('<?xml version="1.0" encoding="utf-8"?><rss version="2.0">'
+            '<channel><title>%s</title><link>%s</link>'
+            '<description>d</description>%s</channel></rss>' %\
+                    (title, link, items)).encode("UTF-8")
+
+# A Home is a throwaway configuration directory, with feeds and scripts
+# directories, for a config made of lines.
+
+class Home():
+    def __init__(self, lines=[]):
+        self.path = tempfile.mkdtemp(prefix="canto-test-")
+        self.feed_dir = self.path + "/feeds/"
+        self.script_dir = self.path + "/scripts/"
+        os.mkdir(self.feed_dir)
+        os.mkdir(self.script_dir)
+        self.configure(lines)
+
+    def configure(self, lines):
+        f = open(self.path + "/conf.py", "w")
+        try:
+            f.write("\n".join(lines) + "\n")
+        finally:
+            f.close()
+
+    # script adds a script feed that prints whatever is in the file data.
+
+    def script(self, name, data):
+        self.write(name + ".xml", data)
+        path = self.script_dir + name
+        f = open(path, "w")
+        try:
+            f.write("#!/bin/sh\ncat %s.xml\n" % path)
+        finally:
+            f.close()
+        os.chmod(path, 0755)
+        return "script:" + name
+
+    def write(self, name, data):
+        f = open(self.script_dir + name, "w")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+    def cfg(self):
+        c = get_cfg(self.path + "/conf.py", self.path + "/log",
+                self.feed_dir, self.script_dir)
+        c.parse()
+        return c
+
+    def fpath(self, URL):
+        return self.feed_dir + URL.replace("/", "_")
+
+    def remove(self):
+        shutil.rmtree(self.path, True)
+
+# FeedServer is a local HTTP/1.1 server. Paths are looked up in pages, a dict
+# of path -> (status, headers, body), and hits counts the requests for each.
+# Every response waits delay seconds first, like a server far away.
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.lock.acquire()
+        try:
+            server.hits[self.path] = server.hits.get(self.path, 0) + 1
+            status, headers, body = server.pages.get(self.path,
+                    (404, {}, "not found"))
+        finally:
+            server.lock.release()
+
+        if server.delay:
+            time.sleep(server.delay)
+
+        if status == None:
+            self.wfile.write(body)
+            self.close_connection = 1
+            return
+
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.pages = {}
+        self.hits = {}
+        self.delay = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def URL(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server_address[1], path)
+
+    def page(self, path, body, status=200, headers={}):
+        self.pages[path] = (status, headers, body)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# prune only removes the blobs that no feed refers to, once they're old
+# enough that nobody could be about to refer to them. Writing a feed full of
+# new blobs syncs them all at once.
+
+from common import Home, rss
+from canto import canto_fetch, storage
+
+import unittest
+import os
+
+TEXT = u"A long story. " * 1000
+
+class PruneTest(unittest.TestCase):
+    def setUp(self):
+        self.home = Home()
+        self.URL = self.home.script("s", rss("S", ["urn:a"], TEXT))
+        self.home.configure([ "add(\"%s\")" % self.URL,
+            "fetch_processes = 0" ])
+        self.fpath = self.home.fpath(self.URL)
+
+    def tearDown(self):
+        self.home.remove()
+
+    def test_prune(self):
+        canto_fetch.run(self.home.cfg(), False, True, 1)
+        store = storage.PickleStore(self.home.feed_dir)
+        feed = store.load(self.fpath, blobs=False)[0]
+        used = dict.__getitem__(feed["entries"][0], "summary")
+        self.failUnless(storage.is_ref(used))
+
+        old = store.blobs.put(TEXT + u"old")
+        new = store.blobs.put(TEXT + u"new")
+        for ref in [used, old]:
+            os.utime(store.blobs.path(ref[1]), (0, 0))
+
+        removed = []
+        store.prune([ os.path.basename(self.fpath) ], removed.append)
+        self.assertEqual(removed, ["Removed 1 unused blobs."])
+
+        self.failIf(os.path.exists(store.blobs.path(old[1])))
+        self.failUnless(os.path.exists(store.blobs.path(new[1])))
+        self.failUnless(os.path.exists(store.blobs.path(used[1])))
+
+        feed = storage.PickleStore(self.home.feed_dir).load(self.fpath)[0]
+        self.assertEqual(feed["entries"][0]["summary"],
+                store.resolve(used))
+
+    # Updates collect blobs as they go, not just when canto-fetch starts.
+
+    def test_run(self):
+        canto_fetch.run(self.home.cfg(), False, True, 1)
+        store = storage.PickleStore(self.home.feed_dir)
+        old = store.blobs.put(TEXT + u"old")
+        os.utime(store.blobs.path(old[1]), (0, 0))
+
+        writes = canto_fetch.PRUNE_WRITES
+        canto_fetch.PRUNE_WRITES = 2
+        canto_fetch.written[self.home.feed_dir] = 0
+        try:
+            self.home.script("s", rss("S", ["urn:b"], TEXT))
+            canto_fetch.run(self.home.cfg(), False, True, 1)
+            self.failUnless(os.path.exists(store.blobs.path(old[1])))
+
+            self.home.script("s", rss("S", ["urn:c"], TEXT))
+            canto_fetch.run(self.home.cfg(), False, True, 1)
+            self.failIf(os.path.exists(store.blobs.path(old[1])))
+        finally:
+            canto_fetch.PRUNE_WRITES = writes
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.home = Home()
+
+        # Every entry has a text of its own.
+
+        items = "".join([ "<item><guid>urn:%d</guid><description>%s%d"
+            "</description></item>" % (i, TEXT, i) for i in xrange(20) ])
+        self.URL = self.home.script("s", rss("S", []).replace("</channel>",
+            items + "</channel>"))
+        self.home.configure([ "add(\"%s\")" % self.URL,
+            "fetch_processes = 0" ])
+
+        self.syncfs = storage.syncfs
+        self.fsync = os.fsync
+
+    def tearDown(self):
+        storage.syncfs = self.syncfs
+        os.fsync = self.fsync
+        self.home.remove()
+
+    def test_sync(self):
+        calls = []
+        def syncfs(fd):
+            calls.append("syncfs")
+            return 0
+        def fsync(fd):
+            calls.append("fsync")
+            return self.fsync(fd)
+
+        storage.syncfs = syncfs
+        os.fsync = fsync
+        canto_fetch.run(self.home.cfg(), False, True, 1)
+
+        # One fsync for the stub written before the first fetch, and one for
+        # the feed, after all of its blobs.
+
+        self.assertEqual(calls, ["fsync", "syncfs", "fsync"])
+
+        refs = {}
+        store = storage.PickleStore(self.home.feed_dir)
+        for entry in store.load(self.home.fpath(self.URL), blobs=False)[0]\
+                ["entries"]:
+            store.blobs.find(dict.__getitem__(entry, "summary"), refs)
+        self.assertEqual(len(refs), 20)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# The change log only carries references to the long texts of new entries,
+# which have to stay in the blob store as long as the log refers to them. Any
+# number of writers can append to it at once.
+
+from common import Home, rss
+from canto import canto_fetch, changelog, storage
+
+import unittest
+import os
+
+TEXT = u"A long story. " * 1000
+
+class ChangeLogTest(unittest.TestCase):
+    def setUp(self):
+        self.home = Home()
+        self.URL = self.home.script("s", rss("S", ["urn:a"], TEXT + u"a"))
+        self.home.configure([ "add(\"%s\", keep=1)" % self.URL,
+            "fetch_processes = 0" ])
+        self.fpath = self.home.fpath(self.URL)
+
+    def tearDown(self):
+        self.home.remove()
+
+    def fetch(self, ids):
+        self.home.script("s", rss("S", ids, TEXT + ids[0]))
+        cfg = self.home.cfg()
+        canto_fetch.run(cfg, False, True, 1)
+        return cfg
+
+    def test_refs(self):
+        self.fetch(["urn:a"])
+        cfg = self.fetch(["urn:b"])
+
+        records = changelog.load(self.fpath)
+        new = [ entry for id, state, entry in records[-1][3] if entry ]
+        self.assertEqual([ e["id"] for e in new ], ["urn:b"])
+
+        summary = dict.__getitem__(new[0], "summary")
+        self.failUnless(storage.is_ref(summary))
+        self.assertEqual(cfg.store.resolve(summary), TEXT + u"urn:b")
+
+        # A client following the log gets the text, whether or not the feed
+        # still has the entry.
+
+        cfg = self.fetch(["urn:c"])
+        self.failIf("urn:b" in [ e["id"] for e in
+            cfg.store.load(self.fpath)[0]["entries"] ])
+
+        for sub in os.listdir(self.home.feed_dir + ".blobs"):
+            dir = self.home.feed_dir + ".blobs/" + sub + "/"
+            for file in os.listdir(dir):
+                os.utime(dir + file, (0, 0))
+
+        cfg.store.prune([ os.path.basename(self.fpath) ], lambda x: None)
+        self.assertEqual(cfg.store.resolve(summary), TEXT + u"urn:b")
+
+    def test_append(self):
+        pids = []
+        for i in xrange(4):
+            pid = os.fork()
+            if not pid:
+                try:
+                    for seq in xrange(i, 12, 4):
+                        changelog.append(self.fpath, (seq, seq + 1, 0.0, []))
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+        seqs = [ record[0] for record in changelog.load(self.fpath) ]
+        seqs.sort()
+        self.assertEqual(seqs, range(12))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# A reused connection is only tried again on a new one if the server closed it
+# while it sat in the pool, not if the server is just slow.
+
+from common import FeedServer
+from canto.connpool import ConnectionPool
+
+import unittest
+import urllib2
+import socket
+import errno
+
+# StaleConnection is an idle connection the server has already reset.
+
+class StaleConnection():
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def request(self, *args):
+        raise socket.error(errno.ECONNRESET, "Connection reset by peer")
+
+    def close(self):
+        pass
+
+class ReuseTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FeedServer()
+        self.server.page("/feed", "<rss/>")
+        self.pool = ConnectionPool()
+        self.opener = urllib2.build_opener(*self.pool.handlers())
+        self.timeout = socket.getdefaulttimeout()
+
+    def tearDown(self):
+        socket.setdefaulttimeout(self.timeout)
+        self.pool.close()
+        self.server.stop()
+
+    def get(self):
+        return self.opener.open(self.server.URL("/feed")).read()
+
+    def test_stale(self):
+        host, port = self.server.server_address
+        self.pool.put(("http", "%s:%d" % (host, port)),
+                StaleConnection(host, port))
+
+        self.assertEqual(self.get(), "<rss/>")
+        self.assertEqual(self.pool.stats(), (1, 1))
+        self.assertEqual(self.server.hits["/feed"], 1)
+
+    def test_timeout(self):
+        socket.setdefaulttimeout(0.2)
+        self.get()
+
+        self.server.delay = 1
+        try:
+            self.get()
+        except urllib2.URLError, e:
+            self.failUnless(isinstance(e.reason, socket.timeout))
+        else:
+            self.fail("No timeout")
+
+        self.assertEqual(self.pool.stats(), (1, 1))
+        self.assertEqual(self.server.hits["/feed"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
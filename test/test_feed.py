@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# What the client does with the states of the items it reads, and what it
+# writes back. state_change_hook runs once the states are written.
+
+from common import Home, rss
+from canto import canto_fetch, storage
+from canto.const import STORY_SAVED
+
+import unittest
+
+class FeedStateTest(unittest.TestCase):
+    def setUp(self):
+        self.home = Home()
+        self.URL = self.home.script("s", rss("S", ["urn:a", "urn:b"]))
+        self.home.configure([ "add(\"%s\", tags=[\"S\"])" % self.URL,
+            "fetch_processes = 0" ])
+        canto_fetch.run(self.home.cfg(), False, True, 1)
+
+    def tearDown(self):
+        self.home.remove()
+
+    def states(self):
+        feed = storage.PickleStore(self.home.feed_dir).load(
+                self.home.fpath(self.URL))[0]
+        return [ (e["id"], e["canto_state"]) for e in feed["entries"] ]
+
+    # Tags added in the config aren't known to canto-fetch, so the client adds
+    # them to the items' states, and has to write them out.
+
+    def test_added_tag(self):
+        self.home.configure([ "add(\"%s\", tags=[\"S\", \"extra\"])" %\
+                self.URL, "fetch_processes = 0" ])
+        f = self.home.cfg().feeds[0]
+        f.update()
+
+        self.assertEqual([ s.updated for s in f ], [STORY_SAVED] * 2)
+        self.assertEqual(self.states(),
+                [ (u"urn:a", [u"S", u"*", u"extra"]),
+                  (u"urn:b", [u"S", u"*", u"extra"]) ])
+
+    def test_state_change(self):
+        f = self.home.cfg().feeds[0]
+        f.update()
+        f[0].set("read")
+        f.todisk()
+
+        self.assertEqual(self.states(),
+                [ (u"urn:a", [u"S", u"*", u"read"]),
+                  (u"urn:b", [u"S", u"*"]) ])
+
+    def test_hook(self):
+        store = storage.PickleStore(self.home.feed_dir)
+        fpath = self.home.fpath(self.URL)
+        hooked = []
+        def hook(feed, entry, add, rem):
+            l = store.writelock(fpath, False)
+            store.unlock(l)
+            hooked.append((entry["id"], add, rem, self.states()))
+
+        cfg = self.home.cfg()
+        cfg.state_change_hook = hook
+        f = cfg.feeds[0]
+        f.update()
+        f[0].set("read")
+        f.todisk()
+
+        self.assertEqual(hooked, [ (u"urn:a", [u"read"], [],
+                [ (u"urn:a", [u"S", u"*", u"read"]),
+                  (u"urn:b", [u"S", u"*"]) ]) ])
+
+if __name__ == "__main__":
+    unittest.main()
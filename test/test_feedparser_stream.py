@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# feedparser's streaming parse has to come up with the same result as the
+# regular one, down to the complaints about feeds it can read anyway.
+
+from common import rss
+from canto import feedparser_builtin as feedparser
+
+from StringIO import StringIO
+import unittest
+import httplib
+import urllib
+
+def response(body, headers):
+    f = StringIO(body)
+    r = urllib.addinfourl(f, httplib.HTTPMessage(StringIO(headers + "\r\n")),
+            "http://example.com/feed")
+    r.seek = f.seek
+    r.status = 200
+    return r
+
+def summary(result):
+    return (result.get("bozo"),
+            result.get("bozo_exception").__class__.__name__,
+            str(result.get("bozo_exception")),
+            result.get("encoding"),
+            [ (e["id"], e["title"]) for e in result["entries"] ])
+
+class StreamTest(unittest.TestCase):
+    def compare(self, body, headers):
+        streamed = feedparser._parseStream(response(body, headers))
+        self.failIf(streamed == None)
+
+        parseStream = feedparser._parseStream
+        feedparser._parseStream = lambda f: None
+        try:
+            regular = feedparser.parse(response(body, headers))
+        finally:
+            feedparser._parseStream = parseStream
+
+        self.assertEqual(summary(streamed), summary(regular))
+        return streamed
+
+    def test_xml(self):
+        r = self.compare(rss(u"T", ["urn:a"], u"\xe9"),
+                "Content-Type: application/rss+xml; charset=utf-8\r\n")
+        self.assertEqual(r["bozo"], 0)
+
+    def test_no_content_type(self):
+        r = self.compare(rss(u"T", ["urn:a"]), "X-Nothing: here\r\n")
+        self.failUnless(isinstance(r["bozo_exception"],
+            feedparser.NonXMLContentType))
+
+    def test_html_content_type(self):
+        r = self.compare(rss(u"T", ["urn:a"]), "Content-Type: text/html\r\n")
+        self.failUnless(isinstance(r["bozo_exception"],
+            feedparser.NonXMLContentType))
+
+    def test_override(self):
+        r = self.compare(rss(u"T", ["urn:a"], u"\xe9"),
+                "Content-Type: application/xml; charset=bogus-charset\r\n")
+        self.failUnless(isinstance(r["bozo_exception"],
+            feedparser.CharacterEncodingOverride))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# The async engine against a local server with hundreds of feeds, some of which
+# redirect, fail or send garbage. Every feed has to come out the other end one
+# way or another, without the engine waiting on a download that's gone.
+#
+# Then both engines against the same feeds, from a server that takes its time
+# to answer, with their wall time and peak memory reported side by side.
+
+from common import Home, FeedServer, rss
+from canto import canto_fetch, storage
+from canto.fetch_backoff import Backoff
+
+import unittest
+import signal
+import socket
+import time
+import sys
+import os
+
+FEEDS = 300
+
+# The feeds both engines fetch, how long the server waits before each answer,
+# and how many downloads (or threads) they get.
+
+SLOW_FEEDS = 200
+DELAY = 0.2
+JOBS = 50
+
+class AsyncEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FeedServer()
+        self.home = Home()
+
+        # A port nothing's listening on.
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        self.closed = s.getsockname()[1]
+        s.close()
+
+    def tearDown(self):
+        self.server.stop()
+        self.home.remove()
+
+    def run_fetch(self, URLs, engine="async", jobs=50):
+        self.home.configure([ "add(\"%s\")" % URL for URL in URLs ] +\
+                [ "fetch_engine = \"%s\"" % engine, "fetch_processes = 0",
+                  "fetch_host_concurrency = 1000", "fetch_host_delay = 0" ])
+        cfg = self.home.cfg()
+
+        # A hang is a failure, not a test that never ends. run() has to be in
+        # the main thread, it sets signal handlers.
+
+        def hung(a, b):
+            raise AssertionError, "engine hung"
+
+        signal.signal(signal.SIGALRM, hung)
+        signal.alarm(120)
+        try:
+            canto_fetch.run(cfg, False, True, jobs)
+        finally:
+            signal.alarm(0)
+        return cfg
+
+    def entries(self, URL):
+        store = storage.PickleStore(self.home.feed_dir)
+        feed = store.load(self.home.fpath(URL))[0]
+        return [ e["id"] for e in feed["entries"] ]
+
+    def test_many_feeds(self):
+        good = []
+        bad = []
+        for i in xrange(FEEDS):
+            path = "/feed%d" % i
+            self.server.page(path, rss("Feed %d" % i, [ "urn:%d-%d" % (i, j)\
+                    for j in xrange(5) ]))
+
+            if i % 10 == 1:
+                self.server.page("/moved%d" % i, "", 302,
+                        { "Location" : path })
+                good.append((self.server.URL("/moved%d" % i), i))
+            elif i % 10 == 2:
+                self.server.page("/garbage%d" % i, "not http at all\r\n\r\n",
+                        None)
+                bad.append(self.server.URL("/garbage%d" % i))
+            elif i % 10 == 3:
+                bad.append(self.server.URL("/missing%d" % i))
+            elif i % 10 == 4:
+                bad.append("http://127.0.0.1:%d/feed%d" % (self.closed, i))
+            else:
+                good.append((self.server.URL(path), i))
+
+        # A redirect that blows up while it's being followed, and a host name
+        # that has to be looked up.
+
+        self.server.page("/badport", "", 302,
+                { "Location" : "http://127.0.0.1:notaport/" })
+        bad.append(self.server.URL("/badport"))
+
+        self.server.page("/named", rss("Named", ["urn:n"]))
+        good.append(("http://localhost:%d/named" %\
+                self.server.server_address[1], None))
+
+        cfg = self.run_fetch([ URL for URL, i in good ] + bad)
+
+        for URL, i in good:
+            if i == None:
+                self.assertEqual(self.entries(URL), ["urn:n"])
+            else:
+                self.assertEqual(self.entries(URL),
+                        [ "urn:%d-%d" % (i, j) for j in xrange(5) ])
+
+        # The failures are all backing off, so they were all finished.
+
+        backoff = Backoff(self.home.feed_dir + ".backoff")
+        for URL in bad:
+            self.failUnless(backoff.until(URL), URL)
+
+    # Each engine runs in a child of its own, so its peak RSS (from wait4) is
+    # its own and not whatever the other one left behind.
+
+    def compare(self, engine, URLs):
+        start = time.time()
+        pid = os.fork()
+        if not pid:
+            code = 1
+            try:
+                try:
+                    self.run_fetch(URLs, engine, JOBS)
+                    code = 0
+                except:
+                    pass
+            finally:
+                os._exit(code)
+
+        status, usage = os.wait4(pid, 0)[1:]
+        wall = time.time() - start
+        self.assertEqual(status, 0)
+
+        for URL in URLs:
+            self.assertEqual(len(self.entries(URL)), 5, URL)
+        return (wall, usage.ru_maxrss)
+
+    def test_compare(self):
+        self.server.delay = DELAY
+        URLs = []
+        for i in xrange(SLOW_FEEDS):
+            self.server.page("/slow%d" % i, rss("Slow %d" % i,
+                [ "urn:%d-%d" % (i, j) for j in xrange(5) ]))
+            URLs.append(self.server.URL("/slow%d" % i))
+
+        results = []
+        for engine in ["thread", "async"]:
+            self.home.remove()
+            self.home = Home()
+            wall, rss_kb = self.compare(engine, URLs)
+            results.append("%s %.2fs, %d KB peak" % (engine, wall, rss_kb))
+
+            # Neither waited on the server one feed at a time.
+
+            self.failUnless(wall < SLOW_FEEDS * DELAY / 4,
+                    "%s took %.2fs" % (engine, wall))
+
+        sys.stderr.write("\n%d feeds, %.1fs latency, %d jobs: %s\n" %\
+                (SLOW_FEEDS, DELAY, JOBS, "; ".join(results)))
+
+if __name__ == "__main__":
+    unittest.main()
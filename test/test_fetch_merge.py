@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Merging a fetched feed with the one on disk, when a client changes the feed
+# while canto-fetch is writing it out and the merge has to be done again.
+
+from common import Home, rss
+from canto import canto_fetch
+
+import unittest
+
+class MergeRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.home = Home()
+        self.URL = self.home.script("s", rss("S", ["urn:a", "urn:b"]))
+        self.home.configure([ "add(\"%s\")" % self.URL,
+            "fetch_processes = 0" ])
+        self.fpath = self.home.fpath(self.URL)
+
+    def tearDown(self):
+        self.home.remove()
+
+    def fetch(self, hook=None):
+        cfg = self.home.cfg()
+        cfg.new_hook = hook
+        canto_fetch.run(cfg, False, True, 1)
+        return cfg
+
+    def test_retry(self):
+        self.fetch()
+
+        # The client marks a read just before canto-fetch writes the feed out,
+        # so the first write fails and the merge is done again.
+
+        self.home.script("s", rss("S", ["urn:c", "urn:a", "urn:b"]))
+
+        hooked = []
+        def hook(feed, entry, last):
+            hooked.append(entry["id"])
+
+        cfg = self.home.cfg()
+        cfg.new_hook = hook
+        store = cfg.store
+        write = store.write
+        attempts = []
+
+        def racing(fpath, feed, prevtime, log=None, timed=None):
+            attempts.append([ e["id"] for e in feed["entries"] ])
+            if len(attempts) == 1:
+                store.update_states(fpath, ["urn:a"],
+                    lambda states: { "urn:a" : states["urn:a"] + [u"read"] })
+            return write(fpath, feed, prevtime, log, timed)
+
+        store.write = racing
+        canto_fetch.run(cfg, False, True, 1)
+
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(attempts[0], attempts[1])
+        self.assertEqual(hooked, ["urn:c"])
+
+        feed = store.load(self.fpath)[0]
+        self.assertEqual([ e["id"] for e in feed["entries"] ],
+                ["urn:c", "urn:a", "urn:b"])
+
+        states = dict([ (e["id"], e["canto_state"]) for e in feed["entries"] ])
+        self.failUnless(u"read" in states["urn:a"])
+        self.failIf(u"read" in states["urn:b"])
+        self.assertEqual(states["urn:c"].count(u"*"), 1)
+
+if __name__ == "__main__":
+    unittest.main()
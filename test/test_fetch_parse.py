@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Feeds that are parsed in the ParsePool's processes, some of which can't be
+# parsed. Those have to back off and still be scheduled, like any other
+# failure. new_hook still runs in canto-fetch itself.
+
+from common import Home, rss
+from canto import canto_fetch, storage
+from canto.fetch_backoff import Backoff
+
+import unittest
+import time
+import os
+
+class ParsePoolTest(unittest.TestCase):
+    def setUp(self):
+        self.home = Home()
+
+    def tearDown(self):
+        self.home.remove()
+
+    def fetch(self, URLs, extra=[]):
+        self.home.configure([ "add(\"%s\")" % URL for URL in URLs ] +\
+                [ "fetch_processes = 1" ] + extra)
+        refresh = canto_fetch.RefreshQueue()
+        canto_fetch.run(self.home.cfg(), False, True, 2, None, None, refresh)
+        return refresh
+
+    def test_broken(self):
+        good = self.home.script("good", rss("Good", ["urn:a", "urn:b"]))
+        broken = self.home.script("broken", "<rss><channel><title>Broken")
+        garbage = self.home.script("garbage", "not a feed at all")
+
+        start = time.time()
+        refresh = self.fetch([good, broken, garbage])
+
+        feed = storage.PickleStore(self.home.feed_dir).load(
+                self.home.fpath(good))[0]
+        self.assertEqual([ e["id"] for e in feed["entries"] ],
+                ["urn:a", "urn:b"])
+
+        backoff = Backoff(self.home.feed_dir + ".backoff")
+        self.failIf(backoff.until(good))
+
+        # None of them are due again straight away.
+
+        for URL in [good, broken, garbage]:
+            self.failUnless(refresh.next.get(URL) > start, URL)
+
+        for URL in [broken, garbage]:
+            self.failUnless(backoff.until(URL) > start, URL)
+
+        # Once it's fixed, it doesn't back off anymore.
+
+        self.home.script("broken", rss("Fixed", ["urn:c"]))
+        self.fetch([good, broken, garbage])
+
+        backoff = Backoff(self.home.feed_dir + ".backoff")
+        self.failIf(backoff.until(broken))
+        self.failUnless(backoff.until(garbage) > start)
+
+    def test_hook(self):
+        URLs = [ self.home.script("f%d" % i, rss("F%d" % i,
+            [ "urn:%d:a" % i, "urn:%d:b" % i ])) for i in xrange(3) ]
+
+        path = self.home.path + "/hooked"
+        self.fetch(URLs, [ "def hook(feed, item, last):",
+            "    import os",
+            "    f = open(%r, 'a')" % path,
+            "    f.write('%d %s %s\\n' % (os.getpid(), item['id'], last))",
+            "    f.close()",
+            "new_hook = hook" ])
+
+        f = open(path, "r")
+        try:
+            hooked = [ line.split() for line in f ]
+        finally:
+            f.close()
+
+        hooked.sort()
+        self.assertEqual(hooked, [ [str(os.getpid()), "urn:%d:%s" % (i, id),
+            str(id == "b")] for i in xrange(3) for id in ["a", "b"] ])
+
+if __name__ == "__main__":
+    unittest.main()
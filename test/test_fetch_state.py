@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# canto-fetch's own state (.backoff and .checked) is only written when it
+# changes, so a daemon with nothing due doesn't write anything. Only failures
+# to reach the server at all count against its host.
+
+from common import Home, rss
+from canto import canto_fetch
+from canto.fetch_backoff import Backoff
+from canto.fetch_checked import Checked
+
+import unittest
+import urllib2
+import socket
+import httplib
+import os
+
+class StateTest(unittest.TestCase):
+    def setUp(self):
+        self.home = Home()
+        self.good = self.home.script("good", rss("Good", ["urn:a"]))
+        self.bad = self.home.script("bad", "not a feed at all")
+        self.home.configure([ "add(\"%s\")" % self.good,
+            "add(\"%s\")" % self.bad, "fetch_processes = 0" ])
+
+    def tearDown(self):
+        self.home.remove()
+
+    def files(self):
+        r = []
+        for name in [".backoff", ".checked"]:
+            st = os.stat(self.home.feed_dir + name)
+            r.append((st.st_ino, st.st_mtime))
+        return r
+
+    def test_idle(self):
+        refresh = canto_fetch.RefreshQueue()
+        canto_fetch.run(self.home.cfg(), False, False, 1, None, None, refresh)
+
+        # The unchanged feed is checked once more, so both files exist.
+
+        canto_fetch.run(self.home.cfg(), False, True, 1)
+        before = self.files()
+
+        canto_fetch.run(self.home.cfg(), False, False, 1, None, None, refresh)
+        self.assertEqual(self.files(), before)
+
+    def test_save(self):
+        path = self.home.feed_dir + ".backoff"
+        backoff = Backoff(path)
+        backoff.failed(self.bad, None, 5)
+        backoff.save([self.good, self.bad])
+        before = os.stat(path).st_ino
+
+        Backoff(path).save([self.good, self.bad])
+        self.assertEqual(os.stat(path).st_ino, before)
+
+        # Feeds that are gone are still forgotten.
+
+        Backoff(path).save([self.good])
+        self.failIf(Backoff(path).until(self.bad))
+
+        path = self.home.feed_dir + ".checked"
+        checks = Checked(path)
+        checks.set(self.good, 1.0, 2.0)
+        checks.save([self.good])
+        before = os.stat(path).st_ino
+
+        checks.set(self.good, 1.0, 2.0)
+        checks.save([self.good])
+        Checked(path).save([self.good])
+        self.assertEqual(os.stat(path).st_ino, before)
+        self.assertEqual(Checked(path).get(self.good), (1.0, 2.0))
+
+    def test_connect(self):
+        self.home.configure([ "add(\"http://example.com/feed\")",
+            "fetch_processes = 0" ])
+        cfg = self.home.cfg()
+        fd = cfg.feeds[0]
+
+        def counts(e):
+            fetch = canto_fetch.FetchThread(cfg, fd, self.home.fpath(fd.URL),
+                    cfg.script_dir, False, lambda x: None, None)
+            fetch.backoff = Backoff(self.home.feed_dir + ".counts")
+            fetch.failed(e)
+            return ("host", "example.com") in fetch.backoff.state
+
+        self.failUnless(counts(urllib2.URLError(socket.error(111, "refused"))))
+        self.failUnless(counts(urllib2.URLError(socket.timeout("timed out"))))
+        self.failIf(counts(urllib2.URLError(httplib.BadStatusLine(""))))
+        self.failIf(counts(urllib2.HTTPError(fd.URL, 404, "", None, None)))
+        self.failIf(counts(socket.timeout("timed out")))
+        self.failIf(counts(ValueError("broken")))
+
+    # A forced daemon fetches every feed on every run, due or not.
+
+    def test_force(self):
+        self.home.configure([ "add(\"%s\")" % self.good,
+            "fetch_processes = 0" ])
+        refresh = canto_fetch.RefreshQueue()
+        canto_fetch.run(self.home.cfg(), False, True, 1, None, None, refresh)
+
+        self.home.script("good", rss("Changed", ["urn:a"]))
+        canto_fetch.run(self.home.cfg(), False, True, 1, None, None, refresh)
+
+        feed = self.home.cfg().store.load(self.home.fpath(self.good))[0]
+        self.assertEqual(feed["feed"]["title"], u"Changed")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# A client journaling states in another process while canto-fetch keeps
+# writing the feed out. Whichever way they interleave, no state is lost.
+
+from common import Home, rss
+from canto import canto_fetch, storage
+
+import unittest
+import time
+import os
+
+IDS = [ "urn:%d" % i for i in xrange(20) ]
+
+class InterleaveTest(unittest.TestCase):
+    def setUp(self):
+        self.home = Home()
+        self.URL = self.home.script("s", rss("S", IDS))
+        self.home.configure([ "add(\"%s\", keep=%d)" % (self.URL, len(IDS)),
+            "fetch_processes = 0" ])
+        self.fpath = self.home.fpath(self.URL)
+        canto_fetch.run(self.home.cfg(), False, True, 1)
+
+    def tearDown(self):
+        self.home.remove()
+
+    def client(self):
+        store = storage.PickleStore(self.home.feed_dir)
+        for id in IDS:
+            while store.update_states(self.fpath, [id],
+                    lambda states: { id : states[id] + [u"read"] }) == None:
+                time.sleep(0.01)
+            time.sleep(0.01)
+
+    def test_interleave(self):
+        pid = os.fork()
+        if not pid:
+            try:
+                self.client()
+            finally:
+                os._exit(0)
+
+        # Every fetch changes the feed, so it's written out every time.
+
+        try:
+            for i in xrange(10):
+                self.home.script("s", rss("S %d" % i, IDS))
+                canto_fetch.run(self.home.cfg(), False, True, 1)
+        finally:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+        feed = storage.PickleStore(self.home.feed_dir).load(self.fpath)[0]
+        self.assertEqual(feed["feed"]["title"], u"S 9")
+        self.assertEqual([ (e["id"], e["canto_state"]) for e in
+            feed["entries"] ], [ (id, [u"S", u"*", u"read"]) for id in IDS ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# SQLiteStore only changes a feed's mtime when it writes something, and only
+# logs writes that were committed.
+
+from common import Home
+from canto import storage
+from canto.feedparser_builtin import FeedParserDict
+
+import unittest
+
+def feed(ids):
+    f = FeedParserDict()
+    f["feed"] = FeedParserDict(title=u"T")
+    f["canto_update"] = 1.0
+    f["entries"] = [ FeedParserDict(id=id, title=id, canto_state=[u"*"])\
+            for id in ids ]
+    return f
+
+class SQLiteStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.home = Home()
+        self.store = storage.SQLiteStore(self.home.feed_dir)
+        self.fpath = self.home.feed_dir + "feed"
+        self.store.create(self.fpath, feed([u"a", u"b"]))
+
+    def tearDown(self):
+        self.home.remove()
+
+    def mtime(self):
+        return self.store.load(self.fpath)[1]
+
+    def test_unchanged_states(self):
+        mtime = self.mtime()
+        self.assertEqual(self.store.update_states(self.fpath, [u"a"],
+            lambda states: {}), (mtime, mtime))
+        self.assertEqual(self.mtime(), mtime)
+
+        before, after = self.store.update_states(self.fpath, [u"a"],
+                lambda states: { u"a" : states[u"a"] + [u"read"] })
+        self.assertEqual(before, mtime)
+        self.failUnless(after > mtime)
+        self.assertEqual(self.mtime(), after)
+
+    def test_log_after_commit(self):
+        seen = []
+
+        # Another connection can only see the new mtime once it's committed,
+        # and can only write if the database isn't locked.
+
+        def log(mtime):
+            db = storage.sqlite3.connect(self.store.path, timeout=0,
+                    isolation_level=None)
+            try:
+                seen.append(db.execute("SELECT mtime FROM feeds").fetchone()[0])
+                db.execute("BEGIN IMMEDIATE")
+                db.execute("ROLLBACK")
+            finally:
+                db.close()
+
+        mtime = self.store.write(self.fpath, feed([u"c"]), self.mtime(), log)
+        self.assertEqual(seen, [mtime])
+
+        # A write that fails the compare-and-swap isn't logged.
+
+        self.assertEqual(self.store.write(self.fpath, feed([u"d"]), 1.0, log),
+                None)
+        self.assertEqual(seen, [mtime])
+
+if not storage.sqlite3:
+    del SQLiteStoreTest
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Feeds written by older cantos, as a single pickle of the whole feed, have to
+# be read as they are and upgraded by canto-fetch, without losing the states
+# the client has journaled in the meantime.
+
+from common import Home, rss
+from canto import canto_fetch, storage
+
+import unittest
+import cPickle
+import stat
+import os
+
+TEXT = u"A long story. " * 1000
+
+class BaselineTest(unittest.TestCase):
+    def setUp(self):
+        self.home = Home()
+        self.URL = self.home.script("s", rss("S", ["urn:a", "urn:b"], TEXT))
+        self.home.configure([ "add(\"%s\")" % self.URL,
+            "fetch_processes = 0" ])
+        self.fpath = self.home.fpath(self.URL)
+
+        # Write the feed out the way canto used to, with the default protocol.
+
+        canto_fetch.run(self.home.cfg(), False, True, 1)
+        feed = storage.PickleStore(self.home.feed_dir).load(self.fpath)[0]
+        self.summary = feed["entries"][0]["summary"]
+        f = open(self.fpath, "w")
+        cPickle.dump(feed, f)
+        f.close()
+
+    def tearDown(self):
+        self.home.remove()
+
+    def version(self):
+        f = open(self.fpath)
+        try:
+            return storage.PickleStore(self.home.feed_dir).header(f)[0]
+        finally:
+            f.close()
+
+    def states(self, store):
+        feed = store.load(self.fpath)[0]
+        return [ (e["id"], e["canto_state"], e["summary"] == self.summary)\
+                for e in feed["entries"] ]
+
+    def test_upgrade(self):
+        store = storage.PickleStore(self.home.feed_dir)
+        self.assertEqual(self.version(), 0)
+        store.update_states(self.fpath, [u"urn:a"],
+                lambda states: { u"urn:a" : states[u"urn:a"] + [u"read"] })
+
+        self.assertEqual(self.states(store),
+                [ (u"urn:a", [u"S", u"*", u"read"], True),
+                  (u"urn:b", [u"S", u"*"], True) ])
+
+        # The client's loads don't rewrite it, only canto-fetch does.
+
+        self.assertEqual(self.version(), 0)
+
+        canto_fetch.run(self.home.cfg(), False, True, 1)
+        self.assertEqual(self.version(), storage.FORMAT)
+
+        store = storage.PickleStore(self.home.feed_dir)
+        self.assertEqual(self.states(store),
+                [ (u"urn:a", [u"S", u"*", u"read"], True),
+                  (u"urn:b", [u"S", u"*"], True) ])
+
+        # The texts went to the blob store.
+
+        feed = store.load(self.fpath, blobs=False)[0]
+        self.failUnless(storage.is_ref(
+            dict.__getitem__(feed["entries"][0], "summary")))
+
+    # With SQLiteStore, the client reads and journals the pickle until
+    # canto-fetch moves it into the database.
+
+    def test_sqlite(self):
+        self.home.configure([ "add(\"%s\")" % self.URL,
+            "fetch_processes = 0", "feed_storage = \"sqlite\"" ])
+        store = storage.SQLiteStore(self.home.feed_dir)
+        store.update_states(self.fpath, [u"urn:a"],
+                lambda states: { u"urn:a" : states[u"urn:a"] + [u"read"] })
+
+        self.assertEqual(self.states(store),
+                [ (u"urn:a", [u"S", u"*", u"read"], True),
+                  (u"urn:b", [u"S", u"*"], True) ])
+        self.failUnless(store.entry(self.fpath, u"urn:a"))
+        self.assertEqual(self.version(), 0)
+
+        canto_fetch.run(self.home.cfg(), False, True, 1)
+        self.failIf(os.path.exists(self.fpath))
+
+        store = storage.SQLiteStore(self.home.feed_dir)
+        self.assertEqual(self.states(store),
+                [ (u"urn:a", [u"S", u"*", u"read"], True),
+                  (u"urn:b", [u"S", u"*"], True) ])
+
+# Feeds, journals and blobs are readable by whoever the umask lets read them,
+# like the files canto used to write with open().
+
+class ModeTest(unittest.TestCase):
+    def setUp(self):
+        self.home = Home()
+        self.URL = self.home.script("s", rss("S", ["urn:a"], TEXT))
+        self.home.configure([ "add(\"%s\")" % self.URL,
+            "fetch_processes = 0" ])
+        self.fpath = self.home.fpath(self.URL)
+
+    def tearDown(self):
+        self.home.remove()
+
+    def test_mode(self):
+        canto_fetch.run(self.home.cfg(), False, True, 1)
+        store = storage.PickleStore(self.home.feed_dir)
+        store.update_states(self.fpath, [u"urn:a"],
+                lambda states: { u"urn:a" : states[u"urn:a"] + [u"read"] })
+
+        paths = [ self.fpath, store.journal(self.fpath) ]
+        for sub in os.listdir(self.home.feed_dir + ".blobs"):
+            dir = self.home.feed_dir + ".blobs/" + sub + "/"
+            paths += [ dir + file for file in os.listdir(dir) ]
+        self.failUnless(len(paths) > 2)
+
+        mask = os.umask(0)
+        os.umask(mask)
+        for path in paths:
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode),
+                    0666 & ~mask, path)
+
+if not storage.sqlite3:
+    del BaselineTest.test_sqlite
+
+if __name__ == "__main__":
+    unittest.main()